@@ -0,0 +1,265 @@
+'''Benchmarks for the converter.
+
+Usage: python benchmark.py [options]
+'''
+
+import copy
+import optparse
+import random
+import time
+import wstomwconverter
+
+def make_table(rows):
+    '''A wikispaces table with the given number of rows.'''
+    lines = ['||~ name ||~ value ||~ comment ||']
+    for i in range(rows):
+        lines.append('|| row %d ||= %d ||> some **bold** text ||' % (i, i * 7))
+    return '\n'.join(lines) + '\n'
+
+def make_gallery(images):
+    '''A page with the given number of image tags, a few of them repeated.'''
+    lines = []
+    for i in range(images):
+        lines.append('[[image:photo%d.jpg width="%d" height="80" align="left" '
+                     'caption="Photo number %d"]]' % (i % 50, 100 + i, i))
+    return '\n'.join(lines) + '\n'
+
+# Generators of the blocks a synthetic page is made of. Each takes a 
+# random.Random and returns the wikispaces source of one block.
+
+WORDS = ('wiki', 'page', 'space', 'convert', 'table', 'media', 'text', 
+         'link', 'image', 'list', 'the', 'a', 'of', 'and', 'with', 'for')
+
+def make_sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for i in range(words))
+
+def make_paragraph_block(rng):
+    return '%s **%s** %s //%s// %s __%s__ {{%s}}.\n' % (
+            make_sentence(rng), make_sentence(rng, 2), make_sentence(rng), 
+            make_sentence(rng, 3), make_sentence(rng), make_sentence(rng, 2), 
+            make_sentence(rng, 1))
+
+def make_list_block(rng):
+    return ''.join('%s %s\n' % ('*' * rng.randint(1, 3), make_sentence(rng, 6)) 
+                   for i in range(rng.randint(3, 8)))
+
+def make_table_block(rng):
+    return make_table(rng.randint(3, 30))
+
+def make_image_block(rng):
+    return '[[image:img%d.png width="%d" height="%d" align="right" ' \
+           'caption="%s"]]\n' % (rng.randint(1, 100), rng.randint(50, 400), 
+                                  rng.randint(50, 400), make_sentence(rng, 4))
+
+def make_code_block(rng):
+    return '[[code format="python"]]\n%s\n[[code]]\n' % '\n'.join(
+            'x = %d  # **not bold** //not italic//' % i 
+            for i in range(rng.randint(3, 15)))
+
+def make_escape_block(rng):
+    return 'Escaped: ``%s **raw**``, and more ``%s``.\n' % (
+            make_sentence(rng, 3), make_sentence(rng, 2))
+
+def make_link_block(rng):
+    return 'See [[http://example.com/%d|%s]], [[file:doc%d.pdf]], ' \
+           '[[include page="Page%d"]] and [[ftp://example.com/%d]].\n' % (
+            rng.randint(1, 1000), make_sentence(rng, 3), rng.randint(1, 100), 
+            rng.randint(1, 100), rng.randint(1, 1000))
+
+def make_math_block(rng):
+    return '[[math]]\\sum_{i=0}^{%d} x_i^2[[math]]\n' % rng.randint(1, 100)
+
+BLOCK_MAKERS = {
+    'paragraphs': make_paragraph_block,
+    'lists': make_list_block,
+    'tables': make_table_block,
+    'images': make_image_block,
+    'code': make_code_block,
+    'escapes': make_escape_block,
+    'links': make_link_block,
+    'math': make_math_block,
+    }
+
+DEFAULT_MIX = 'paragraphs=6,lists=2,tables=1,images=1,code=1,escapes=1,links=2,math=1'
+
+def parse_mix(mix):
+    '''Parse a 'name=weight,...' construct mix into a list of (name, weight).'''
+    weights = []
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in BLOCK_MAKERS:
+            raise ValueError('unknown construct %r' % name)
+        weights.append((name, float(weight)))
+    return weights
+
+def generate_page(rng, size, weights):
+    '''A synthetic wikispaces page of about size bytes.
+    
+    Blocks are picked at random according to weights, separated by 
+    blank lines, until the page reaches size.
+    '''
+    total = sum(weight for name, weight in weights)
+    blocks = []
+    length = 0
+    while length < size:
+        pick = rng.uniform(0, total)
+        for name, weight in weights:
+            pick -= weight
+            if pick <= 0:
+                break
+        block = BLOCK_MAKERS[name](rng)
+        blocks.append(block)
+        length += len(block) + 1
+    return '\n'.join(blocks)
+
+def generate_corpus(pages, size, mix=DEFAULT_MIX, seed=0):
+    '''A list of synthetic pages; the same arguments give the same corpus.'''
+    rng = random.Random(seed)
+    weights = parse_mix(mix)
+    return [generate_page(rng, size, weights) for i in range(pages)]
+
+def time_call(function, repeat):
+    '''Best wall time of repeat calls of function.'''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def time_stage(options, content, stage, repeat):
+    '''Best time of one stage of converting content, over repeat 
+    conversions with the regexp engine.'''
+    options = copy.copy(options)
+    options.engine = 'regexp'
+    best = None
+    for i in range(repeat):
+        profile = wstomwconverter.StageProfile()
+        wstomwconverter.IMAGE_TAG_CACHE.clear()
+        wstomwconverter.Converter(options, profile).convert(content)
+        elapsed = profile.stages[stage][0]
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Each benchmark takes the options of the converter, and the settings of 
+# the benchmarks: the command line options of main, with sizes and 
+# page_sizes as lists.
+
+def bench_tables(options, settings):
+    '''Time parse_tables on single tables of increasing row count.
+
+    If parse_tables is linear, the time per row stays flat.
+    '''
+    print '%10s %12s %14s' % ('rows', 'seconds', 'usec per row')
+    for rows in settings.sizes:
+        content = 'A paragraph.\n\n' + make_table(rows) + '\nThe end.\n'
+        elapsed = time_stage(options, content, 'parse_tables', 
+                             settings.repeat)
+        print '%10d %12.4f %14.2f' % (rows, elapsed, elapsed / rows * 1e6)
+
+def bench_images(options, settings):
+    '''Time parse_images on gallery pages of increasing image count.'''
+    print '%10s %12s %14s' % ('images', 'seconds', 'usec per image')
+    for images in settings.sizes:
+        content = 'A gallery.\n\n' + make_gallery(images)
+        elapsed = time_stage(options, content, 'parse_images', 
+                             settings.repeat)
+        print '%10d %12.4f %14.2f' % (images, elapsed, elapsed / images * 1e6)
+
+def bench_corpus(options, settings):
+    '''Convert synthetic corpora of increasing page size, end to end.
+    
+    Reports throughput in MB/s and pages/s for each page size, and with 
+    --stages, the time of each conversion stage.
+    '''
+    print '%10s %8s %10s %10s %10s' % ('page size', 'pages', 'seconds', 
+                                      'MB/s', 'pages/s')
+    pages = settings.pages
+    for size in settings.page_sizes:
+        corpus = generate_corpus(pages, size, settings.mix, settings.seed)
+        corpus_bytes = sum(len(page) for page in corpus)
+        best = None
+        for i in range(settings.repeat):
+            profile = wstomwconverter.StageProfile()
+            converter = wstomwconverter.Converter(options, profile)
+            wstomwconverter.IMAGE_TAG_CACHE.clear()
+            start = time.time()
+            for page in corpus:
+                converter.convert(page)
+            elapsed = time.time() - start
+            if best is None or elapsed < best[0]:
+                best = (elapsed, profile)
+        elapsed, profile = best
+        print '%10d %8d %10.4f %10.2f %10.1f' % (size, pages, elapsed, 
+                corpus_bytes / elapsed / 1e6, pages / elapsed)
+        if settings.stages:
+            print profile.report()
+            print
+
+def bench_tree(options, settings):
+    '''Time parsing synthetic corpora into document trees, and rendering 
+    the trees to mediawiki, with and without usemedia, and to plain text.'''
+    media_options = wstomwconverter.default_options()
+    media_options.usemedia = True
+    steps = [
+        ('parse', lambda page: wstomwconverter.parse(page, options)), 
+        ('mediawiki', lambda document: wstomwconverter.MediaWikiRenderer(
+                options).render_document(document)), 
+        ('usemedia', lambda document: wstomwconverter.MediaWikiRenderer(
+                media_options).render_document(document)), 
+        ('plain text', lambda document: wstomwconverter.PlainTextRenderer(
+                ).render_document(document)), 
+        ('links', wstomwconverter.page_links), 
+        ]
+    print '%10s %12s %10s %10s' % ('page size', 'step', 'seconds', 'MB/s')
+    for size in settings.page_sizes:
+        corpus = generate_corpus(settings.pages, size, settings.mix, 
+                                 settings.seed)
+        corpus_bytes = sum(len(page) for page in corpus)
+        documents = [wstomwconverter.parse(page, options) for page in corpus]
+        for name, step in steps:
+            inputs = corpus if name == 'parse' else documents
+            def run():
+                for item in inputs:
+                    step(item)
+            elapsed = time_call(run, settings.repeat)
+            print '%10d %12s %10.4f %10.2f' % (size, name, elapsed, 
+                                               corpus_bytes / elapsed / 1e6)
+
+BENCHMARKS = {
+    'tables': bench_tables,
+    'images': bench_images,
+    'corpus': bench_corpus,
+    'tree': bench_tree,
+    }
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--repeat", action="store", type="int", dest="repeat", help="Report the best of this many runs. [default: %default]")
+    parser.add_option("-s", "--sizes", action="store", dest="sizes", help="Comma-separated sizes, in table rows or images. [default: %default]")
+    parser.add_option("-b", "--bench", action="append", dest="bench", help="Benchmark to run, one of: " + ', '.join(sorted(BENCHMARKS)) + ". May be used multiple times. [default: all]")
+    parser.add_option("-P", "--page-sizes", action="store", dest="page_sizes", help="Comma-separated page sizes of the corpus benchmark, in bytes. [default: %default]")
+    parser.add_option("-n", "--pages", action="store", type="int", dest="pages", help="Number of pages of each size in the corpus benchmark. [default: %default]")
+    parser.add_option("-m", "--mix", action="store", dest="mix", help="Construct mix of the corpus benchmark, as comma-separated name=weight pairs. Constructs: " + ', '.join(sorted(BLOCK_MAKERS)) + ". [default: %default]")
+    parser.add_option("--seed", action="store", type="int", dest="seed", help="Random seed of the corpus generator. [default: %default]")
+    parser.add_option("--stages", action="store_true", dest="stages", help="Also print the time of each conversion stage in the corpus benchmark. [default: %default]")
+    parser.add_option("-e", "--engine", action="store", type="choice", choices=["regexp", "singlepass"], dest="engine", help="Conversion engine of the corpus benchmark. [default: %default]")
+    parser.set_defaults(repeat=3, sizes="1000,10000,100000", bench=[], 
+                        page_sizes="2000,20000,200000", pages=50, 
+                        mix=DEFAULT_MIX, seed=0, stages=False, engine="regexp")
+    (settings, args) = parser.parse_args()
+
+    settings.sizes = [int(size) for size in settings.sizes.split(',')]
+    settings.page_sizes = [int(size) 
+                           for size in settings.page_sizes.split(',')]
+    options = wstomwconverter.default_options()
+    options.engine = settings.engine
+    for name in settings.bench or sorted(BENCHMARKS):
+        print '%s:' % name
+        BENCHMARKS[name](options, settings)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,19 @@
 import unittest
+import os
+import shutil
+import sys
+import tempfile
+import time
+import random
+import StringIO
+import multiprocessing.pool
+import threading
+import httplib
+import json
+import xml.etree.ElementTree
+import zipfile
+import tarfile
+import socket
 import wstomwconverter
 
 class OptionsContainer:
@@ -7,7 +22,6 @@ class OptionsContainer:
 class TestConverter(unittest.TestCase):
     def setUp(self):    
         filepath = "./test.tmp"
-        open(filepath, 'w').write('junk')
     
         options = OptionsContainer()
         options.debug=False
@@ -15,7 +29,7 @@ class TestConverter(unittest.TestCase):
         options.filelocation="http://localhost/files/"
         
         self.converter = wstomwconverter.WikispacesToMediawikiConverter(filepath, 
-                        options)
+                        options, '')
     
     def test_bold_simple(self):
         self.source_wikitext = \
@@ -293,6 +307,24 @@ Another paragraph with [[Media:somefile.tex|a tex file]].
         self.converter.run_regexps()
         self.assertEqual(self.converter.content, self.target_wikitext)
 
+    def test_file_links_otherlocation(self):
+        self.source_wikitext = \
+"""
+A paragraph with [[file:somefile.doc]].
+
+Another paragraph with [[file:somefile.tex|a tex file]].
+"""
+        self.target_wikitext = \
+"""
+A paragraph with [http://example.com/files/somefile.doc somefile.doc].
+
+Another paragraph with [http://example.com/files/somefile.tex a tex file].
+"""
+        self.converter.content = self.source_wikitext
+        self.converter.options.filelocation = "http://example.com/files/"
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, self.target_wikitext)
+
     def test_code_tags(self):
         self.source_wikitext = \
 """
@@ -551,5 +583,1055 @@ A paragraph with some <nowiki>escaped stuff that would **otherwise be parsed**</
         self.converter.run_regexps()
         self.assertEqual(self.converter.content, self.target_wikitext)
 
+    def test_escapes_around_code(self):
+        self.source_wikitext = \
+"""
+A paragraph with ``escaped [[code]]code[[code]] in it``.
+"""
+        self.target_wikitext = \
+"""
+A paragraph with <nowiki>escaped <pre>code</pre> in it</nowiki>.
+"""
+        self.converter.content = self.source_wikitext
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, self.target_wikitext)
+
+    def test_escapes_many(self):
+        self.source_wikitext = \
+"""
+verbatim_placeholder_1 \x00 \x001\x00 **bold** """ + '``x``\n' * 2000
+        self.target_wikitext = \
+"""
+verbatim_placeholder_1 \x00 \x001\x00 '''bold''' """ + '<nowiki>x</nowiki>\n' * 2000
+        self.converter.content = self.source_wikitext
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, self.target_wikitext)
+
+    def test_stage_hook(self):
+        profile = wstomwconverter.StageProfile()
+        self.converter.stage_hook = profile
+        self.converter.content = "\nSome **bold** text.\n"
+        self.converter.run_regexps()
+        profile.merge(profile)
+        seconds, calls, bytes_in, bytes_out = profile.stages['parse_bold']
+        self.assertEqual((calls, bytes_out - bytes_in), (2, 4))
+
+    def test_skipped_stages(self):
+        profile = wstomwconverter.StageProfile()
+        self.converter.stage_hook = profile
+        # the underline markers are only made by parse_external_links
+        self.converter.content = "\nSee [[http://x_]]_ and [[http://y_]]_.\n"
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, 
+                         "\nSee http://x<u> and http://y</u>.\n")
+        self.assertEqual(profile.stages['parse_underline'][1], 1)
+        self.assertEqual(sorted(profile.skipped), 
+                         sorted(set(wstomwconverter.STAGE_MARKERS) - 
+                                set(['parse_italics', 'parse_external_links', 
+                                     'parse_underline', 'parse_indents'])))
+        self.assertTrue('parse_bold' not in profile.stages)
+        self.assertEqual(profile.skipped['parse_bold'], 1)
+        self.assertEqual(set(profile.skipped.values()), set([1]))
+
+    def test_time_budget(self):
+        self.converter.options.time_budget = 0.0001
+        self.converter.content = "\nSome **bold** and //italic// text.\n" * 20000
+        self.assertRaises(wstomwconverter.ConversionTimeout, 
+                          self.converter.run_regexps)
+
+    def test_unclosed_openers(self):
+        self.source_wikitext = \
+"""
+[[code format="x [[math]] m [[math]] [[include page="a"]x [[include page="b"]]
+[[http://a [[http://b|c]] {{ [[file:d]] [[image:e [[image:f]]
+"""
+        self.target_wikitext = \
+"""
+[[code format="x <math> m </math> [[include page="a"]x {{:b}}
+[http://a [[http://b c] {{ [http://localhost/files/d d] [[File:e]]
+"""
+        self.converter.content = self.source_wikitext
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, self.target_wikitext)
+
+    def test_math_around_code(self):
+        self.converter.content = "\n[[math]]a[[code]]b[[code]]c[[math]]\n"
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, 
+                         "\n<math>a<pre>b</pre>c</math>\n")
+
+    def test_toc_between_marks(self):
+        self.converter.content = "\n**bold**[[toc]]**bold**\n"
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, 
+                         "\n**bold''''''bold'''\n")
+        self.converter.content = "\n``raw``\n[[toc]]``raw``\n"
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, 
+                         "\n<nowiki>raw````raw</nowiki>\n")
+
+class TestSinglePassConverter(TestConverter):
+    '''Runs all of the TestConverter tests with the single-pass engine.'''
+    def setUp(self):
+        TestConverter.setUp(self)
+        self.converter.run_regexps = self.converter.run_singlepass
+    
+    # the tests whose markup is irregular enough for the engine to hand it 
+    # to the sequential passes; it must convert all the others itself
+    fallback_tests = set(['test_escapes_around_code', 'test_fallback', 
+                          'test_math_around_code', 'test_toc_between_marks', 
+                          'test_unclosed_openers'])
+    
+    def tearDown(self):
+        self.assertEqual(self.converter.singlepass_fallback, 
+                         self._testMethodName in self.fallback_tests)
+    
+    def test_stage_hook(self):
+        profile = wstomwconverter.StageProfile()
+        self.converter.stage_hook = profile
+        self.converter.content = "\nSome **bold** text.\n"
+        self.converter.run_regexps()
+        seconds, calls, bytes_in, bytes_out = profile.stages['singlepass']
+        self.assertEqual((calls, bytes_out - bytes_in), (1, 2))
+    
+    def test_skipped_stages(self):
+        profile = wstomwconverter.StageProfile()
+        self.converter.stage_hook = profile
+        self.converter.content = "\nSee [[http://x]] and **y**.\n"
+        self.converter.run_regexps()
+        self.assertEqual(profile.skipped, {})
+        self.assertEqual(profile.stages.keys(), ['singlepass'])
+    
+    def test_fallback(self):
+        profile = wstomwconverter.StageProfile()
+        self.converter.stage_hook = profile
+        self.converter.content = "\nSee [[http://x_]]_ and [[http://y_]]_.\n"
+        self.converter.run_regexps()
+        self.assertEqual(self.converter.content, 
+                         "\nSee http://x<u> and http://y</u>.\n")
+        self.assertTrue('singlepass_fallback' in profile.stages)
+        self.assertTrue('parse_external_links' in profile.stages)
+
+class TestSinglePassDifferential(unittest.TestCase):
+    '''Checks that the single-pass engine converts random markup like the 
+    sequential passes do.'''
+    pieces = ['a', ' ', '\n', '\n\n', '"', ']', ']]', '|', '[[', '**', '//', 
+              '__', '{{', '}}', '``', '[[code', ' format="', '"]]', 
+              '[[code]]', '[[math]]', '[[math', '[[http://', '[[ftp://', 
+              '[[file:', '[[include page="', '[[image:', '||', '*', '_', 
+              '\n||', '||\n', '|||', '>', '[[toc]]', '[[toc|flat]]', 
+              '{$page}', 'width="3" ', 'caption="c"', '=']
+    
+    def check_pages(self, pages, page_names):
+        for usemedia in (False, True):
+            regexp = wstomwconverter.default_options()
+            regexp.usemedia = usemedia
+            singlepass = wstomwconverter.default_options()
+            singlepass.usemedia = usemedia
+            singlepass.engine = 'singlepass'
+            for i, page in enumerate(pages):
+                page_name = page_names[i % len(page_names)]
+                self.assertEqual(
+                    wstomwconverter.convert(page, singlepass, page_name), 
+                    wstomwconverter.convert(page, regexp, page_name), 
+                    repr((page, page_name, usemedia)))
+    
+    def test_random_markup(self):
+        rng = random.Random(1)
+        pages = [''.join(rng.choice(self.pieces) 
+                         for j in range(rng.randint(1, 60)))
+                 for i in range(2000)]
+        self.check_pages(pages, ['Page', '|', '*', '[[image:'])
+    
+    def test_regular_markup(self):
+        # none of these should need the sequential passes
+        pages = [
+            "\n**bold** and //italics// and __under__ {{mono}}\n",
+            "\n[[toc]]\n>quoted\n>>more\n",
+            "\n||a||b||\n||c||d||\n",
+            "\nA [[http://x|link]], [[file:f.pdf]] and [[image:i.png]]\n",
+            "\n[[code]]**x**[[code]] ``//y//`` [[math]]z[[math]]\n",
+            "\n[[include page=\"Other\"]] on {$page}\n"]
+        self.check_pages(pages, ['Page'])
+        profile = wstomwconverter.StageProfile()
+        for page in pages:
+            converter = wstomwconverter.WikispacesToMediawikiConverter(
+                './test.tmp', wstomwconverter.default_options(), 'Page')
+            converter.content = page
+            converter.stage_hook = profile
+            converter.run_singlepass()
+        self.assertEqual(profile.stages.keys(), ['singlepass'])
+
+class TestAdversarialInput(unittest.TestCase):
+    '''Pages full of unclosed openers must still convert in linear time.
+    
+    Each page is converted at two sizes, 16 times apart: linear time gives 
+    a ratio of about 16 between the two, quadratic time about 256. The 
+    bound between them leaves room for slow or busy machines.
+    '''
+    units = ['{{ ', '__ x', '[[code]] ', '[[math]] ', '[[code format="x ', 
+             '[[math format="x ', '[[code format="x"]] ', '`` a ', 
+             '[[http://x ', '[[http://x|y ', '[[ftp://x ', '[[file:x ', 
+             '[[file:x|y ', '[[include page="x ', '[[include page="x" ', 
+             '[[image:x ', '|| x\n', '[[toc ', '**', '// ', '\n>']
+    
+    def conversion_time(self, engine, page):
+        options = wstomwconverter.default_options()
+        options.engine = engine
+        converter = wstomwconverter.Converter(options)
+        best = None
+        for i in range(3):
+            start_time = time.time()
+            converter.convert(page)
+            elapsed = time.time() - start_time
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+    
+    def check_linear(self, engine):
+        superlinear = []
+        for unit in self.units:
+            small = self.conversion_time(engine, 'start ' + unit * 1000 + ' end')
+            large = self.conversion_time(engine, 'start ' + unit * 16000 + ' end')
+            if large > 64 * max(small, 0.0005):
+                superlinear.append((unit, small, large))
+        self.assertEqual(superlinear, [])
+    
+    def test_regexp_engine(self):
+        self.check_linear('regexp')
+    
+    def test_singlepass_engine(self):
+        self.check_linear('singlepass')
+
+class TestConvert(unittest.TestCase):
+    def test_convert(self):
+        self.assertEqual(wstomwconverter.convert('Some **bold** text on {$page}.', 
+                page_name='A Page'), "Some '''bold''' text on A Page.")
+    
+    def test_options(self):
+        options = wstomwconverter.default_options()
+        options.usemedia = True
+        for engine in ('regexp', 'singlepass'):
+            options.engine = engine
+            self.assertEqual(wstomwconverter.convert('[[file:a.pdf]]\r\n', 
+                    options), '[[Media:a.pdf]]\n')
+    
+    def test_default_options(self):
+        options = wstomwconverter.default_options()
+        self.assertEqual(vars(options), vars(wstomwconverter.
+                make_option_parser().get_default_values()))
+        options.file.append('a')
+        options.engine = 'singlepass'
+        options = wstomwconverter.default_options()
+        self.assertEqual((options.file, options.engine), ([], 'regexp'))
+    
+    def test_no_files(self):
+        cwd = os.getcwd()
+        tempdir = tempfile.mkdtemp()
+        try:
+            os.chdir(tempdir)
+            wstomwconverter.convert('**bold**', page_name='page')
+            self.assertEqual(os.listdir(tempdir), [])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tempdir)
+
+class TestTree(unittest.TestCase):
+    page = ('Some **bold** and {{mono}} on {$page}: [[http://a.b/c|a link]]\n'
+            '\n\n'
+            '[[image:pic.png caption="A pic"]] [[file:doc.pdf]] '
+            '[[include page="Other"]]\n'
+            '[[code]]\nx = 1 || 2\n[[code]]\n\n\n'
+            '|| a ||~ b ||\n|| [[file:c.txt|c]] ||= ``d`` ||\n'
+            'The end.\n')
+    
+    def test_mediawiki_renderer(self):
+        document = wstomwconverter.parse(self.page)
+        for usemedia in (False, True):
+            options = wstomwconverter.default_options()
+            options.usemedia = usemedia
+            self.assertEqual(wstomwconverter.MediaWikiRenderer(options, 
+                    'Page').render_document(document), 
+                    wstomwconverter.convert(self.page, options, 'Page'))
+    
+    def test_mediawiki_renderer_random(self):
+        # the pages that a strict engine converts render like run_regexps
+        options = wstomwconverter.default_options()
+        rng = random.Random(2)
+        pieces = TestSinglePassDifferential.pieces
+        regular = 0
+        for i in range(1000):
+            page = ''.join(rng.choice(pieces) 
+                           for j in range(rng.randint(1, 20)))
+            text = wstomwconverter.extend_edges(page)[0]
+            try:
+                wstomwconverter.SinglePassEngine(options, 'Page', 
+                                                 strict=True).parse(text)
+            except wstomwconverter.IrregularMarkup:
+                continue
+            regular += 1
+            self.assertEqual(wstomwconverter.MediaWikiRenderer(options, 
+                    'Page').render_document(wstomwconverter.parse(page)), 
+                    wstomwconverter.convert(page, options, 'Page'), 
+                    repr(page))
+        self.assertTrue(regular > 100)
+    
+    def test_nodes(self):
+        document = wstomwconverter.parse(self.page)
+        first, gap, second, blank, third, end = document.children
+        self.assertEqual((gap, blank, end), ('\n\n\n', '\n\n', '\n\n\n'))
+        self.assertEqual([node.kind for node in first.children 
+                          if not isinstance(node, basestring)], 
+                         ['format', 'format', 'format', 'format', 'variable', 
+                          'external_link'])
+        self.assertEqual([node.kind for node in second.children 
+                          if not isinstance(node, basestring)], 
+                         ['image', 'file_link', 'include', 'code'])
+        self.assertEqual(third.children[0].kind, 'table')
+        self.assertFalse(hasattr(second.children[0], '__dict__'))
+        self.assertEqual(wstomwconverter.page_links(document), 
+                [('external', 'http://a.b/c'), ('image', 'pic.png'), 
+                 ('file', 'doc.pdf'), ('include', 'Other'), ('file', 'c.txt')])
+    
+    def test_plain_text(self):
+        document = wstomwconverter.parse(self.page)
+        self.assertEqual(wstomwconverter.PlainTextRenderer('Page').render_document(
+                document), 
+                'Some bold and mono on Page: a link\n\n\n'
+                ' doc.pdf \n\nx = 1 || 2\n\n\n\n'
+                '  a   b  \n  c   d  \nThe end.\n')
+
+class TestThreads(unittest.TestCase):
+    '''One Converter, shared by a pool of threads, must give the serial output.'''
+    def make_pages(self, count):
+        pages = []
+        for i in range(count):
+            pages.append('\n'.join([
+                    'Page %d: **bold** //italics// __under__ {{mono}} {$page}' % i,
+                    '[[code format="python"]]\nx = %d ``raw``\n[[code]]' % i,
+                    '|| %d ||= ``**not bold**`` ||\n|| [[image:a%d.png width="%d"]] ||' % (i, i % 7, i),
+                    '[[http://example.com/%d|link **%d**]] [[file:f%d.pdf]] ``{{x}}``' % (i, i, i),
+                    '[[include page="p%d"]] [[math]]x^%d[[math]] [[toc]]' % (i, i),
+                    ]) * (1 + i % 5))
+        return pages
+    
+    def check_threads(self, engine):
+        options = wstomwconverter.default_options()
+        options.engine = engine
+        pages = self.make_pages(60)
+        tasks = [(pages[i % len(pages)], 'page%d' % (i % len(pages))) 
+                 for i in range(len(pages) * 4)]
+        serial_profile = wstomwconverter.StageProfile()
+        serial = wstomwconverter.Converter(options, serial_profile)
+        expected = [serial.convert(text, name) for text, name in tasks]
+        
+        profile = wstomwconverter.StageProfile()
+        converter = wstomwconverter.Converter(options, profile)
+        pool = multiprocessing.pool.ThreadPool(8)
+        try:
+            wstomwconverter.IMAGE_TAG_CACHE.clear()
+            results = pool.map(lambda task: converter.convert(*task), tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(results, expected)
+        self.assertEqual(
+                dict((stage, stats[1:]) for stage, stats in profile.stages.items()), 
+                dict((stage, stats[1:]) for stage, stats in serial_profile.stages.items()))
+    
+    def test_regexp_engine(self):
+        self.check_threads('regexp')
+    
+    def test_singlepass_engine(self):
+        self.check_threads('singlepass')
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+    
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(self.path)
+
+class TestServer(unittest.TestCase):
+    def start_server(self, address):
+        server = wstomwconverter.make_server(address, 
+                                             wstomwconverter.Converter())
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.addCleanup(stop)
+        return server
+    
+    def request(self, connection, method, path, body=None):
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        return response.status, response.read()
+    
+    def test_http(self):
+        server = self.start_server('127.0.0.1:0')
+        connection = httplib.HTTPConnection(*server.server_address)
+        self.assertEqual(self.request(connection, 'POST', '/convert?page=Home', 
+                'Some **bold** on {$page}.'), (200, "Some '''bold''' on Home."))
+        status, body = self.request(connection, 'POST', '/batch', json.dumps([
+                {'name': 'a', 'text': u'//caf\xe9//'}, {'text': '[[toc]]'}]))
+        self.assertEqual((status, json.loads(body)), (200, [
+                {'name': 'a', 'text': u"''caf\xe9''"}, {'name': '', 'text': ''}]))
+        self.assertEqual(self.request(connection, 'POST', '/batch', '{}')[0], 400)
+        self.assertEqual(self.request(connection, 'GET', '/nothing')[0], 404)
+        status, body = self.request(connection, 'GET', '/stats')
+        stats = json.loads(body)
+        self.assertEqual((stats['requests'], stats['pages'], stats['errors']), 
+                         (3, 3, 1))
+        self.assertTrue(stats['max_latency'] >= stats['mean_latency'] > 0)
+    
+    def test_bad_requests(self):
+        server = self.start_server('127.0.0.1:0')
+        def connect():
+            return httplib.HTTPConnection(*server.server_address)
+        for pages in ([{'text': 1}], [{'name': ['a'], 'text': 'b'}], [None]):
+            self.assertEqual(self.request(connect(), 'POST', '/batch', 
+                                          json.dumps(pages))[0], 400)
+        for length in ('abc', '-1'):
+            connection = connect()
+            connection.putrequest('POST', '/convert')
+            connection.putheader('Content-Length', length)
+            connection.endheaders()
+            self.assertEqual(connection.getresponse().status, 400)
+        stats = json.loads(self.request(connect(), 'GET', '/stats')[1])
+        self.assertEqual((stats['requests'], stats['errors']), (5, 5))
+    
+    def test_unix_socket(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'socket')
+        # a socket left behind by a server that was killed is replaced
+        socket.socket(socket.AF_UNIX).bind(path)
+        self.start_server('unix:' + path)
+        self.assertEqual(self.request(UnixHTTPConnection(path), 'POST', 
+                '/convert', '[[http://a|b]]'), (200, '[http://a b]'))
+
+class TestTables(unittest.TestCase):
+    def test_generate_table_streaming(self):
+        def lines():
+            yield '||~ heading ||'
+            for i in range(1000):
+                yield '|| row %d ||' % i
+        output = ''.join(wstomwconverter.generate_table(lines()))
+        self.assertTrue(output.startswith(wstomwconverter.TABLE_HEADER + 
+                '|-\n! heading \n|-\n| row 0 \n'))
+        self.assertTrue(output.endswith('|-\n| row 999 \n|}'))
+    
+    def test_triple_bars(self):
+        self.assertEqual(wstomwconverter.convert_table('||a|||b||||\n||c||'), 
+                wstomwconverter.TABLE_HEADER + 
+                '|-\n|a\n||b\n|-\n|c\n|}')
+    
+    def test_find_tables(self):
+        content = '\n|| a ||\n|| b ||\ntext ||\n\n|| unterminated\n\n'
+        self.assertEqual(list(wstomwconverter.find_tables(content)), [(1, 16)])
+
+class TestChunks(unittest.TestCase):
+    page = ('Some __underlined\n\ntext__ and **bold**.\n\n'
+            '[[code]]\nx = 1\n\ny = 2\n[[code]]\n\n'
+            '|| unterminated\n\n|| row ||\n\n'
+            '[[toc]] [[image:a.png\n\ncaption="b"]] {{mono}}\n\n'
+            '> indented //italics//\n')
+    
+    def chunks(self, page, chunk_size=1):
+        return list(wstomwconverter.iter_chunks(page.splitlines(True), 
+                                                chunk_size))
+    
+    def test_iter_chunks(self):
+        self.assertEqual(self.chunks(self.page), [
+                'Some __underlined\n\ntext__ and **bold**.\n', 
+                '\n[[code]]\nx = 1\n\ny = 2\n[[code]]\n', 
+                '\n|| unterminated\n\n|| row ||\n', 
+                '\n[[toc]] [[image:a.png\n\ncaption="b"]] {{mono}}\n', 
+                '\n> indented //italics//\n'])
+        self.assertEqual(self.chunks(self.page, 60), [
+                'Some __underlined\n\ntext__ and **bold**.\n\n'
+                '[[code]]\nx = 1\n\ny = 2\n[[code]]\n', 
+                '\n|| unterminated\n\n|| row ||\n\n'
+                '[[toc]] [[image:a.png\n\ncaption="b"]] {{mono}}\n', 
+                '\n> indented //italics//\n'])
+    
+    def test_same_output(self):
+        page = self.page * 20
+        for engine in ('regexp', 'singlepass'):
+            options = wstomwconverter.default_options()
+            options.engine = engine
+            self.assertEqual(''.join(wstomwconverter.convert_chunks(
+                    self.chunks(page), 'page', options)), 
+                    wstomwconverter.convert(page, options, 'page'))
+    
+    def test_irregular_page(self):
+        # chunks whose markup pairs up across the cut; the page is then 
+        # converted whole
+        for part in ('{[[toc|flat]]{$page}\n\n}}\n', 
+                     '[[math]]\n\n[[math]]x\n\n[[math]]\n'):
+            self.assertRaises(wstomwconverter.IrregularMarkup, list, 
+                    wstomwconverter.convert_chunks(self.chunks(part), 'page', 
+                            wstomwconverter.default_options()))
+        page = ('[[include page="a\n\nb"]]\n\n{[[toc|flat]]{$page}\n\n}}\n\n'
+                '[[math]]\n\n[[math]]x\n\n[[math]]\n') * 10
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        filepath = os.path.join(tempdir, 'page')
+        open(filepath, 'w').write(page)
+        options = wstomwconverter.default_options()
+        options.stream = 1
+        result = wstomwconverter.convert_file((filepath, options))
+        self.assertEqual(result.error, None)
+        self.assertEqual(open(filepath + '_mediawiki').read(), 
+                         wstomwconverter.convert(page, options, 'page'))
+
+class TestImages(unittest.TestCase):
+    def test_attributes(self):
+        self.assertEqual(wstomwconverter.parse_image_attributes(
+                '[[image:a.gif width="x" width="20" valign="top" caption="see link="here""'), 
+                {'width': '20', 'align': 'top', 'caption': 'see link=', 'link': 'here'})
+    
+    def test_memoized(self):
+        imagetag = '[[image:somefile.gif width="20" caption="some caption"'
+        converted = wstomwconverter.convert_image_tag(imagetag)
+        self.assertEqual(converted, '[[File:somefile.gif|thumb|20px|some caption')
+        self.assertTrue(wstomwconverter.convert_image_tag(imagetag) is converted)
+
+class TestStarter(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+    
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tempdir)
+    
+    def write_pages(self, count):
+        filepaths = []
+        for i in range(count):
+            filepath = os.path.join(self.tempdir, 'page%d' % i)
+            open(filepath, 'w').write('Page %d with **bold** and //italics//.\n' % i)
+            filepaths.append(filepath)
+        return filepaths
+    
+    def read_output(self, filepath):
+        return open(filepath + '_mediawiki').read()
+    
+    def run_starter(self, args):
+        return wstomwconverter.Starter(['-q'] + args).start()
+    
+    def run_report(self, args):
+        '''Run the starter, and return what it prints.'''
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            wstomwconverter.Starter(args).start()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+    
+    def test_batch(self):
+        filepaths = self.write_pages(3)
+        args = []
+        for filepath in filepaths:
+            args += ['-f', filepath]
+        self.assertEqual(self.run_starter(args), 0)
+        self.assertEqual(self.read_output(filepaths[2]), 
+                "Page 2 with '''bold''' and ''italics''.\n")
+    
+    def test_parallel_batch(self):
+        filepaths = self.write_pages(6)
+        args = ['-j', '3']
+        for filepath in filepaths:
+            args += ['-f', filepath]
+        self.assertEqual(self.run_starter(args), 0)
+        for i, filepath in enumerate(filepaths):
+            self.assertEqual(self.read_output(filepath), 
+                    "Page %d with '''bold''' and ''italics''.\n" % i)
+    
+    def test_parallel_batch_failure(self):
+        filepaths = self.write_pages(2)
+        missing = os.path.join(self.tempdir, 'missing')
+        args = ['-j', '2', '-f', filepaths[0], '-f', missing, '-f', filepaths[1]]
+        self.assertEqual(self.run_starter(args), 1)
+        self.assertTrue(os.path.exists(filepaths[1] + '_mediawiki'))
+        self.assertTrue(missing in sys.stderr.getvalue())
+    
+    def test_recursive(self):
+        filepaths = self.write_pages(2)
+        subdir = os.path.join(self.tempdir, 'sub')
+        os.mkdir(subdir)
+        for name in ('page.txt', 'draft.txt', 'notes.bak'):
+            open(os.path.join(subdir, name), 'w').write('**x**')
+        self.assertEqual(self.run_starter(['-r', self.tempdir, 
+                '-i', '*page*', '-i', '*.txt', '-x', 'sub/draft*']), 0)
+        self.assertTrue(os.path.exists(filepaths[0] + '_mediawiki'))
+        self.assertTrue(os.path.exists(os.path.join(subdir, 'page.txt_mediawiki')))
+        self.assertFalse(os.path.exists(os.path.join(subdir, 'draft.txt_mediawiki')))
+        self.assertFalse(os.path.exists(os.path.join(subdir, 'notes.bak_mediawiki')))
+        # converter output is never picked up as input on a rerun, even 
+        # when a batch that was killed left it half written
+        open(filepaths[1] + '_mediawiki.part', 'w').write('half')
+        files = list(wstomwconverter.walk_files(self.tempdir))
+        self.assertFalse([f for f in files if '_mediawiki' in f])
+    
+    def test_filelist(self):
+        filepaths = self.write_pages(3)
+        listpath = os.path.join(self.tempdir, 'list')
+        open(listpath, 'w').write('\0'.join(filepaths[1:]) + '\0')
+        self.assertEqual(self.run_starter(['-F', listpath, '-0']), 0)
+        self.assertFalse(os.path.exists(filepaths[0] + '_mediawiki'))
+        self.assertTrue(os.path.exists(filepaths[1] + '_mediawiki'))
+        self.assertTrue(os.path.exists(filepaths[2] + '_mediawiki'))
+    
+    def test_time_budget(self):
+        filepaths = self.write_pages(2)
+        open(filepaths[1], 'w').write('Some **bold** and //italics//.\n' * 50000)
+        self.assertEqual(self.run_starter(['--time-budget', '0.02', 
+                '-f', filepaths[0], '-f', filepaths[1]]), 1)
+        self.assertTrue(os.path.exists(filepaths[0] + '_mediawiki'))
+        self.assertTrue('%s: ConversionTimeout' % filepaths[1] in sys.stderr.getvalue())
+    
+    def test_stream(self):
+        filepaths = self.write_pages(2)
+        page = 'Some **bold**\n\n[[code]]\n//code//\n\n[[code]]\n\n' * 1000
+        open(filepaths[1], 'w').write(page)
+        self.assertEqual(self.run_starter(['--stream', '100', 
+                '-f', filepaths[0], '-f', filepaths[1]]), 0)
+        self.assertEqual(self.read_output(filepaths[0]), 
+                "Page 0 with '''bold''' and ''italics''.\n")
+        self.assertEqual(self.read_output(filepaths[1]), 
+                wstomwconverter.convert(page, page_name='page1'))
+        self.assertEqual(sorted(os.listdir(self.tempdir)), 
+                ['page0', 'page0_mediawiki', 'page1', 'page1_mediawiki'])
+    
+    def test_split(self):
+        filepaths = self.write_pages(3)
+        page = ('|| a ||\n\n|| b ||\n[[code]]\n\n[[code]]\n\n'
+                '[[toc]]**bold** {{mono\n\n}}\n\n') * 500
+        open(filepaths[1], 'w').write(page)
+        open(filepaths[2], 'w').write(page * 2)
+        for args in ([], ['--io-threads', '2']):
+            self.assertEqual(self.run_starter(['-j', '2', '--split', '1000', 
+                    '-f', filepaths[0], '-f', filepaths[1], '-f', filepaths[2]] 
+                    + args), 0)
+            self.assertEqual(self.read_output(filepaths[1]), 
+                    wstomwconverter.convert(page, page_name='page1'))
+            self.assertEqual(self.read_output(filepaths[2]), 
+                    wstomwconverter.convert(page * 2, page_name='page2'))
+            self.assertEqual(self.read_output(filepaths[0]), 
+                    "Page 0 with '''bold''' and ''italics''.\n")
+    
+    def test_manifest(self):
+        filepaths = self.write_pages(3)
+        filepaths.append(os.path.join(self.tempdir, 'p\xc3\xa4ge'))
+        open(filepaths[3], 'w').write('**new**')
+        manifest = os.path.join(self.tempdir, 'manifest')
+        def run(*args):
+            args = ['--manifest', manifest] + list(args)
+            for filepath in filepaths:
+                args += ['-f', filepath]
+            return self.run_report(args)
+        self.assertTrue('Converted 4 pages, 0 failed, 0 unchanged' in run())
+        self.assertTrue('Converted 0 pages, 0 failed, 4 unchanged' in run())
+        open(filepaths[0], 'a').write('More **bold**.\n')
+        os.remove(filepaths[1] + '_mediawiki')
+        self.assertTrue('Converted 2 pages, 0 failed, 2 unchanged' in run())
+        self.assertEqual(self.read_output(filepaths[0]), 
+                "Page 0 with '''bold''' and ''italics''.\nMore '''bold'''.\n")
+        self.assertTrue(os.path.exists(filepaths[1] + '_mediawiki'))
+        self.assertTrue('Converted 4 pages, 0 failed, 0 unchanged' in 
+                        run('--usemedia'))
+    
+    def test_manifest_reads_once(self):
+        filepaths = self.write_pages(3)
+        manifest = os.path.join(self.tempdir, 'manifest')
+        args = ['--manifest', manifest]
+        for filepath in filepaths:
+            args += ['-f', filepath]
+        read = []
+        def read_page(filepath, read_page=wstomwconverter.read_page):
+            read.append(filepath)
+            return read_page(filepath)
+        self.addCleanup(setattr, wstomwconverter, 'read_page', 
+                        wstomwconverter.read_page)
+        wstomwconverter.read_page = read_page
+        def page_digest(filepath, options, content=None, 
+                        page_digest=wstomwconverter.page_digest):
+            self.assertTrue(content is not None)
+            return page_digest(filepath, options, content)
+        self.addCleanup(setattr, wstomwconverter, 'page_digest', 
+                        wstomwconverter.page_digest)
+        wstomwconverter.page_digest = page_digest
+        for io_args in ([], ['--io-threads', '2']):
+            self.assertTrue('Converted 3 pages, 0 failed, 0 unchanged' in 
+                            self.run_report(io_args + args))
+            self.assertEqual(sorted(read), sorted(filepaths))
+            del read[:]
+            os.remove(manifest)
+        self.run_report(args)
+        self.addCleanup(setattr, wstomwconverter, 'OUTPUT_FORMAT', 
+                        wstomwconverter.OUTPUT_FORMAT)
+        wstomwconverter.OUTPUT_FORMAT += 1
+        self.assertTrue('Converted 3 pages, 0 failed, 0 unchanged' in 
+                        self.run_report(args))
+    
+    def test_journal_resume(self):
+        filepaths = self.write_pages(4)
+        journal = os.path.join(self.tempdir, 'journal')
+        args = ['--journal', journal, '-f', os.path.join(self.tempdir, 'missing')]
+        for filepath in filepaths:
+            args += ['-f', filepath]
+        self.assertEqual(self.run_starter(['-j', '2'] + args), 1)
+        entries = wstomwconverter.load_journal(journal)
+        self.assertEqual(sorted(entries), sorted(os.path.abspath(filepath) 
+                                                 for filepath in filepaths))
+        line = json.loads(open(journal).readline())
+        self.assertEqual(line[2], os.path.abspath(filepaths[0]) + '_mediawiki')
+        # a crash in the middle of writing the third entry
+        lines = open(journal).readlines()
+        open(journal, 'w').write(''.join(lines[:2]) + lines[2][:10])
+        open(filepaths[0], 'a').write('More.\n')
+        self.assertTrue('Converted 3 pages, 1 failed, 1 unchanged' in 
+                        self.run_report(['--resume'] + args))
+        self.assertEqual(self.read_output(filepaths[0]), 
+                "Page 0 with '''bold''' and ''italics''.\nMore.\n")
+        self.assertEqual(len(wstomwconverter.load_journal(journal)), 4)
+        self.assertTrue('Converted 0 pages, 1 failed, 4 unchanged' in 
+                        self.run_report(['--resume'] + args))
+        self.assertRaises(SystemExit, self.run_starter, ['--resume'])
+    
+    def test_output_counts(self):
+        filepaths = self.write_pages(3)
+        args = ['-f', filepaths[0], '-f', filepaths[1], '-f', filepaths[2]]
+        self.assertTrue('Output files: 3 new, 0 updated, 0 unchanged.' in 
+                        self.run_report(args))
+        os.utime(filepaths[0] + '_mediawiki', (0, 0))
+        open(filepaths[1], 'a').write('More.\n')
+        self.assertTrue('Output files: 0 new, 1 updated, 2 unchanged.' in 
+                        self.run_report(args))
+        self.assertEqual(os.path.getmtime(filepaths[0] + '_mediawiki'), 0)
+        self.assertEqual(self.read_output(filepaths[1]), 
+                "Page 1 with '''bold''' and ''italics''.\nMore.\n")
+        self.assertTrue('Output files: 0 new, 0 updated, 3 unchanged.' in 
+                        self.run_report(['--stream', '1'] + args))
+        self.assertEqual(len(os.listdir(self.tempdir)), 6)
+    
+    def test_failed_write(self):
+        filepaths = self.write_pages(1)
+        os.mkdir(filepaths[0] + '_mediawiki')
+        for args in ([], ['--stream', '1'], ['--io-threads', '2']):
+            self.assertEqual(self.run_starter(args + ['-f', filepaths[0]]), 1)
+            self.assertEqual(sorted(os.listdir(self.tempdir)), 
+                             ['page0', 'page0_mediawiki'])
+    
+    def test_xml_dump(self):
+        filepaths = self.write_pages(3)
+        open(filepaths[1], 'w').write('a < b && **c**\x0c\n\n' * 100)
+        dump = os.path.join(self.tempdir, 'dump.xml')
+        for args in ([], ['-j', '2'], ['--stream', '100'], 
+                     ['-j', '2', '--split', '100']):
+            self.assertEqual(self.run_starter(args + ['--xml-dump', dump, 
+                    '-f', filepaths[0], '-f', filepaths[1], 
+                    '-f', os.path.join(self.tempdir, 'missing'), 
+                    '-f', filepaths[2]]), 1)
+            namespace = '{http://www.mediawiki.org/xml/export-0.10/}'
+            pages = dict((page.findtext(namespace + 'title'), 
+                          page.findtext(namespace + 'revision/' + namespace + 'text'))
+                         for page in xml.etree.ElementTree.parse(dump).getroot())
+            self.assertEqual(sorted(pages), ['page0', 'page1', 'page2'])
+            self.assertEqual(pages['page1'], "a < b && '''c'''\n\n" * 100)
+            self.assertEqual(pages['page2'], 
+                             "Page 2 with '''bold''' and ''italics''.\n")
+        self.assertFalse(os.path.exists(filepaths[0] + '_mediawiki'))
+        self.assertEqual(sorted(os.listdir(self.tempdir)), 
+                         ['dump.xml', 'page0', 'page1', 'page2'])
+    
+    def test_xml_dump_titles(self):
+        filepaths = self.write_pages(2)
+        os.mkdir(os.path.join(self.tempdir, 'sub'))
+        for name in ('page0', 'Page1'):
+            open(os.path.join(self.tempdir, 'sub', name), 'w').write('**x**\n')
+        dump = os.path.join(self.tempdir, 'dump.xml')
+        self.assertTrue('Converted 2 pages, 2 failed' in self.run_report([
+                '-f', filepaths[0], '-f', filepaths[1], 
+                '-r', os.path.join(self.tempdir, 'sub'), '--xml-dump', dump]))
+        namespace = '{http://www.mediawiki.org/xml/export-0.10/}'
+        pages = xml.etree.ElementTree.parse(dump).getroot()
+        self.assertEqual([page.findtext(namespace + 'title') for page in pages], 
+                         ['page0', 'page1'])
+    
+    def test_file_results(self):
+        filepaths = self.write_pages(3)
+        listed = []
+        def listing():
+            for filepath in filepaths:
+                listed.append(filepath)
+                yield filepath
+        self.addCleanup(setattr, wstomwconverter, 'BATCH_SIZE', 
+                        wstomwconverter.BATCH_SIZE)
+        wstomwconverter.BATCH_SIZE = 2
+        results = wstomwconverter.Starter([]).file_results(listing())
+        self.assertEqual(results.next().filepath, filepaths[0])
+        self.assertEqual(listed, filepaths[:2])
+        self.assertEqual([result.filepath for result in results], 
+                         filepaths[1:])
+        self.assertTrue('Peak memory: ' in 
+                        self.run_report(['-f', filepaths[0]]))
+    
+    def test_io_threads(self):
+        filepaths = self.write_pages(4)
+        open(filepaths[3], 'w').write('A **big** page.\n\n' * 100)
+        missing = os.path.join(self.tempdir, 'missing')
+        args = ['--io-threads', '2', '--stream', '100', '-f', missing]
+        for filepath in filepaths:
+            args += ['-f', filepath]
+        for jobs, counts in (('1', '4 new, 0 updated, 0 unchanged'), 
+                             ('2', '0 new, 0 updated, 4 unchanged')):
+            self.assertTrue('Output files: %s.' % counts in 
+                            self.run_report(['-j', jobs] + args))
+            self.assertTrue(missing in sys.stderr.getvalue())
+            self.assertEqual(self.read_output(filepaths[2]), 
+                    "Page 2 with '''bold''' and ''italics''.\n")
+            self.assertEqual(self.read_output(filepaths[3]), 
+                             "A '''big''' page.\n\n" * 100)
+    
+    def test_interrupted(self):
+        filepaths = self.write_pages(20)
+        args = ['-j', '2', '--io-threads', '2', '--split', '10']
+        for filepath in filepaths:
+            args += ['-f', filepath]
+        pools = []
+        def pool(processes=None, make_pool=multiprocessing.Pool):
+            pools.append(make_pool(processes))
+            return pools[-1]
+        self.addCleanup(setattr, multiprocessing, 'Pool', multiprocessing.Pool)
+        multiprocessing.Pool = pool
+        def record_result(starter, result, dump=None, pages=None):
+            raise KeyboardInterrupt
+        self.addCleanup(setattr, wstomwconverter.Starter, 'record_result', 
+                        wstomwconverter.Starter.record_result)
+        wstomwconverter.Starter.record_result = record_result
+        self.assertRaises(KeyboardInterrupt, self.run_starter, args)
+        self.assertEqual(pools[0]._state, multiprocessing.pool.TERMINATE)
+    
+    def test_io_threads_latency(self):
+        filepaths = self.write_pages(10)
+        read_page = wstomwconverter.read_page
+        write_if_changed = wstomwconverter.write_if_changed
+        # the most reads and writes that were under way at once
+        lock = threading.Lock()
+        busy = {'now': 0, 'most': 0}
+        def slow(function, *args):
+            with lock:
+                busy['now'] += 1
+                busy['most'] = max(busy['most'], busy['now'])
+            try:
+                time.sleep(0.05)
+                return function(*args)
+            finally:
+                with lock:
+                    busy['now'] -= 1
+        def slow_read_page(filepath):
+            return slow(read_page, filepath)
+        def slow_write_if_changed(path, content):
+            return slow(write_if_changed, path, content)
+        wstomwconverter.read_page = slow_read_page
+        wstomwconverter.write_if_changed = slow_write_if_changed
+        self.addCleanup(setattr, wstomwconverter, 'read_page', read_page)
+        self.addCleanup(setattr, wstomwconverter, 'write_if_changed', 
+                        write_if_changed)
+        args = []
+        for filepath in filepaths:
+            args += ['-f', filepath]
+        self.assertEqual(self.run_starter(args), 0)
+        self.assertEqual(busy['most'], 1)
+        for filepath in filepaths:
+            os.remove(filepath + '_mediawiki')
+        self.assertEqual(self.run_starter(['--io-threads', '8'] + args), 0)
+        self.assertTrue(busy['most'] > 1)
+        self.assertEqual(self.read_output(filepaths[9]), 
+                "Page 9 with '''bold''' and ''italics''.\n")
+    
+    def write_archives(self):
+        '''A zip and a tar.gz archive of the same pages; returns their paths.'''
+        members = [('export/page0', 'Zero **zero**\n'), 
+                   ('export/sub/page1', '[[code]]\n**x**\n[[code]]\n'), 
+                   ('export/page0_mediawiki', 'old output'), 
+                   ('../escape', '//out//\n')]
+        zip_path = os.path.join(self.tempdir, 'export.zip')
+        archive = zipfile.ZipFile(zip_path, 'w')
+        archive.writestr('export/', '')
+        for name, content in members:
+            archive.writestr(name, content)
+        archive.close()
+        tar_path = os.path.join(self.tempdir, 'export.tar.gz')
+        archive = tarfile.open(tar_path, 'w:gz')
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = 1300000000
+            archive.addfile(info, StringIO.StringIO(content))
+        archive.close()
+        return zip_path, tar_path
+    
+    def test_archive(self):
+        expected = {'export/page0': "Zero '''zero'''\n", 
+                    'export/sub/page1': '<pre>\n**x**\n</pre>\n', 
+                    'escape': "''out''\n"}
+        outdir = os.path.join(self.tempdir, 'out')
+        output = os.path.join(self.tempdir, 'out.zip')
+        zip_path, tar_path = self.write_archives()
+        for archive in (zip_path, tar_path):
+            for jobs in ('1', '2'):
+                shutil.rmtree(outdir, True)
+                self.assertEqual(self.run_starter(['-j', jobs, '-a', archive, 
+                        '--output-dir', outdir]), 0)
+                for name, content in expected.items():
+                    self.assertEqual(open(os.path.join(outdir, name) + 
+                                          '_mediawiki').read(), content)
+                self.assertFalse(os.path.exists(os.path.join(outdir, 
+                        'export', 'page0_mediawiki_mediawiki')))
+            self.assertEqual(self.run_starter(['-a', archive, '-x', 'escape', 
+                    '--output-archive', output]), 0)
+            converted = zipfile.ZipFile(output)
+            self.assertEqual(sorted(converted.namelist()), 
+                             ['export/page0_mediawiki', 
+                              'export/sub/page1_mediawiki'])
+            self.assertEqual(converted.read('export/page0_mediawiki'), 
+                             expected['export/page0'])
+            converted.close()
+        self.assertTrue('Output files: 0 new, 0 updated, 3 unchanged.' in 
+                self.run_report(['-a', zip_path, '--output-dir', outdir]))
+        self.assertRaises(SystemExit, self.run_starter, ['-a', output])
+    
+    def test_bad_archives(self):
+        zip_path, tar_path = self.write_archives()
+        junk = os.path.join(self.tempdir, 'junk.zip')
+        open(junk, 'w').write('junk\n')
+        corrupt = os.path.join(self.tempdir, 'corrupt.zip')
+        archive = zipfile.ZipFile(corrupt, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('page', 'A **page**\n' * 100)
+        archive.close()
+        data = open(corrupt, 'rb').read()
+        open(corrupt, 'wb').write(data[:40] + 'x' * 20 + data[60:])
+        outdir = os.path.join(self.tempdir, 'out')
+        for jobs in ('1', '2'):
+            report = self.run_report(['-j', jobs, '-a', junk, 
+                    '-a', os.path.join(self.tempdir, 'missing.tar'), 
+                    '-a', corrupt, '-a', tar_path, '--output-dir', outdir])
+            self.assertTrue('Converted 3 pages, 3 failed' in report)
+            self.assertEqual(open(os.path.join(outdir, 'export', 'page0') + 
+                                  '_mediawiki').read(), "Zero '''zero'''\n")
+        self.assertEqual(self.run_starter(['-a', corrupt, 
+                                           '--output-dir', outdir]), 1)
+    
+    def test_archive_utf8_names(self):
+        # zipfile flags non-ASCII names as UTF-8, and reads them back as 
+        # unicode; they must still be bytes, like every other path
+        zip_path = os.path.join(self.tempdir, 'export.zip')
+        archive = zipfile.ZipFile(zip_path, 'w')
+        archive.writestr(u'export/caf\xe9', 'Caf\xc3\xa9 **au lait**\n')
+        archive.close()
+        name = 'export/caf\xc3\xa9'
+        content = "Caf\xc3\xa9 '''au lait'''\n"
+        outdir = os.path.join(self.tempdir, 'out')
+        output = os.path.join(self.tempdir, 'out.zip')
+        dump = os.path.join(self.tempdir, 'dump.xml')
+        manifest = os.path.join(self.tempdir, 'manifest')
+        for jobs in ('1', '2'):
+            shutil.rmtree(outdir, True)
+            self.assertEqual(self.run_starter(['-j', jobs, '-a', zip_path, 
+                    '--output-dir', outdir, '--manifest', manifest]), 0)
+            self.assertEqual(open(os.path.join(outdir, name) + 
+                                  '_mediawiki').read(), content)
+        self.assertEqual(self.run_starter(['-a', zip_path, 
+                '--output-archive', output]), 0)
+        converted = zipfile.ZipFile(output)
+        self.assertEqual(converted.read(name + '_mediawiki'), content)
+        converted.close()
+        self.assertEqual(self.run_starter(['-a', zip_path, 
+                '--xml-dump', dump]), 0)
+        namespace = '{http://www.mediawiki.org/xml/export-0.10/}'
+        page = xml.etree.ElementTree.parse(dump).getroot()[0]
+        self.assertEqual(page.findtext(namespace + 'title'), u'caf\xe9')
+    
+    def test_archive_xml_dump(self):
+        tar_path = self.write_archives()[1]
+        dump = os.path.join(self.tempdir, 'dump.xml')
+        manifest = os.path.join(self.tempdir, 'manifest')
+        args = ['-a', tar_path, '--xml-dump', dump, '--manifest', manifest]
+        self.assertTrue('Converted 3 pages, 0 failed, 0 unchanged' in 
+                        self.run_report(args))
+        namespace = '{http://www.mediawiki.org/xml/export-0.10/}'
+        pages = xml.etree.ElementTree.parse(dump).getroot()
+        self.assertEqual([page.findtext(namespace + 'title') for page in pages], 
+                         ['page0', 'page1', 'escape'])
+        self.assertEqual(pages[0].findtext(namespace + 'revision/' + 
+                namespace + 'timestamp'), '2011-03-13T07:06:40Z')
+        self.assertTrue('Converted 0 pages, 0 failed, 3 unchanged' in 
+                        self.run_report(args))
+    
+    def test_schedule_largest_first(self):
+        filepaths = self.write_pages(3)
+        open(filepaths[1], 'a').write('more text' * 10)
+        missing = os.path.join(self.tempdir, 'missing')
+        self.assertEqual(wstomwconverter.schedule_largest_first(
+                [missing] + filepaths), 
+                [filepaths[1], filepaths[0], filepaths[2], missing])
+    
+    def test_timings(self):
+        filepaths = self.write_pages(3)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            wstomwconverter.Starter(['-j', '2', '-t', '2', '-f', filepaths[0], 
+                    '-f', filepaths[1], '-f', filepaths[2]]).start()
+            report = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue('Slowest files:' in report)
+        self.assertEqual(len([f for f in filepaths if f in report]), 2)
+    
+    def test_profile(self):
+        filepaths = self.write_pages(2)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            wstomwconverter.Starter(['-p', '--profile-slow', '0', 
+                    '--profile-dir', self.tempdir, 
+                    '-f', filepaths[0], '-f', filepaths[1]]).start()
+            report = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue('parse_bold' in report)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 
+                filepaths[0].strip(os.sep).replace(os.sep, '_') + '.prof')))
+    
+    def test_profile_dir_errors(self):
+        filepaths = self.write_pages(2)
+        missing = os.path.join(self.tempdir, 'missing')
+        self.assertRaises(SystemExit, self.run_starter, ['--profile-slow', 
+                '0', '--profile-dir', missing, '-f', filepaths[0]])
+        # a dump that fails is an error of its page only
+        options = wstomwconverter.make_option_parser().parse_args([
+                '--profile-slow', '0', '--profile-dir', missing])[0]
+        result = wstomwconverter.convert_file((filepaths[0], options))
+        self.assertTrue(result.error.startswith('IOError: '))
+        result = wstomwconverter.convert_content(filepaths[1], options, 
+                                                 '**x**\n')
+        self.assertTrue(result.error.startswith('IOError: '))
+    
+    def test_read_file_list(self):
+        stream = StringIO.StringIO('a\nbb\n\nccc')
+        self.assertEqual(list(wstomwconverter.read_file_list(stream)), 
+                ['a', 'bb', 'ccc'])
+
 if __name__ == '__main__':
     unittest.main()
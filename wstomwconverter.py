@@ -15,7 +15,597 @@
 import re
 import optparse
 import os.path
-import random
+import functools
+import sys
+import time
+import multiprocessing
+import multiprocessing.pool
+import fnmatch
+import heapq
+import hashlib
+import xml.sax.saxutils
+import itertools
+import cProfile
+import threading
+import json
+import signal
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+import collections
+import zipfile
+import tarfile
+import tempfile
+import zlib
+import stat
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+TABLE_HEADER = '{| style="border: 1px solid #c6c9ff; border-collapse: collapse;" cellspacing="0" cellpadding="10" border="1"\n'
+
+# cells are the text between two '||'; only needed for rows with '|||'
+TABLE_CELL_REGEXP = re.compile(r'(?s)(?<=\|\|)(.*?)(?=\|\|)')
+
+def find_tables(content):
+    '''Yield (start, end) of every wikispaces table in content.
+    
+    A table starts with '||' at the beginning of a line, and ends with the 
+    first '||' at the end of a line that is not followed by another row. 
+    This is what the pattern 
+    (?s)(?<=\n)([|][|].*?[|][|])(?=\n[^|]|\n[|][^|]) matches, found with 
+    str.find in time linear in the length of content.
+    '''
+    pos = 0
+    while True:
+        start = content.find('\n||', pos)
+        if start == -1:
+            return
+        start += 1
+        end = find_table_end(content, start + 2)
+        if end == -1:
+            # then no later table can be terminated either
+            return
+        yield start, end
+        pos = end
+
+def find_table_end(content, pos):
+    '''Return the end of the table whose last '||' is at or after pos, or -1.'''
+    while True:
+        i = content.find('||\n', pos)
+        if i == -1:
+            return -1
+        following = content[i + 3:i + 5]
+        if following[:1] not in ('|', '') or following[1:] not in ('|', ''):
+            return i + 2
+        pos = i + 1
+
+def generate_table(lines):
+    '''Yield the mediawiki table for the lines of one wikispaces table.
+    
+    lines is any iterable of the lines of the table, without line breaks, 
+    so a very large table can be streamed through without holding either 
+    the source or the output in memory. Only the current row is kept.
+    '''
+    yield TABLE_HEADER
+    row = []
+    lines = iter(lines)
+    line = next(lines, None)
+    while line is not None:
+        row.append(line)
+        next_line = next(lines, None)
+        if line.endswith('||') or next_line is None:
+            atable_row = '\n'.join(row)
+            if next_line is not None:
+                # rows are separated by '||\n'; the '||' is put back unless 
+                # the row already ends with one.
+                if atable_row[:-2].endswith('||'):
+                    atable_row = atable_row[:-2]
+            elif not atable_row.endswith('||'):
+                atable_row += '||'
+            yield convert_table_row(atable_row)
+            row = []
+        line = next_line
+    yield '|}'
+
+def convert_table_row(row):
+    '''Convert one '||'-delimited row of a wikispaces table.'''
+    if '|||' in row:
+        cells = TABLE_CELL_REGEXP.findall(row)
+    else:
+        cells = row.split('||')[1:-1]
+    output_row = ['|-\n']
+    for cell in cells:
+        if cell.startswith('='):
+            cell_type = '|align="center" |'
+            cell = cell[1:]
+        elif cell.startswith('>'):
+            cell_type = '|align="right" |'
+            cell = cell[1:]
+        elif cell.startswith('~'):
+            cell_type = '!'
+            cell = cell[1:]
+        else:
+            cell_type = '|'
+        output_row.append(cell_type)
+        output_row.append(cell)
+        output_row.append('\n')
+    return ''.join(output_row)
+
+def convert_table(atable):
+    '''Convert the source of one wikispaces table to a mediawiki table.'''
+    return ''.join(generate_table(atable.split('\n')))
+
+# Every place where one of the supported image attributes starts, with its 
+# value up to the closing quote. Values are only looked ahead at, not 
+# consumed, so an attribute mentioned inside another one's value is still 
+# found, like separate searches for each attribute would.
+IMAGE_ATTRIBUTE_REGEXP = re.compile(r'(width|height|align|caption|link)="(?=([^"\n]*)")')
+
+# converted image tags, by source tag; cleared when it reaches the limit. 
+# It is shared by all threads: each dict operation is atomic, and at worst 
+# two threads convert the same tag.
+IMAGE_TAG_CACHE = {}
+IMAGE_TAG_CACHE_LIMIT = 10000
+
+def parse_image_attributes(imagetag):
+    '''Return a dict of the attributes of an [[image:...]] tag, in one scan.
+    
+    For each attribute the first valid occurrence wins; width and height 
+    must be numbers.
+    '''
+    attributes = {}
+    for matchobj in IMAGE_ATTRIBUTE_REGEXP.finditer(imagetag):
+        name, value = matchobj.groups()
+        if name in attributes:
+            continue
+        if name in ('width', 'height') and not value.isdigit():
+            continue
+        attributes[name] = value
+    return attributes
+
+def convert_image_tag(imagetag):
+    '''Convert the opening part of a wikispaces [[image:...]] tag.
+    
+    imagetag is everything up to, but not including, the closing ']]'.
+    Returns the corresponding part of a mediawiki [[File:...]] tag.
+    Results are memoized, since the same image tag tends to be repeated 
+    throughout a wiki.
+    '''
+    converted = IMAGE_TAG_CACHE.get(imagetag)
+    if converted is not None:
+        return converted
+    
+    start = imagetag.index('[[image:') + len('[[image:')
+    image_filename = imagetag[start:].split(' ', 1)[0]
+    attributes = parse_image_attributes(imagetag)
+    
+    image_width = attributes.get('width')
+    image_height = attributes.get('height')
+    if image_width is not None and image_height is not None:
+        image_size = '|' + image_width + 'x' + image_height + 'px'
+    elif image_width is not None and image_height is None:
+        image_size = '|' + image_width + 'px'
+    elif image_width is None and image_height is not None:
+        image_size = '|' + 'x' + image_height + 'px'
+    else:
+        image_size = ''
+    
+    if 'align' in attributes:
+        image_align = '|' + attributes['align']
+    else:
+        image_align = ''
+    
+    if 'caption' in attributes:
+        image_comment = '|' + attributes['caption']
+    else:
+        image_comment = ''
+    
+    if 'link' in attributes:
+        image_link = '|' + 'link=' + attributes['link']
+    else:
+        image_link = ''
+    
+    # in MW, thumbs cannot be links, but otherwise, a thumb is the 
+    # best representation of a captioned wikispaces image.
+    if image_comment != '' and image_link == '':
+        image_thumb = '|thumb'
+    else:
+        image_thumb = ''
+    
+    converted = '[[File:' + image_filename + image_thumb + image_size + \
+                image_align + image_link + image_comment
+    if len(IMAGE_TAG_CACHE) >= IMAGE_TAG_CACHE_LIMIT:
+        IMAGE_TAG_CACHE.clear()
+    IMAGE_TAG_CACHE[imagetag] = converted
+    return converted
+
+# Verbatim sections are replaced by placeholders: their index, delimited by 
+# a sentinel character. The sentinel is the first of these characters that 
+# doesn't occur in the page, so placeholders can't collide with page text.
+SENTINEL_CHARS = ''.join([chr(i) for i in range(32) if chr(i) not in '\t\n\x0b\x0c\r'])
+
+def choose_sentinel(text):
+    '''Return a placeholder sentinel character that doesn't occur in text.'''
+    for char in SENTINEL_CHARS:
+        if char not in text:
+            return char
+    raise ValueError('Page contains every control character, '
+                     'no placeholder sentinel is available')
+
+def make_placeholder(sentinel, index):
+    return sentinel + str(index) + sentinel
+
+PLACEHOLDER_REGEXPS = {}
+
+def placeholder_regexp(sentinel):
+    '''The regexp matching placeholders made with sentinel.
+    
+    Group 1 of a match is the index of the placeholder.
+    '''
+    regexp = PLACEHOLDER_REGEXPS.get(sentinel)
+    if regexp is None:
+        regexp = re.compile(re.escape(sentinel) + r'(\d+)' + re.escape(sentinel))
+        PLACEHOLDER_REGEXPS[sentinel] = regexp
+    return regexp
+
+# Matchers for the rules whose plain regexps take quadratic time on pages
+# with many unclosed openers: the regexp scans the rest of the page from
+# every opener, only to fail each time. Each gives the same result as its
+# plain regexp in linear time, and has the sub method of a regexp.
+
+class GuardedRegexp:
+    '''The regexp opener + pattern, with a skip pattern for failed openers.
+
+    Where pattern fails to match after the opener, skip is tried instead. 
+    It must only consume text in which no match can start, i.e. the text 
+    that pattern scanned before failing. The skipped text is left as it 
+    is, and isn't scanned again. The opener is a plain string, kept out 
+    of the alternation so that re can still search for it quickly.
+    
+    Strings with at most guard_threshold openers are searched with the 
+    plain regexp, which is faster as long as few openers can fail.
+    '''
+    guard_threshold = 32
+    
+    def __init__(self, opener, pattern, skip, flags=0):
+        self.opener = opener
+        self.plain = re.compile(re.escape(opener) + pattern, flags)
+        self.regexp = re.compile('%s(?:%s|(?P<skip>%s))' % 
+                                 (re.escape(opener), pattern, skip), flags)
+
+    def sub(self, replacement, string):
+        if string.count(self.opener) <= self.guard_threshold:
+            return self.plain.sub(replacement, string)
+        if not callable(replacement):
+            replacement = template_function(replacement)
+        def replace(matchobj):
+            if matchobj.group('skip') is not None:
+                return matchobj.group(0)
+            return replacement(matchobj)
+        return self.regexp.sub(replace, string)
+
+TEMPLATE_GROUP_REGEXP = re.compile(r'\\(\d)')
+
+def template_function(template):
+    '''A function that expands template, whose groups must be like \\1, for a match.
+    
+    It is faster than matchobj.expand, which parses the template every time.
+    '''
+    parts = TEMPLATE_GROUP_REGEXP.split(template)
+    literals = parts[0::2]
+    groups = [int(group) for group in parts[1::2]]
+    def expand(matchobj):
+        out = [literals[0]]
+        for group, literal in zip(groups, literals[1:]):
+            out.append(matchobj.group(group))
+            out.append(literal)
+        return ''.join(out)
+    return expand
+
+class ClosedRegexp:
+    '''A regexp whose matches end with closer, and can match wherever a 
+    closer follows, e.g. (?s){{(.*?)}}.
+    
+    Only the string up to its last closer is searched, so an opener that 
+    is never closed doesn't make the regexp scan to the end of the string.
+    '''
+    def __init__(self, pattern, closer):
+        self.regexp = re.compile(pattern)
+        self.closer = closer
+    
+    def sub(self, replacement, string):
+        end = string.rfind(self.closer)
+        if end == -1:
+            return string
+        end += len(self.closer)
+        return self.regexp.sub(replacement, string[:end]) + string[end:]
+
+class SpanMatch:
+    '''A match of one of the matchers below.
+    
+    spans holds the (start, end) of the whole match and of each group, 
+    or None for a group that didn't participate in the match.
+    '''
+    def __init__(self, string, spans):
+        self.string = string
+        self.spans = spans
+    
+    def start(self):
+        return self.spans[0][0]
+    
+    def end(self):
+        return self.spans[0][1]
+    
+    def group(self, index=0):
+        span = self.spans[index]
+        if span is None:
+            return None
+        return self.string[span[0]:span[1]]
+
+class Matcher:
+    '''Base class of matchers that find their matches with str.find.
+    
+    Subclasses implement finditer(string).
+    '''
+    def sub(self, replacement, string):
+        '''Like re.sub, but replacement must be a function.'''
+        out = []
+        pos = 0
+        for matchobj in self.finditer(string):
+            out.append(string[pos:matchobj.start()])
+            out.append(replacement(matchobj))
+            pos = matchobj.end()
+        if not out:
+            return string
+        out.append(string[pos:])
+        return ''.join(out)
+
+FORMAT_REGEXP = re.compile(r' +format="')
+
+class BlockMatcher(Matcher):
+    '''Finds [[tag]]...[[tag]] blocks, e.g. code.
+    
+    Matches are those of (?s)\[\[tag( +format=".*?")?\]\](.*?)\[\[tag\]\], 
+    with the same groups. With newlines, a line break right before or 
+    after a block is part of its match, like with \\n? around the regexp.
+    '''
+    def __init__(self, tag, newlines=False):
+        self.opener = '[[' + tag
+        self.closer = '[[' + tag + ']]'
+        self.newlines = newlines
+    
+    def finditer(self, string):
+        opener, closer = self.opener, self.closer
+        last_closer = string.rfind(closer)
+        if last_closer == -1:
+            return
+        pos = last_end = 0
+        # the first '"]]' after the format of the last formatted opener; 
+        # openers are found in order, so it is only searched for again 
+        # once an opener is past it.
+        quote = None
+        while True:
+            start = string.find(opener, pos)
+            if start == -1:
+                return
+            header = start + len(opener)
+            body_start = -1
+            format = FORMAT_REGEXP.match(string, header)
+            if format is not None:
+                if quote is None or -1 < quote < format.end():
+                    quote = string.find('"]]', format.end())
+                if quote != -1:
+                    body_start = quote + 3
+            elif string.startswith(']]', header):
+                body_start = header + 2
+            if body_start == -1 or body_start > last_closer:
+                pos = start + 1
+                continue
+            body_end = string.find(closer, body_start)
+            end = body_end + len(closer)
+            if format is None:
+                format_span = None
+            else:
+                format_span = (header, body_start - 2)
+            if self.newlines:
+                if start > last_end and string[start - 1] == '\n':
+                    start -= 1
+                if string.startswith('\n', end):
+                    end += 1
+            yield SpanMatch(string, [(start, end), format_span, 
+                                     (body_start, body_end)])
+            pos = last_end = end
+
+class IncludeMatcher(Matcher):
+    '''Finds [[include page="..."]] tags.
+    
+    Matches are those of \[\[include page="([^"]*?)"[^\]]*?\]\], with 
+    the same groups.
+    '''
+    opener = '[[include page="'
+    
+    def finditer(self, string):
+        opener = self.opener
+        pos = 0
+        # a tag whose page name ends before horizon ends at the same 
+        # ']' as a tag that has failed there
+        horizon = 0
+        while True:
+            start = string.find(opener, pos)
+            if start == -1:
+                return
+            quote = string.find('"', start + len(opener))
+            if quote == -1:
+                return
+            if quote < horizon:
+                pos = start + 1
+                continue
+            close = string.find(']', quote + 1)
+            if close == -1:
+                return
+            if not string.startswith(']]', close):
+                horizon = close
+                pos = start + 1
+                continue
+            yield SpanMatch(string, [(start, close + 2), 
+                                     (start + len(opener), quote)])
+            pos = close + 2
+
+# Replacement functions of the regexp engine. Each takes the converter that 
+# is running the rule and the match object.
+
+def replace_verbatim(converter, matchobj):
+    verbatim = matchobj.group(0)
+    if converter.verbatim_sentinel in verbatim:
+        # this section encloses earlier ones, e.g. an escape around code
+        verbatim = converter.restore_placeholders(verbatim)
+    key = make_placeholder(converter.verbatim_sentinel, len(converter.verbatim))
+    converter.verbatim.append(verbatim)
+    return key
+
+def replace_file_link(converter, matchobj):
+    return '[' + converter.options.filelocation + matchobj.group(1) + ' ' + \
+                matchobj.group(2) + ']'
+
+def replace_naked_file_link(converter, matchobj):
+    return '[' + converter.options.filelocation + matchobj.group(1) + ' ' + \
+                matchobj.group(1) + ']'
+
+def replace_bold(converter, matchobj):
+    text = matchobj.group(0)
+    text = text.replace('**', "'''")
+    return text
+
+def replace_variable(converter, matchobj):
+    return converter.page_name
+
+def replace_include(converter, matchobj):
+    return '{{:' + matchobj.group(1) + '}}'
+
+def replace_image(converter, matchobj):
+    imagetag = matchobj.group(0)
+    if converter.options.debug:
+        print imagetag
+    return convert_image_tag(imagetag)
+
+def replace_indents(converter, matchobj):
+    indents = matchobj.group(0)
+    if converter.options.debug:
+        print indents
+    indents = indents.replace('>', ':')
+    return indents
+
+def replace_code(converter, matchobj):
+    code = matchobj.group(2)
+    if converter.options.debug:
+        print code
+    return '<pre>' + code + '</pre>'
+
+def replace_math(converter, matchobj):
+    code = matchobj.group(2)
+    if converter.options.debug:
+        print code
+    return '<math>' + code + '</math>'
+
+# The substitutions of the regexp engine: (stage, pattern, replacement).
+# The pattern is a regexp, or a matcher with the same sub method. The 
+# replacement is a re.sub template, or one of the functions above.
+# Rules of a stage are applied in the order they are listed here; the 
+# order of the stages themselves is given by REGEXP_STAGES.
+REGEXP_RULES = [
+    ('verbatim', BlockMatcher('code', newlines=True), replace_verbatim),
+    ('verbatim', r'``(.*)``', replace_verbatim),
+    ('verbatim', BlockMatcher('math'), replace_verbatim),
+    ('toc', r'\n?\[\[toc(\|flat)?\]\]', r''),
+    ('italics', r'(?<!http:)(?<!https:)(?<!ftp:)//', r"''"),
+    ('external_links', GuardedRegexp('[[', r'(https?://[^|\]]*)\|([^\]]*)\]\]', 
+            r'https?://[^|\]]*(?:\|[^\]]*)?'), r'[\1 \2]'),
+    ('external_links', GuardedRegexp('[[', r'(ftp://[^|\]]*)\|([^\]]*)\]\]', 
+            r'ftp://[^|\]]*(?:\|[^\]]*)?'), r'[\1 \2]'),
+    ('external_links', GuardedRegexp('[[', r'(https?://[^|\]]*)\]\]', 
+            r'https?://[^|\]]*'), r'\1'),
+    ('external_links', GuardedRegexp('[[', r'(ftp://[^|\]]*)\]\]', 
+            r'ftp://[^|\]]*'), r'\1'),
+    ('file_links', GuardedRegexp('[[', r'file:([^|\]]*)\|([^\]]*)\]\]', 
+            r'file:[^|\]]*(?:\|[^\]]*)?'), replace_file_link),
+    ('file_links', GuardedRegexp('[[', r'file:([^|\]]*)\]\]', 
+            r'file:[^|\]]*'), replace_naked_file_link),
+    ('media_links', GuardedRegexp('[[', r'file:([^|\]]*)\|([^\]]*)\]\]', 
+            r'file:[^|\]]*(?:\|[^\]]*)?'), r'[[Media:\1|\2]]'),
+    ('media_links', GuardedRegexp('[[', r'file:([^|\]]*)\]\]', 
+            r'file:[^|\]]*'), r'[[Media:\1]]'),
+    ('bold', r'(?<![\n\*])\*{2,}', replace_bold),
+    ('underline', r'(?s)__(.*?)__', r'<u>\1</u>'),
+    ('monospaced', ClosedRegexp(r'(?s){{(.*?)}}', '}}'), r'<tt>\1</tt>'),
+    ('variables', r'{\$page}', replace_variable),
+    ('includes', IncludeMatcher(), replace_include),
+    ('images', r'\[\[image:[^\]]+', replace_image),
+    ('indents', r'(?m)^>+', replace_indents),
+    ('code', BlockMatcher('code'), replace_code),
+    ('math', BlockMatcher('math'), replace_math),
+    ('escapes', r'``(.*)``', r'<nowiki>\1</nowiki>'),
+    ]
+
+# The stages of the regexp engine, i.e. the converter methods that 
+# run_regexps calls, in order.
+REGEXP_STAGES = [
+    'extract_verbatim', # take out code and escapes
+    'parse_toc',
+    'parse_italics',
+    'parse_external_links',
+    'parse_file_links',
+    'parse_bold',
+    'parse_underline',
+    'parse_monospaced',
+    'parse_variables',
+    'parse_includes',
+    'parse_images',
+    'parse_indents',
+    'parse_tables',
+    'restore_verbatim', # restore code and escapes
+    'parse_code',
+    'parse_math',
+    'parse_escapes',
+    ]
+
+# Strings that the rules of a stage need in the content to match at all: 
+# run_regexps skips a stage when none of its markers is in the content. 
+# The content is checked right before each stage, since an earlier stage 
+# can make a marker, e.g. the naked link [[http://x_]]_ leaves http://x__. 
+# Stages that aren't listed always run.
+STAGE_MARKERS = {
+    'extract_verbatim': ('[[code', '``', '[[math'),
+    'parse_toc': ('[[toc',),
+    'parse_italics': ('//',),
+    'parse_external_links': ('[[http', '[[ftp'),
+    'parse_file_links': ('[[file:',),
+    'parse_bold': ('**',),
+    'parse_underline': ('__',),
+    'parse_monospaced': ('{{',),
+    'parse_variables': ('{$page}',),
+    'parse_includes': (IncludeMatcher.opener,),
+    'parse_images': ('[[image:',),
+    'parse_indents': ('>',),
+    'parse_tables': ('\n||',),
+    'parse_code': ('[[code',),
+    'parse_math': ('[[math',),
+    'parse_escapes': ('``',),
+    }
+
+def compile_rules(rules):
+    '''Compile a rule table into a dict of stage -> [(regexp, replacement)].'''
+    compiled = {}
+    for stage, pattern, replacement in rules:
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+        compiled.setdefault(stage, []).append((pattern, replacement))
+    return compiled
+
+# compiled once, and shared by all converter instances
+COMPILED_RULES = compile_rules(REGEXP_RULES)
 
 class VersionInfo:
     '''Just a container for some information.'''
@@ -24,35 +614,1670 @@ class VersionInfo:
     url = 'http://wiki.df.dreamhosters.com/wiki/Wikispaces_to_Mediawiki_Converter'
     author='Daniel Folkinshteyn'
     
+class ConversionTimeout(Exception):
+    '''A page took longer to convert than the time budget in its options.'''
+    def __init__(self, stage, elapsed, budget):
+        Exception.__init__(self, 'over the time budget of %g seconds '
+                           'after %.2f seconds, in stage %s' % 
+                           (budget, elapsed, stage))
+        self.stage = stage
+        self.elapsed = elapsed
+        self.budget = budget
+
+class StageProfile:
+    '''Accumulates time, call count and bytes in/out per conversion stage.
+    
+    An instance can be used as the stage_hook of a converter, also of 
+    converters running in several threads. Profiles of several converters 
+    (or worker processes) can be combined with merge.
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.skipped = {}
+        self.lock = threading.Lock()
+    
+    def __call__(self, stage, elapsed, bytes_in, bytes_out):
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = [0.0, 0, 0, 0]
+            stats[0] += elapsed
+            stats[1] += 1
+            stats[2] += bytes_in
+            stats[3] += bytes_out
+    
+    def skip(self, stage):
+        '''Count a run of stage that was skipped, see STAGE_MARKERS.'''
+        with self.lock:
+            self.skipped[stage] = self.skipped.get(stage, 0) + 1
+    
+    def __getstate__(self):
+        # profiles are sent back from worker processes, and a lock can't 
+        # be pickled.
+        return (self.stages, self.skipped)
+    
+    def __setstate__(self, state):
+        self.stages, self.skipped = state
+        self.lock = threading.Lock()
+    
+    def merge(self, other):
+        for stage, other_stats in other.stages.items():
+            stats = self.stages.setdefault(stage, [0.0, 0, 0, 0])
+            for i, value in enumerate(other_stats):
+                stats[i] += value
+        for stage, skipped in other.skipped.items():
+            self.skipped[stage] = self.skipped.get(stage, 0) + skipped
+    
+    def report(self):
+        '''Return the profile as a table, in stage order.
+        
+        The skipped column counts the runs of each stage that were 
+        skipped, because the page had none of its markers.
+        '''
+        names = set(self.stages) | set(self.skipped)
+        stages = [stage for stage in REGEXP_STAGES if stage in names]
+        stages += sorted(stage for stage in names if stage not in stages)
+        lines = ['%-22s %10s %8s %12s %12s %8s' % 
+                 ('stage', 'seconds', 'calls', 'bytes in', 'bytes out', 
+                  'skipped')]
+        total = 0.0
+        total_calls = total_skipped = 0
+        for stage in stages:
+            seconds, calls, bytes_in, bytes_out = self.stages.get(
+                    stage, (0.0, 0, 0, 0))
+            skipped = self.skipped.get(stage, 0)
+            total += seconds
+            total_calls += calls
+            total_skipped += skipped
+            lines.append('%-22s %10.4f %8d %12d %12d %8d' % 
+                         (stage, seconds, calls, bytes_in, bytes_out, skipped))
+        lines.append('%-22s %10.4f %8d %12s %12s %8d' % 
+                     ('total', total, total_calls, '', '', total_skipped))
+        return '\n'.join(lines)
+
+class ConversionResult:
+    '''The outcome of converting one file in a batch.
+    
+    output is what happened to the output file, see write_output. When 
+    the batch goes to an XML dump, content is the converted page instead.
+    A page for the dump that was converted in chunks comes instead in a 
+    temporary file at content_path, for the batch to remove once the page 
+    is in the dump.
+    The pages of an archive (see convert_member) also have the name of 
+    their member, and its timestamp, and always come with their content.
+    '''
+    def __init__(self, filepath, error=None, elapsed=0.0, profile=None, 
+                 output=None, content=None, name=None, timestamp=None, 
+                 content_path=None):
+        self.filepath = filepath
+        self.error = error
+        self.elapsed = elapsed
+        self.profile = profile
+        self.output = output
+        self.content = content
+        self.name = name
+        self.timestamp = timestamp
+        self.content_path = content_path
+
+# the control characters that XML 1.0 doesn't allow
+XML_INVALID_REGEXP = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def xml_text(text):
+    '''Escape text for an XML element, dropping what XML can't contain.'''
+    if XML_INVALID_REGEXP.search(text):
+        text = XML_INVALID_REGEXP.sub('', text)
+    return xml.sax.saxutils.escape(text)
+
+class XmlDumpWriter:
+    '''Writes pages to a MediaWiki XML export file, one page at a time.
+    
+    The file can be loaded into a wiki with MediaWiki's 
+    maintenance/importDump.php. Only the page being written is in memory, 
+    or only a block of it when it is copied from a file.
+    
+    MediaWiki would make pages of the same title one page, so a page whose 
+    title the dump already has is refused.
+    '''
+    header = ('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" '
+              'version="0.10" xml:lang="en">\n')
+    page_template = '''  <page>
+    <title>%s</title>
+    <ns>0</ns>
+    <revision>
+      <timestamp>%s</timestamp>
+      <contributor>
+        <username>%s</username>
+      </contributor>
+      <comment>%s</comment>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text xml:space="preserve">'''
+    page_end = '''</text>
+    </revision>
+  </page>
+'''
+    footer = '</mediawiki>\n'
+    
+    def __init__(self, path):
+        self.stream = open(path, 'w')
+        self.stream.write(self.header)
+        # the titles of the pages so far, as MediaWiki compares them
+        self.titles = set()
+    
+    def write_page(self, title, text, timestamp=None):
+        '''Add a page; timestamp is in seconds since the epoch, the time 
+        of its only revision, and defaults to now. text is the page, or a 
+        file to copy it from.
+        
+        Raises ValueError if the dump already has a page of that title: 
+        MediaWiki doesn't tell '_' from ' ', nor the case of the first 
+        letter.
+        '''
+        key = title.replace('_', ' ').strip(' ')
+        key = key[:1].upper() + key[1:]
+        if key in self.titles:
+            raise ValueError('the XML dump already has a page titled %s' % 
+                             title)
+        self.titles.add(key)
+        if timestamp is None:
+            timestamp = time.time()
+        self.stream.write(self.page_template % (
+                xml_text(title), 
+                time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp)), 
+                xml_text(VersionInfo.name), 
+                xml_text('Converted from Wikispaces')))
+        if isinstance(text, basestring):
+            self.stream.write(xml_text(text))
+        else:
+            for block in iter(lambda: text.read(65536), ''):
+                self.stream.write(xml_text(block))
+        self.stream.write(self.page_end)
+    
+    def close(self):
+        self.stream.write(self.footer)
+        self.stream.close()
+
+def member_output_path(directory, name):
+    '''Where DirectoryWriter writes the converted page of the archive 
+    member name to.'''
+    return os.path.join(directory, *name.split('/')) + '_mediawiki'
+
+class DirectoryWriter:
+    '''Writes the converted pages of archives under a directory, each at 
+    the path of its member in the archive, as if it had been extracted.'''
+    def __init__(self, path):
+        self.path = path
+    
+    def write_page(self, name, text, timestamp=None):
+        '''Write the page of the member name, unless it is there already. 
+        Returns what happened to the output file, like write_output.'''
+        path = member_output_path(self.path, name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return write_if_changed(path, text)
+    
+    def close(self):
+        pass
+
+# the earliest time a zip archive can store
+ZIP_EPOCH = time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1))
+
+class ZipWriter:
+    '''Writes the converted pages of archives to a new zip archive, each 
+    as a '_mediawiki' member next to where its source member would be.'''
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, 
+                                       allowZip64=True)
+    
+    def write_page(self, name, text, timestamp=None):
+        '''Add the page of the member name; timestamp defaults to now. 
+        Returns 'new', as the archive is written from scratch.'''
+        if timestamp is None:
+            timestamp = time.time()
+        info = zipfile.ZipInfo(name + '_mediawiki', 
+                time.localtime(max(timestamp, ZIP_EPOCH))[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        self.archive.writestr(info, text)
+        return 'new'
+    
+    def close(self):
+        self.archive.close()
+
+def page_title(filepath):
+    '''The title of the page at filepath: its file name, as for {$page}.'''
+    return os.path.basename(filepath)
+
+def convert_file(task, pool=None):
+    '''Convert one file of a batch. task is a (filepath, options) tuple.
+    
+    This is a module-level function so that it can be run in the worker 
+    processes of a parallel batch. Any error is caught and returned in the 
+    ConversionResult, so that one bad page doesn't stop the whole batch.
+    
+    Given the pool of the batch, the file is instead cut into chunks of 
+    about options.split bytes, which the workers of the pool convert. A 
+    page that can't be cut without changing its output (see 
+    convert_chunks) is converted whole after all.
+    
+    With options.xml_dump, nothing is written: the converted page is 
+    returned in the result, for the batch to add to the dump, or in a 
+    temporary file if it was converted in chunks (see 
+    convert_file_for_dump).
+    '''
+    filepath, options = task
+    dump = getattr(options, 'xml_dump', None) is not None
+    profile = None
+    if options.profile:
+        profile = StageProfile()
+    error = None
+    output = None
+    content = None
+    content_path = None
+    start_time = time.time()
+    try:
+        chunk_size = None
+        imap = itertools.imap
+        if pool is not None:
+            chunk_size = options.split
+            window = 2 * options.jobs
+            imap = lambda function, tasks: imap_bounded(pool, function, tasks, 
+                                                        window)
+        elif (getattr(options, 'stream', None) is not None and 
+                os.path.getsize(filepath) > options.stream):
+            chunk_size = options.stream
+        if chunk_size is not None:
+            try:
+                if dump:
+                    content_path = convert_file_for_dump(filepath, chunk_size, 
+                                                         options, profile, 
+                                                         imap)
+                else:
+                    output = convert_file_in_chunks(filepath, chunk_size, 
+                                                    options, profile, imap)
+            except IrregularMarkup:
+                # a cut that may change the output: convert the page whole
+                chunk_size = None
+                if profile is not None:
+                    profile = StageProfile()
+        if chunk_size is None:
+            wp = WikispacesToMediawikiConverter(filepath, options)
+            wp.stage_hook = profile
+            wp.convert()
+            if dump:
+                content = wp.content
+            else:
+                output = wp.write_output()
+    except Exception as e:
+        error = '%s: %s' % (e.__class__.__name__, e)
+    elapsed = time.time() - start_time
+    
+    if (error is None and options.profile_slow is not None and 
+            elapsed >= options.profile_slow):
+        try:
+            dump_page_profile(filepath, options)
+        except Exception as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+            if content_path is not None:
+                os.remove(content_path)
+                content_path = None
+    return ConversionResult(filepath, error, elapsed, profile, output, 
+                            content, content_path=content_path)
+
+def convert_member(task):
+    '''Convert one page read from an archive. task is a (filepath, 
+    options, name, content, timestamp) tuple, as made by 
+    Starter.archive_tasks: name is the member's path in the archive, 
+    filepath its path under the archive's, for {$page} and the report.
+    
+    Like convert_file, this can run in a worker process, and any error is 
+    returned in the result. Nothing is written: the converted page is 
+    returned in the result, for the batch to write where it belongs.
+    
+    For an archive that couldn't be read, name is None, and content is 
+    the error, which the result just reports.
+    '''
+    filepath, options, name, content, timestamp = task
+    if name is None:
+        return ConversionResult(filepath, content)
+    result = convert_content(filepath, options, content)
+    result.name = name
+    result.timestamp = timestamp
+    return result
+
+def convert_content(filepath, options, source):
+    '''Convert the page at filepath, already read into source. Returns its 
+    ConversionResult, with the converted page as content.'''
+    profile = None
+    if options.profile:
+        profile = StageProfile()
+    error = None
+    content = None
+    start_time = time.time()
+    try:
+        wp = WikispacesToMediawikiConverter(filepath, options, source)
+        wp.stage_hook = profile
+        wp.convert()
+        content = wp.content
+    except Exception as e:
+        error = '%s: %s' % (e.__class__.__name__, e)
+    elapsed = time.time() - start_time
+    
+    if (error is None and options.profile_slow is not None and 
+            elapsed >= options.profile_slow):
+        try:
+            dump_page_profile(filepath, options, source)
+        except Exception as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+    return ConversionResult(filepath, error, elapsed, profile, 
+                            content=content)
+
+def read_file(task):
+    '''Read the page of a convert_file task ahead of its conversion, see 
+    Starter.pipeline.
+    
+    Returns a (filepath, options, content, error) tuple, error telling why 
+    the file couldn't be read. A file that convert_file would stream is 
+    left for it to read, with a content of None.
+    '''
+    filepath, options = task
+    try:
+        if (options.stream is not None and 
+                os.path.getsize(filepath) > options.stream):
+            return filepath, options, None, None
+        return filepath, options, read_page(filepath), None
+    except EnvironmentError as e:
+        return filepath, options, None, '%s: %s' % (e.__class__.__name__, e)
+
+def convert_read_file(task):
+    '''Convert a page read by read_file. Like convert_file, this can run 
+    in a worker process, and the converted page is returned in the result, 
+    for write_result to write.'''
+    filepath, options, content, error = task
+    if error is not None:
+        return ConversionResult(filepath, error)
+    if content is None:
+        return convert_file((filepath, options))
+    return convert_content(filepath, options, content)
+
+def write_result(result):
+    '''Write the page of a result of convert_read_file to its output file, 
+    unless convert_file already did. Sets what happened to the output file 
+    in result.output, or the error in result.error.'''
+    if result.error is None and result.output is None:
+        try:
+            result.output = write_if_changed(output_path(result.filepath), 
+                                             result.content)
+        except EnvironmentError as e:
+            result.error = '%s: %s' % (e.__class__.__name__, e)
+        result.content = None
+    return result
+
+def imap_bounded(pool, function, iterable, window):
+    '''Like pool.imap, but with at most window items of iterable handed to 
+    the pool and not yet collected.
+    
+    pool.imap takes items from iterable as fast as it can, so items that 
+    carry whole pages would all end up in memory at once.
+    '''
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+def read_page(filepath):
+    '''The content of the page at filepath.'''
+    # the 'rU' mode should convert any \r\n to plain \n.
+    source = open(filepath, 'rU')
+    try:
+        return source.read()
+    finally:
+        source.close()
+
+def output_path(filepath):
+    '''Where the converted page of filepath is written to.'''
+    return os.path.join(os.path.dirname(filepath), 
+                        os.path.basename(filepath) + '_mediawiki')
+
+def hash_file(path, digest):
+    '''Update the hashlib digest with the content of the file at path.'''
+    source = open(path, 'rb')
+    try:
+        for block in iter(lambda: source.read(65536), ''):
+            digest.update(block)
+    finally:
+        source.close()
+    return digest
+
+def replace_file(temp_path, path):
+    '''Move the file at temp_path to path, replacing any file there.'''
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # on Windows, a file can't be renamed over another one
+        if not os.path.exists(path):
+            raise
+        os.remove(path)
+        os.rename(temp_path, path)
+
+def write_if_changed(path, content):
+    '''Write content to the file at path, unless it has it already.
+    
+    The file is written to a temporary file first, which then replaces 
+    it, so the file at path is always complete. Returns 'new', 'updated' 
+    or 'unchanged', see write_output.
+    '''
+    if os.path.exists(path):
+        if (os.path.getsize(path) == len(content) and 
+                hash_file(path, hashlib.sha1()).digest() == 
+                hashlib.sha1(content).digest()):
+            return 'unchanged'
+        status = 'updated'
+    else:
+        status = 'new'
+    temp_path = path + '.part'
+    output = open(temp_path, 'w')
+    try:
+        try:
+            output.write(content)
+        finally:
+            output.close()
+        replace_file(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    return status
+
+def replace_output(temp_path, path):
+    '''Move a new output file at temp_path to path, unless the file at path 
+    has the same content already.
+    
+    Returns 'new', 'updated' or 'unchanged', see write_output.
+    '''
+    if not os.path.exists(path):
+        replace_file(temp_path, path)
+        return 'new'
+    if (os.path.getsize(temp_path) == os.path.getsize(path) and 
+            hash_file(temp_path, hashlib.sha1()).digest() == 
+            hash_file(path, hashlib.sha1()).digest()):
+        os.remove(temp_path)
+        return 'unchanged'
+    replace_file(temp_path, path)
+    return 'updated'
+
+def convert_file_in_chunks(filepath, chunk_size, options, profile=None, 
+                           imap=itertools.imap):
+    '''Convert the page at filepath in chunks of about chunk_size bytes.
+    
+    The page is read, converted and written out one chunk at a time (see 
+    iter_chunks), so memory use depends on the chunk size rather than on 
+    the size of the page, unless imap reads ahead, like the imap of a 
+    process pool that converts the chunks in parallel. The output is 
+    written to a temporary file, which replaces the output file once the 
+    whole page is converted, unless it is the same. Returns what happened 
+    to the output file, like write_output.
+    '''
+    temp_filepath = output_path(filepath) + '.part'
+    write_chunks(convert_file_chunks(filepath, chunk_size, options, profile, 
+                                     imap), 
+                 open(temp_filepath, 'w'), temp_filepath)
+    try:
+        return replace_output(temp_filepath, output_path(filepath))
+    except:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+
+def convert_file_for_dump(filepath, chunk_size, options, profile=None, 
+                          imap=itertools.imap):
+    '''Convert the page at filepath in chunks, like convert_file_in_chunks, 
+    but to a new temporary file next to the XML dump, which the batch then 
+    copies into the dump. Returns the path of the temporary file.'''
+    directory = os.path.dirname(os.path.abspath(options.xml_dump))
+    handle, temp_filepath = tempfile.mkstemp('.part', 'page', directory)
+    write_chunks(convert_file_chunks(filepath, chunk_size, options, profile, 
+                                     imap), 
+                 os.fdopen(handle, 'w'), temp_filepath)
+    return temp_filepath
+
+def write_chunks(chunks, output, temp_filepath):
+    '''Write the chunks to output, the file open at temp_filepath, and 
+    close it. If anything goes wrong, the file is removed.'''
+    try:
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            output.close()
+    except:
+        os.remove(temp_filepath)
+        raise
+
+def convert_file_chunks(filepath, chunk_size, options, profile=None, 
+                        imap=itertools.imap):
+    '''Yield the converted chunks of the page at filepath, see convert_chunks.'''
+    source = open(filepath, 'rU')
+    try:
+        for converted in convert_chunks(iter_chunks(source, chunk_size), 
+                                        filepath, options, profile, imap):
+            yield converted
+    finally:
+        source.close()
+
+def convert_chunks(chunks, filepath, options, profile=None, 
+                   imap=itertools.imap):
+    '''Convert the chunks of the page at filepath, as cut by iter_chunks.
+    
+    Yields the converted text of each chunk, in order. The chunks are 
+    converted by convert_chunk, mapped over them with imap. The stage 
+    profiles of the chunks are merged into profile.
+    
+    IrregularMarkup is raised at the first chunk that has markup which 
+    may pair up with the next chunks, e.g. an opener that isn't closed in 
+    it; the page must then be converted whole.
+    '''
+    tasks = ((filepath, options, chunk, i == 0) 
+             for i, chunk in enumerate(chunks))
+    for converted, chunk_profile, regular in imap(convert_chunk, tasks):
+        if not regular:
+            raise IrregularMarkup('a chunk of %s can\'t be cut off' % filepath)
+        if profile is not None and chunk_profile is not None:
+            profile.merge(chunk_profile)
+        yield converted
+
+def convert_chunk(task):
+    '''Convert one chunk of a page. task is a (filepath, options, chunk, 
+    first) tuple, first telling whether the chunk starts the page.
+    
+    Returns the converted chunk, its stage profile if options.profile is 
+    set, and whether the chunk is regular: whether a strict 
+    SinglePassEngine takes it, which it doesn't if a construct is left 
+    open, so that it converts the same within the whole page. Like convert_file, this can run in a 
+    worker process.
+    '''
+    filepath, options, chunk, first = task
+    if not first:
+        # the chunk starts with a blank line; the line break before 
+        # it is the one a [[toc]] right after it leaves behind.
+        chunk = '\n' + chunk
+    wp = WikispacesToMediawikiConverter(filepath, options, chunk)
+    singlepass = getattr(options, 'engine', 'regexp') == 'singlepass'
+    regular = True
+    if not singlepass:
+        try:
+            SinglePassEngine(options, wp.page_name, strict=True).parse(
+                    extend_edges(wp.content)[0])
+        except IrregularMarkup:
+            regular = False
+    if getattr(options, 'profile', False):
+        wp.stage_hook = StageProfile()
+    wp.convert()
+    if singlepass:
+        # the conversion was that check already
+        regular = not wp.singlepass_fallback
+    if first:
+        return wp.content, wp.stage_hook, regular
+    return wp.content[1:], wp.stage_hook, regular
+
+def dump_page_profile(filepath, options, content=None):
+    '''Convert filepath (or content, if given) again under cProfile, and 
+    dump the stats.
+    
+    The stats go to a '.prof' file in options.profile_dir, named after 
+    the page's path, for use with the pstats module.
+    '''
+    wp = WikispacesToMediawikiConverter(filepath, options, content)
+    stats_name = filepath.strip(os.sep).replace(os.sep, '_') + '.prof'
+    profiler = cProfile.Profile()
+    profiler.runcall(wp.convert)
+    profiler.dump_stats(os.path.join(options.profile_dir, stats_name))
+
+def schedule_largest_first(filepaths):
+    '''Sort filepaths by file size, largest first.
+    
+    Handing the largest pages to the workers first (LPT scheduling) keeps 
+    a few giant pages from being the tail of a parallel batch. Files that 
+    can't be stat'ed go last; files of equal size keep their order.
+    '''
+    return sorted(filepaths, key=file_size, reverse=True)
+
+def peak_memory():
+    '''The peak resident set size of this process, and of the largest of 
+    its child processes that have ended, in bytes; or None where it isn't 
+    known.'''
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes, except on Mac OS X where it's in bytes
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit, 
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+def file_size(filepath):
+    '''The size of the file at filepath, or -1 if it can't be stat'ed.'''
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return -1
+
+# The version of what the converter writes. Bump it with any change that 
+# changes the output of some page, so that the pages of a --manifest or a 
+# --journal are converted again instead of skipped.
+OUTPUT_FORMAT = 2
+
+def page_digest(filepath, options, content=None):
+    '''The hash of the page at filepath for the manifest, or None if the 
+    file can't be read. For a page already read, its content is given 
+    instead.
+    
+    Besides the content of the page, it covers the options that change 
+    how a page converts, and OUTPUT_FORMAT.
+    '''
+    digest = hashlib.sha1(repr((OUTPUT_FORMAT, options.filelocation, 
+                                options.usemedia, options.engine)))
+    if content is not None:
+        digest.update(content)
+        return digest.hexdigest()
+    try:
+        return hash_file(filepath, digest).hexdigest()
+    except IOError:
+        return None
+
+def load_manifest(path):
+    '''Read the manifest at path: a dict of file path -> page_digest.
+    
+    A manifest that doesn't exist yet is empty.
+    '''
+    try:
+        manifest_file = open(path)
+    except IOError:
+        return {}
+    try:
+        manifest = json.load(manifest_file)
+    finally:
+        manifest_file.close()
+    return dict((key.encode('latin-1'), digest) 
+                for key, digest in manifest.items())
+
+def save_manifest(path, manifest):
+    '''Write the manifest to path, replacing the old one only once it is 
+    completely written.'''
+    temp_path = path + '.part'
+    manifest_file = open(temp_path, 'w')
+    try:
+        # paths are bytes in any encoding, which latin-1 keeps as they are
+        json.dump(manifest, manifest_file, indent=0, sort_keys=True, 
+                  encoding='latin-1')
+    finally:
+        manifest_file.close()
+    replace_file(temp_path, path)
+
+class Journal:
+    '''An append-only record of the pages a batch has converted, so that 
+    a batch that stops half-way can be resumed.
+    
+    Each line is a JSON list of the absolute path of a page, its 
+    page_digest and the path of its output. Lines are written FLUSH_SIZE 
+    at a time, or when the last write is FLUSH_INTERVAL seconds old, and 
+    synced to disk: a crash loses the last few entries at most, whose 
+    pages are then just converted again. Only one process writes to it, 
+    so the pages that workers finish out of order can't mix up entries.
+    '''
+    FLUSH_SIZE = 100
+    FLUSH_INTERVAL = 5.0
+    
+    def __init__(self, path, resume=False):
+        '''Start a new journal at path, or with resume, read the one there 
+        and carry on writing to it.'''
+        self.entries = {}
+        cut = False
+        if resume and os.path.exists(path):
+            self.entries = load_journal(path)
+            stream = open(path, 'rb')
+            try:
+                stream.seek(0, os.SEEK_END)
+                if stream.tell() > 0:
+                    stream.seek(-1, os.SEEK_END)
+                    cut = stream.read(1) != '\n'
+            finally:
+                stream.close()
+        self.stream = open(path, 'ab' if resume else 'wb')
+        if cut:
+            # end the line cut short by a crash, which load_journal skipped
+            self.stream.write('\n')
+        self.pending = []
+        self.flush_time = time.time()
+    
+    def get(self, filepath):
+        '''The digest of the page at filepath, if the journal has it.'''
+        return self.entries.get(os.path.abspath(filepath))
+    
+    def record(self, filepath, digest, output):
+        '''Add the page at filepath, converted to output.'''
+        self.pending.append(json.dumps([os.path.abspath(filepath), digest, 
+                                        output], encoding='latin-1'))
+        if (len(self.pending) >= self.FLUSH_SIZE or 
+                time.time() - self.flush_time >= self.FLUSH_INTERVAL):
+            self.flush()
+    
+    def flush(self):
+        if self.pending:
+            self.stream.write('\n'.join(self.pending) + '\n')
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+            self.pending = []
+        self.flush_time = time.time()
+    
+    def close(self):
+        self.flush()
+        self.stream.close()
+
+def load_journal(path):
+    '''Read the journal at path: a dict of page path -> page_digest.
+    
+    A journal that doesn't exist yet is empty, and a last line cut short 
+    by a crash is skipped.
+    '''
+    entries = {}
+    try:
+        stream = open(path, 'rb')
+    except IOError:
+        return entries
+    try:
+        for line in stream:
+            try:
+                filepath, digest, output = json.loads(line)
+            except ValueError:
+                continue
+            entries[filepath.encode('latin-1')] = digest
+    finally:
+        stream.close()
+    return entries
+
+def walk_files(top, include=None, exclude=None):
+    '''Yield the files under directory top, recursively, in sorted order.
+    
+    include and exclude are lists of glob patterns, matched against the 
+    path relative to top. A file is yielded if it matches any include 
+    pattern (or there are none), and no exclude pattern. Converter output 
+    files ('*_mediawiki'), and those being written ('*_mediawiki.part') 
+    are always skipped.
+    '''
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            if is_page(os.path.relpath(filepath, top), include, exclude):
+                yield filepath
+
+def is_page(relpath, include=None, exclude=None):
+    '''Whether to convert the file at relpath, see walk_files.'''
+    if relpath.endswith('_mediawiki') or relpath.endswith('_mediawiki.part'):
+        return False
+    if include and not [p for p in include if fnmatch.fnmatch(relpath, p)]:
+        return False
+    if exclude and [p for p in exclude if fnmatch.fnmatch(relpath, p)]:
+        return False
+    return True
+
+def archive_pages(path, include=None, exclude=None):
+    '''Yield (name, content, timestamp) for each page in the zip or tar 
+    archive at path, in the order they are stored in.
+    
+    The pages are the files of the archive, picked like walk_files does 
+    with name as the relative path. Members are read one at a time, and a 
+    tar archive (compressed or not) is read as a stream, so the archive 
+    is never extracted, to disk or to memory. Names are made safe to 
+    extract, like zipfile does: without '..' parts nor a leading '/'.
+    '''
+    for name, content, timestamp in archive_members(path):
+        name = '/'.join(part for part in name.replace('\\', '/').split('/') 
+                        if part not in ('', '.', '..'))
+        if name and is_page(name, include, exclude):
+            yield name, content, timestamp
+
+# what reading a missing, truncated or corrupt archive can raise
+ARCHIVE_ERRORS = (EnvironmentError, tarfile.TarError, zipfile.BadZipfile, 
+                  zlib.error)
+
+def archive_members(path):
+    '''Yield (name, content, timestamp) for each file in the zip or tar 
+    archive at path, timestamp in seconds since the epoch.'''
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        try:
+            for info in archive.infolist():
+                name = info.filename
+                if isinstance(name, unicode):
+                    # a name flagged as UTF-8; paths are bytes everywhere else
+                    name = name.encode('utf-8')
+                if not name.endswith('/'):
+                    yield (name, archive.read(info), 
+                           time.mktime(info.date_time + (0, 0, -1)))
+        finally:
+            archive.close()
+    else:
+        archive = tarfile.open(path, 'r|*')
+        try:
+            for info in archive:
+                if info.isfile():
+                    yield (info.name, archive.extractfile(info).read(), 
+                           info.mtime)
+        finally:
+            archive.close()
+
+def read_file_list(stream, separator='\n'):
+    '''Yield the filepaths in stream, separated by separator.
+    
+    The stream is read in blocks, so that a long list from a pipe can be 
+    consumed while it is still being produced. Empty entries are skipped.
+    '''
+    pending = ''
+    while True:
+        block = stream.read(65536)
+        if not block:
+            break
+        entries = (pending + block).split(separator)
+        pending = entries.pop()
+        for entry in entries:
+            if entry:
+                yield entry
+    if pending:
+        yield pending
+
+# the opening tags of code and math blocks, as BlockMatcher finds them
+BLOCK_OPENER_REGEXPS = {
+    'code': re.compile(r'\[\[code(?= +format="|\]\])'),
+    'math': re.compile(r'\[\[math(?= +format="|\]\])'),
+    }
+ESCAPE_REGEXP = re.compile(r'``.*``')
+LINK_BRACKETS_REGEXP = re.compile(r'\[\[|\]\]')
+
+class BlockTracker:
+    '''Follows the constructs that are still open after each line of a page.
+    
+    A page can be cut after a line where nothing is open, and its pieces 
+    converted separately, see iter_chunks. The tracker errs on the side of 
+    open: where it can't tell, the page is just cut later. It follows 
+    constructs the way the regexp engine sees them; markup garbled enough 
+    to make the two engines disagree can still be cut where the output 
+    of the whole page would differ, which convert_chunk checks for.
+    '''
+    def __init__(self):
+        # the tags of the blocks we are in: code, or math outside of code
+        self.blocks = set()
+        # the number of '[[' that have no ']]' yet: a link that is 
+        # converted takes its ']]' away from an image tag around it.
+        self.open_links = 0
+        # whether the last '{{' has no '}}' after it yet
+        self.open_monospaced = False
+        self.underlines = 0
+        self.open_table = False
+        # whether the last line ended a row of the open table
+        self.row_end = False
+        # whether the current line is partly in a block
+        self.in_block = False
+    
+    def feed(self, text):
+        '''Follow the next lines of the page, with their line breaks.
+        
+        Only the lines that are partly in a block are followed one by one.
+        '''
+        pos = 0
+        # the next opener of each kind, searched for again once passed
+        openers = {}
+        def next_opener(tag):
+            matchobj = openers.get(tag, False)
+            if matchobj is False or (matchobj is not None and 
+                                     matchobj.start() < pos):
+                matchobj = BLOCK_OPENER_REGEXPS[tag].search(text, pos)
+                openers[tag] = matchobj
+            return matchobj
+        while pos < len(text):
+            if self.blocks:
+                # skip to the line where the block may end
+                if 'code' in self.blocks:
+                    stop = text.find('[[code]]', pos)
+                else:
+                    stop = text.find('[[math]]', pos)
+                    code = next_opener('code')
+                    if code is not None and (stop == -1 or 
+                                             code.start() < stop):
+                        stop = code.start()
+                if stop == -1:
+                    self.row_end = False
+                    return
+                pos = text.rfind('\n', pos, stop) + 1 or pos
+            else:
+                matchobj = next_opener('code')
+                math = next_opener('math')
+                if matchobj is None or (math is not None and 
+                                        math.start() < matchobj.start()):
+                    matchobj = math
+                if matchobj is None:
+                    self.feed_plain(text[pos:])
+                    return
+                stop = text.rfind('\n', pos, matchobj.start()) + 1
+                if stop > pos:
+                    self.feed_plain(text[pos:stop])
+                    pos = stop
+            end = text.find('\n', pos) + 1
+            if end == 0:
+                end = len(text)
+            self.feed_line(text[pos:end])
+            pos = end
+    
+    def feed_plain(self, text):
+        '''Follow lines that are not in any block.'''
+        self.feed_outside_code(text)
+        if '||' in text or self.open_table:
+            self.feed_tables(text)
+        else:
+            self.row_end = False
+    
+    def feed_tables(self, text):
+        '''Follow the tables in lines that are not in any block.
+        
+        This is find_tables, carried over from the lines before.
+        '''
+        if self.row_end and not text.startswith('||'):
+            self.open_table = False
+        text = '\n' + text
+        pos = 0
+        while True:
+            if not self.open_table:
+                start = text.find('\n||', pos)
+                if start == -1:
+                    break
+                self.open_table = True
+                pos = start + 3
+            end = find_table_end(text, pos)
+            if end == -1:
+                break
+            self.open_table = False
+            pos = end
+        # a last row that the next line may end the table after
+        self.row_end = (self.open_table and text.endswith('||\n') and 
+                        len(text) - 3 >= pos)
+    
+    def feed_line(self, line):
+        '''Follow one line that is partly in a block.'''
+        self.in_block = bool(self.blocks)
+        is_row = not self.blocks and line.startswith('||')
+        # code blocks are taken out first, then escapes, then math blocks
+        self.feed_blocks(line, 'code', self.feed_outside_code)
+        if self.in_block:
+            # the block is a placeholder when tables are converted, so 
+            # no row ends here.
+            if is_row:
+                self.open_table = True
+            self.row_end = False
+        else:
+            self.feed_tables(line)
+    
+    def feed_blocks(self, text, tag, feed):
+        '''Follow text through [[tag]] blocks, feeding the text outside 
+        of them to feed.'''
+        opener_regexp = BLOCK_OPENER_REGEXPS[tag]
+        closer = '[[' + tag + ']]'
+        pos = 0
+        while True:
+            if tag in self.blocks:
+                end = text.find(closer, pos)
+                if end == -1:
+                    return
+                pos = end + len(closer)
+                self.blocks.remove(tag)
+                continue
+            matchobj = opener_regexp.search(text, pos)
+            if matchobj is None:
+                feed(text[pos:])
+                return
+            feed(text[pos:matchobj.start()])
+            self.blocks.add(tag)
+            self.in_block = True
+            pos = matchobj.end()
+    
+    def feed_outside_code(self, text):
+        if '``' in text:
+            text = ESCAPE_REGEXP.sub('', text)
+        self.feed_blocks(text, 'math', self.feed_text)
+    
+    def feed_text(self, text):
+        '''Follow text outside of code and math blocks and escapes.'''
+        self.underlines += text.count('__')
+        if '[[' in text or self.open_links:
+            for bracket in LINK_BRACKETS_REGEXP.findall(text):
+                if bracket == '[[':
+                    self.open_links += 1
+                elif self.open_links:
+                    self.open_links -= 1
+        if text.rfind('{{') > text.rfind('}}'):
+            self.open_monospaced = True
+        elif '}}' in text:
+            self.open_monospaced = False
+    
+    def is_closed(self):
+        '''Whether nothing is open after the lines so far.'''
+        return (not self.blocks and not self.open_links and 
+                not self.open_monospaced and self.underlines % 2 == 0 and 
+                not self.open_table)
+
+def iter_chunks(lines, chunk_size):
+    '''Yield the text of lines in chunks of at least chunk_size bytes.
+    
+    lines is any iterable of the lines of a page, such as a file opened 
+    in 'rU' mode. Chunks are cut right before a blank line after which no 
+    code or math block, table, link, underline or monospaced text is open, 
+    so each chunk converts to the same text as it does within the whole 
+    page. The blank line starts the next chunk, for the constructs that 
+    take the line break before them, like [[toc]]. Only one chunk is held 
+    in memory at a time.
+    '''
+    tracker = BlockTracker()
+    chunk = []
+    size = 0
+    # the lines of chunk the tracker has followed; it only needs to catch 
+    # up once the chunk is big enough to be cut.
+    fed = 0
+    for line in lines:
+        if line == '\n' and size >= chunk_size:
+            chunk.append(line)
+            tracker.feed(''.join(chunk[fed:]))
+            chunk.pop()
+            if chunk and tracker.is_closed():
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+            fed = len(chunk) + 1
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield ''.join(chunk)
+
+# the number of files a batch looks ahead at, to schedule and split them
+BATCH_SIZE = 10000
+
+def make_option_parser():
+    '''The parser of the command line options, with their defaults.'''
+    parser = optparse.OptionParser(
+                    version=VersionInfo.name + " version " +VersionInfo.version + "\nProject homepage: " + VersionInfo.url, 
+                    description="This script can convert a Wikispaces-style source page into a MediaWiki-style source page. For a more detailed usage manual, see the project homepage: " + VersionInfo.url, 
+                    formatter=optparse.TitledHelpFormatter(),
+                    usage="%prog [options]\n or \n  python %prog [options]")
+    parser.add_option("-d", "--debug", action="store_true", dest="debug", help="debug mode (print some extra debug output). [default: %default]")
+    parser.add_option("-f", "--file", action="append", dest="file", help="Specify filepath to convert. For multiple files use this option multiple times. [default: %default]")
+    parser.add_option("-r", "--recursive", action="append", dest="recursive", metavar="DIR", help="Convert all files in directory DIR and its subdirectories. For multiple directories use this option multiple times. [default: %default]")
+    parser.add_option("-a", "--archive", action="append", dest="archive", metavar="ARCHIVE", help="Convert all files in ARCHIVE, a zip or tar archive such as a Wikispaces export, without extracting it. The pages go to --output-dir, --output-archive or --xml-dump. For multiple archives use this option multiple times. [default: %default]")
+    parser.add_option("-i", "--include", action="append", dest="include", metavar="GLOB", help="With -r or --archive, only convert files whose path relative to DIR or in ARCHIVE matches GLOB. May be used multiple times. [default: %default]")
+    parser.add_option("-x", "--exclude", action="append", dest="exclude", metavar="GLOB", help="With -r or --archive, skip files whose path relative to DIR or in ARCHIVE matches GLOB. May be used multiple times. [default: %default]")
+    parser.add_option("-F", "--filelist", action="store", dest="filelist", metavar="LISTFILE", help="Also convert the files listed in LISTFILE, one per line. Use '-' to read the list from stdin. [default: %default]")
+    parser.add_option("-0", "--null", action="store_true", dest="null", help="Entries in the --filelist are separated by NUL characters instead of newlines, as produced by 'find -print0'. [default: %default]")
+    parser.add_option("-l", "--filelocation", action="store", dest="filelocation", help="Specify the full URL of directory where files are hosted. This will be used to convert [[file:...]] links to external links. [default: %default]")
+    parser.add_option("-m", "--usemedia", action="store_true", dest="usemedia", help="Use the [[Media:...]] tag instead of external links to convert [[file:...]] links. Note that by default Mediawiki doesn't allow uploads of non-image files. [default: %default]")
+    parser.add_option("-e", "--engine", action="store", type="choice", choices=["regexp", "singlepass"], dest="engine", help="Conversion engine: 'regexp' runs one regexp pass per construct, 'singlepass' converts each page in a single scan. [default: %default]")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", help="Number of processes to convert files with in parallel. [default: %default]")
+    parser.add_option("--io-threads", action="store", type="int", dest="io_threads", metavar="N", help="Read and write files with N threads, ahead of and behind their conversion, for files on storage with a high latency. 0 reads and writes each file where it is converted. [default: %default]")
+    parser.add_option("--split", action="store", type="int", dest="split", metavar="BYTES", help="With --jobs, cut files larger than BYTES into chunks of about BYTES at blank lines, and convert the chunks of each such file in parallel. [default: %default]")
+    parser.add_option("-s", "--schedule", action="store", type="choice", choices=["largest", "input"], dest="schedule", help="Order to hand files to the --jobs processes in: 'largest' file first, looking ahead 10000 files at most, or 'input' order. [default: %default]")
+    parser.add_option("-t", "--timings", action="store", type="int", dest="timings", metavar="N", help="At the end of a batch, print the conversion time of the N slowest files. [default: %default]")
+    parser.add_option("--time-budget", action="store", type="float", dest="time_budget", metavar="SECONDS", help="Give up on a page that takes longer than SECONDS to convert, and report it as failed. [default: %default]")
+    parser.add_option("--stream", action="store", type="int", dest="stream", metavar="BYTES", help="Convert files larger than BYTES in chunks of about BYTES, cut at blank lines, so that the whole file is never in memory. [default: %default]")
+    parser.add_option("-p", "--profile", action="store_true", dest="profile", help="At the end of a batch, print the time, number of calls and bytes in/out of each conversion stage. [default: %default]")
+    parser.add_option("--profile-slow", action="store", type="float", dest="profile_slow", metavar="SECONDS", help="Dump cProfile stats of each page that takes at least SECONDS to convert into --profile-dir. [default: %default]")
+    parser.add_option("--profile-dir", action="store", dest="profile_dir", metavar="DIR", help="Directory to dump the --profile-slow stats in. [default: %default]")
+    parser.add_option("--serve", action="store", dest="serve", metavar="ADDRESS", help="Instead of converting files, serve conversions over HTTP on ADDRESS, which is [HOST:]PORT or unix:PATH. See ConversionRequestHandler for the endpoints. [default: %default]")
+    parser.add_option("--xml-dump", action="store", dest="xml_dump", metavar="FILE", help="Write all the converted pages to FILE, a MediaWiki XML dump that maintenance/importDump.php can import, instead of to '_mediawiki' files. Page titles are the file names. [default: %default]")
+    parser.add_option("--output-dir", action="store", dest="output_dir", metavar="DIR", help="Write the converted pages of --archive to '_mediawiki' files under DIR, at their path in the archive. [default: %default]")
+    parser.add_option("--output-archive", action="store", dest="output_archive", metavar="FILE", help="Write the converted pages of --archive to FILE, a new zip archive, as '_mediawiki' files at their path in the archive. [default: %default]")
+    parser.add_option("--manifest", action="store", dest="manifest", metavar="FILE", help="Record the hash of each converted file in FILE, and skip the files whose content and conversion options haven't changed since, and whose output still exists. [default: %default]")
+    parser.add_option("--journal", action="store", dest="journal", metavar="FILE", help="Append each converted page to FILE as it is done, with its hash and output path. [default: %default]")
+    parser.add_option("--resume", action="store_true", dest="resume", help="Carry on with the batch that the --journal was written by: skip the pages it records, unless they or their output changed since. [default: %default]")
+    parser.add_option("-q", "--quiet", action="store_true", dest="quiet", help="Don't print the summary at the end of a batch. [default: %default]")
+    
+    parser.set_defaults(debug=False, 
+                        file=[],
+                        recursive=[],
+                        archive=[],
+                        include=[],
+                        exclude=[],
+                        filelist=None,
+                        null=False,
+                        filelocation="http://localhost/files/",
+                        usemedia=False,
+                        engine="regexp",
+                        jobs=1,
+                        io_threads=0,
+                        split=None,
+                        schedule="largest",
+                        timings=0,
+                        time_budget=None,
+                        stream=None,
+                        profile=False,
+                        profile_slow=None,
+                        profile_dir=".",
+                        serve=None,
+                        manifest=None,
+                        journal=None,
+                        resume=False,
+                        xml_dump=None,
+                        output_dir=None,
+                        output_archive=None,
+                        quiet=False)
+    return parser
+
+def default_options():
+    '''The options of a converter, as if no command line options were given.
+    
+    Each call returns new options, copied from DEFAULT_OPTION_VALUES 
+    rather than made by a new option parser; the lists of the options 
+    that can be given several times are copied too.
+    '''
+    options = optparse.Values(DEFAULT_OPTION_VALUES)
+    for name in DEFAULT_LIST_OPTIONS:
+        setattr(options, name, list(DEFAULT_OPTION_VALUES[name]))
+    return options
+
+# the values of default_options; making the parser takes much longer than 
+# converting a small page
+DEFAULT_OPTION_VALUES = vars(make_option_parser().get_default_values())
+DEFAULT_LIST_OPTIONS = [name for name, value in DEFAULT_OPTION_VALUES.items() 
+                        if isinstance(value, list)]
+
 class Starter:
     '''Grabs cli options, and runs the converter on specified files.'''
-    def __init__(self):
-        self.parse_options()
+    def __init__(self, args=None):
+        self.parse_options(args)
+        # the --manifest and --journal of the batch, see open_records
+        self.manifest = None
+        self.journal = None
+        # the digests of the files in flight, by path
+        self.digests = {}
+        self.skipped = 0
     
     def start(self):
+        '''Convert all the files. Returns the number of files that failed.
+        
+        The batch is a pipeline of generators, from the listing of the files 
+        to the report, so its memory use doesn't grow with the number of 
+        files: files are taken in batches of BATCH_SIZE at most, see 
+        file_results, and only a few pages are in flight at a time. The 
+        summary reports the peak memory use.
+        
+        With --jobs N, the files are converted by a pool of N processes, 
+        largest file of each batch first unless --schedule=input is given. 
+        Results are collected in the order the files were dispatched (with 
+        --split, the files that are cut up come last in their batch), so 
+        the report is the same for any number of jobs.
+        
+        With --io-threads, files are read and written by threads while 
+        others are converted, see pipeline.
+        
+        With --manifest, files that haven't changed since they were last 
+        converted with the same options are skipped, see read_changed.
+        
+        With --journal, each page is recorded as it is done, and with 
+        --resume, the pages of the journal are skipped like the ones of 
+        the manifest, see Journal.
+        
+        With --xml-dump, the converted pages are written to one MediaWiki 
+        XML dump, as they come in, instead of to '_mediawiki' files.
+        
+        The pages of --archive archives are converted after the files, 
+        read and handed to the processes one at a time, see archive_tasks. 
+        They go to the XML dump, or else to --output-dir or 
+        --output-archive.
+        
+        With --serve, serves conversions until interrupted instead.
+        '''
+        if self.options.serve:
+            return self.serve()
+        start_time = time.time()
+        self.open_records()
+        pool = None
+        io_pool = None
+        try:
+            if self.options.jobs > 1:
+                pool = multiprocessing.Pool(self.options.jobs)
+            if self.options.io_threads > 0:
+                io_pool = multiprocessing.pool.ThreadPool(
+                        self.options.io_threads)
+            self.write_results(self.results(pool, io_pool))
+        except:
+            # an error or Ctrl-C: don't wait for the tasks still queued
+            for each in (pool, io_pool):
+                if each is not None:
+                    each.terminate()
+            raise
+        else:
+            for each in (pool, io_pool):
+                if each is not None:
+                    each.close()
+                    each.join()
+        finally:
+            self.close_records()
+        self.print_summary(time.time() - start_time, pool is not None)
+        return self.failed
+    
+    def open_records(self):
+        '''Load the --manifest and open the --journal, if they are given, 
+        and start the counts of the batch from zero.'''
+        self.digests = {}
+        self.skipped = 0
+        self.converted = 0
+        self.failed = 0
+        self.outputs = {'new': 0, 'updated': 0, 'unchanged': 0}
+        self.slowest = []
+        self.profile = StageProfile()
+        if self.options.manifest is not None:
+            self.manifest = load_manifest(self.options.manifest)
+        if self.options.journal is not None:
+            self.journal = Journal(self.options.journal, self.options.resume)
+    
+    def close_records(self):
+        '''Save the manifest and close the journal, if there are any.'''
+        if self.manifest is not None:
+            save_manifest(self.options.manifest, self.manifest)
+        if self.journal is not None:
+            self.journal.close()
+    
+    def results(self, pool=None, io_pool=None):
+        '''Yield the results of the whole batch: those of the files, see 
+        file_results, then those of the pages of the archives, see 
+        archive_tasks.'''
+        member_tasks = self.archive_tasks()
+        if pool is not None:
+            member_results = imap_bounded(pool, convert_member, member_tasks, 
+                                          2 * self.options.jobs)
+        else:
+            member_results = itertools.imap(convert_member, member_tasks)
+        return itertools.chain(self.file_results(self.input_files(), pool, 
+                                                 io_pool), 
+                               member_results)
+    
+    def write_results(self, results):
+        '''Take the results of the batch as they come, see record_result, 
+        with the pages that are left to write going to the --xml-dump, or 
+        else to the --output-dir or --output-archive.'''
+        dump = None
+        pages = None
+        try:
+            if self.options.xml_dump is not None:
+                dump = XmlDumpWriter(self.options.xml_dump)
+            elif self.options.output_dir is not None:
+                pages = DirectoryWriter(self.options.output_dir)
+            elif self.options.output_archive is not None:
+                pages = ZipWriter(self.options.output_archive)
+            for result in results:
+                self.record_result(result, dump, pages)
+        finally:
+            if dump is not None:
+                dump.close()
+            if pages is not None:
+                pages.close()
+    
+    def record_result(self, result, dump=None, pages=None):
+        '''Count the result of a page, write its page to dump or pages if 
+        it has to be, report it if it failed, and record it in the journal 
+        and the manifest.'''
+        if result.profile is not None:
+            self.profile.merge(result.profile)
+        if self.options.timings:
+            timing = (result.elapsed, result.filepath)
+            if len(self.slowest) < self.options.timings:
+                heapq.heappush(self.slowest, timing)
+            else:
+                heapq.heappushpop(self.slowest, timing)
+        digest = self.digests.pop(result.filepath, None)
+        if result.error is None and dump is not None:
+            result.error = self.dump_page(dump, result)
+        if result.error is None:
+            self.converted += 1
+            if dump is None and result.name is not None:
+                self.outputs[pages.write_page(result.name, result.content, 
+                                              result.timestamp)] += 1
+            elif dump is None:
+                self.outputs[result.output] += 1
+            if self.journal is not None:
+                self.journal.record(result.filepath, digest, 
+                                    self.result_output(result))
+        else:
+            self.failed += 1
+            sys.stderr.write('Failed to convert %s: %s\n' % 
+                    (result.filepath, result.error))
+        if self.manifest is not None:
+            key = os.path.abspath(result.filepath)
+            if result.error is None and digest is not None:
+                self.manifest[key] = digest
+            else:
+                self.manifest.pop(key, None)
+    
+    def print_summary(self, elapsed, parallel=False):
+        '''Print the counts of the batch, which took elapsed seconds, and 
+        with --profile and --timings, the stage profile and the slowest 
+        files. parallel tells whether there were worker processes.'''
+        if not self.options.quiet:
+            if self.manifest is not None or self.options.resume:
+                print 'Converted %d pages, %d failed, %d unchanged, ' \
+                      'in %.2f seconds.' % (self.converted, self.failed, 
+                                            self.skipped, elapsed)
+            else:
+                print 'Converted %d pages, %d failed, in %.2f seconds.' % \
+                        (self.converted, self.failed, elapsed)
+            if self.options.xml_dump is None:
+                print 'Output files: %(new)d new, %(updated)d updated, ' \
+                      '%(unchanged)d unchanged.' % self.outputs
+            peak, worker_peak = peak_memory()
+            if peak is not None:
+                if parallel:
+                    print 'Peak memory: %.1f MB, %.1f MB per worker.' % (
+                            peak / 1e6, worker_peak / 1e6)
+                else:
+                    print 'Peak memory: %.1f MB.' % (peak / 1e6)
+        if self.options.profile:
+            print self.profile.report()
+        if self.slowest:
+            print 'Slowest files:'
+            for elapsed, filepath in sorted(self.slowest, reverse=True):
+                print '%10.3fs  %s' % (elapsed, filepath)
+    
+    def file_results(self, filepaths, pool=None, io_pool=None):
+        '''Convert the files, and yield their results in order.
+        
+        Files are taken from filepaths (any iterable) BATCH_SIZE at a time, 
+        the whole batch converted before the next one is taken. With a 
+        process pool, each batch is scheduled largest file first, unless 
+        --schedule=input is given, and with --split, its files larger than 
+        the split size are each cut into chunks that the whole pool 
+        converts. A thread hands those chunks to the pool while the other 
+        files are queued on it too, and their results come after the 
+        others'. With a thread pool for I/O, or a --manifest or --journal, 
+        see pipeline.
+        '''
+        filepaths = iter(filepaths)
+        while True:
+            batch = list(itertools.islice(filepaths, BATCH_SIZE))
+            if not batch:
+                return
+            if pool is not None and self.options.schedule == 'largest':
+                batch = schedule_largest_first(batch)
+            tasks = [(filepath, self.options) for filepath in batch]
+            split_tasks = []
+            if pool is not None and self.options.split is not None:
+                other_tasks = []
+                for task in tasks:
+                    if file_size(task[0]) > self.options.split:
+                        split_tasks.append(task)
+                    else:
+                        other_tasks.append(task)
+                tasks = other_tasks
+                if split_tasks and self.checks_unchanged():
+                    split_tasks = self.changed_tasks(split_tasks, io_pool)
+            split_pool = None
+            try:
+                split_results = []
+                if split_tasks:
+                    split_pool = multiprocessing.pool.ThreadPool(1)
+                    split_results = [split_pool.apply_async(convert_file, 
+                                                            (task, pool)) 
+                                     for task in split_tasks]
+                    split_pool.close()
+                if io_pool is not None or self.checks_unchanged():
+                    results = self.pipeline(tasks, pool, io_pool)
+                elif pool is not None:
+                    results = imap_bounded(pool, convert_file, tasks, 
+                                           2 * self.options.jobs)
+                else:
+                    results = itertools.imap(convert_file, tasks)
+                for result in results:
+                    yield result
+                for result in split_results:
+                    yield result.get()
+            finally:
+                # the thread is done, unless the results were abandoned
+                if split_pool is not None:
+                    split_pool.terminate()
+    
+    def pipeline(self, tasks, pool, io_pool=None):
+        '''Yield the results of the convert_file tasks, in order, with the 
+        files read and written by the threads of io_pool, if there is one.
+        
+        Files are read ahead (read_file), converted by pool if there is one 
+        (convert_read_file), and written behind (write_result), so that the 
+        latency of each file is spent while others are converted. Each stage 
+        holds a few pages at most, so pages don't pile up in memory when 
+        one stage is slower than the others.
+        
+        With a --manifest or --journal, the files that are done are left 
+        out as they are read, see read_changed.
+        '''
+        window = 2 * self.options.io_threads
+        if io_pool is None:
+            io_imap = itertools.imap
+        else:
+            io_imap = lambda function, items: imap_bounded(io_pool, function, 
+                                                           items, window)
+        if self.checks_unchanged():
+            pages = self.changed_pages(io_imap(self.read_changed, tasks))
+        else:
+            pages = io_imap(read_file, tasks)
+        if pool is None:
+            results = itertools.imap(convert_read_file, pages)
+        else:
+            results = imap_bounded(pool, convert_read_file, pages, 
+                                   2 * self.options.jobs)
+        if self.options.xml_dump is not None:
+            return results
+        return io_imap(write_result, results)
+    
+    def checks_unchanged(self):
+        '''Whether files are checked against a manifest or a journal.'''
+        return self.manifest is not None or self.journal is not None
+    
+    def read_changed(self, task, keep=True):
+        '''Read the page of a convert_file task like read_file, and its 
+        page_digest from what was read, so that each file is read once.
+        
+        Returns the (filepath, options, content, error) tuple of read_file 
+        and the digest, or None and the digest if the page is done (see 
+        is_done). Unless keep is given, or for a file that will be 
+        streamed, the content isn't kept, and the digest is taken from the 
+        file.
+        
+        This runs on the threads of the I/O pool, if there is one; the 
+        results go through changed_pages.
+        '''
+        if keep:
+            page = read_file(task)
+        else:
+            page = task + (None, None)
+        filepath, options, content, error = page
+        if error is not None:
+            return page, None
+        digest = page_digest(filepath, options, content)
+        output = None
+        if options.xml_dump is None:
+            output = output_path(filepath)
+        if self.is_done(filepath, digest, output, self.manifest, 
+                        self.journal):
+            return None, digest
+        return page, digest
+    
+    def changed_pages(self, pages):
+        '''Yield the pages read by read_changed that aren't done, keeping 
+        their digests in self.digests, and counting the others in 
+        self.skipped.'''
+        for page, digest in pages:
+            if page is None:
+                self.skipped += 1
+            else:
+                self.digests[page[0]] = digest
+                yield page
+    
+    def changed_tasks(self, tasks, io_pool=None):
+        '''The convert_file tasks whose page isn't done, as by read_changed, 
+        for the files that --split cuts up, which are read as they are 
+        converted.'''
+        read = lambda task: self.read_changed(task, keep=False)
+        if io_pool is None:
+            pages = itertools.imap(read, tasks)
+        else:
+            pages = io_pool.imap(read, tasks)
+        return [page[:2] for page in self.changed_pages(pages)]
+    
+    def is_done(self, filepath, digest, output, manifest, journal):
+        '''Whether the page at filepath, of page_digest digest, was already 
+        converted to output (None if it has no output file of its own), as 
+        the manifest or the journal of a --resume tell.'''
+        if digest is None or (output is not None and 
+                              not os.path.exists(output)):
+            return False
+        if manifest is not None and (manifest.get(os.path.abspath(filepath)) 
+                                     == digest):
+            return True
+        return (journal is not None and self.options.resume and 
+                journal.get(filepath) == digest)
+    
+    def dump_page(self, dump, result):
+        '''Add the page of a result to the XML dump. Returns why it can't 
+        be added, or None.'''
+        timestamp = result.timestamp
+        text = result.content
+        try:
+            if timestamp is None:
+                timestamp = os.path.getmtime(result.filepath)
+            if result.content_path is not None:
+                text = open(result.content_path)
+            dump.write_page(page_title(result.filepath), text, timestamp)
+        except ValueError as e:
+            return str(e)
+        finally:
+            if result.content_path is not None:
+                if text is not None:
+                    text.close()
+                os.remove(result.content_path)
+        return None
+    
+    def result_output(self, result):
+        '''Where the converted page of a result went.'''
+        if self.options.xml_dump is not None:
+            return self.options.xml_dump
+        if result.name is None:
+            return output_path(result.filepath)
+        if self.options.output_dir is not None:
+            return member_output_path(self.options.output_dir, result.name)
+        return self.options.output_archive
+    
+    def archive_tasks(self):
+        '''Yield the convert_member tasks of the pages of the --archive 
+        archives, reading each page only when its task is taken.
+        
+        With a manifest or journal, pages are left out as by read_changed, 
+        and counted in self.skipped; the digests of the others go to 
+        self.digests. Pages are never left out of a new --output-archive, 
+        which has to have them all.
+        
+        An archive that can't be read fails like a file would, after the 
+        pages read from it before the error, if any.
+        '''
+        for archive in self.options.archive:
+            try:
+                for task in self.member_tasks(archive):
+                    yield task
+            except ARCHIVE_ERRORS as e:
+                yield (archive, self.options, None, 
+                       '%s: %s' % (e.__class__.__name__, e), None)
+    
+    def member_tasks(self, archive):
+        '''Yield the convert_member tasks of the pages of one archive, see 
+        archive_tasks.'''
+        for name, content, timestamp in archive_pages(archive, 
+                self.options.include, self.options.exclude):
+            filepath = os.path.join(archive, *name.split('/'))
+            if self.checks_unchanged():
+                digest = page_digest(filepath, self.options, content)
+                output = None
+                if self.options.output_dir is not None:
+                    output = member_output_path(self.options.output_dir, 
+                                                name)
+                if (self.options.output_archive is None and 
+                        self.is_done(filepath, digest, output, 
+                                     self.manifest, self.journal)):
+                    self.skipped += 1
+                    continue
+                self.digests[filepath] = digest
+            yield filepath, self.options, name, content, timestamp
+    
+    def serve(self):
+        '''Serve conversions on the --serve address until interrupted.
+        
+        SIGTERM stops the server cleanly, like Ctrl-C.
+        '''
+        server = make_server(self.options.serve, Converter(self.options))
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if not self.options.quiet:
+            print 'Serving conversions on %s' % (server.server_address,)
+            sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+        
+    def input_files(self):
+        '''Yield the files to convert: -f files, then -r directories, then 
+        the entries of --filelist.'''
         for filepath in self.options.file:
-            wp = WikispacesToMediawikiConverter(filepath, self.options)
-            wp.run()
+            yield filepath
+        for directory in self.options.recursive:
+            for filepath in walk_files(directory, self.options.include, 
+                                       self.options.exclude):
+                yield filepath
+        if self.options.filelist is not None:
+            if self.options.null:
+                separator = '\0'
+            else:
+                separator = '\n'
+            if self.options.filelist == '-':
+                stream = sys.stdin
+            else:
+                stream = open(self.options.filelist, 'rb')
+            try:
+                for filepath in read_file_list(stream, separator):
+                    yield filepath
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
         
-    def parse_options(self):
-        '''Read command line options
+    def parse_options(self, args=None):
+        '''Read command line options (from sys.argv, unless args is given)
         '''
-        parser = optparse.OptionParser(
-                        version=VersionInfo.name + " version " +VersionInfo.version + "\nProject homepage: " + VersionInfo.url, 
-                        description="This script can convert a Wikispaces-style source page into a MediaWiki-style source page. For a more detailed usage manual, see the project homepage: " + VersionInfo.url, 
-                        formatter=optparse.TitledHelpFormatter(),
-                        usage="%prog [options]\n or \n  python %prog [options]")
-        parser.add_option("-d", "--debug", action="store_true", dest="debug", help="debug mode (print some extra debug output). [default: %default]")
-        parser.add_option("-f", "--file", action="append", dest="file", help="Specify filepath to convert. For multiple files use this option multiple times. [default: %default]")
-        parser.add_option("-l", "--filelocation", action="store", dest="filelocation", help="Specify the full URL of directory where files are hosted. This will be used to convert [[file:...]] links to external links. [default: %default]")
-        parser.add_option("-m", "--usemedia", action="store_true", dest="usemedia", help="Use the [[Media:...]] tag instead of external links to convert [[file:...]] links. Note that by default Mediawiki doesn't allow uploads of non-image files. [default: %default]")
-        
-        parser.set_defaults(debug=False, 
-                            file=[],
-                            filelocation="http://localhost/files/",
-                            usemedia=False)
-        
-        (self.options, args) = parser.parse_args()
+        parser = make_option_parser()
+        (self.options, args) = parser.parse_args(args)
+        outputs = [option for option in ('--xml-dump', '--output-dir', 
+                                         '--output-archive') 
+                   if getattr(self.options, option[2:].replace('-', '_')) 
+                   is not None]
+        if len(outputs) > 1:
+            parser.error('%s and %s are exclusive' % tuple(outputs[:2]))
+        if self.options.archive and not outputs:
+            parser.error('--archive needs --output-dir, --output-archive or '
+                         '--xml-dump')
+        if (self.options.profile_slow is not None and 
+                not os.path.isdir(self.options.profile_dir)):
+            parser.error('--profile-dir %s is not a directory' % 
+                         self.options.profile_dir)
+        if self.options.resume:
+            if self.options.journal is None:
+                parser.error('--resume needs a --journal')
+            if outputs and outputs[0] != '--output-dir':
+                # these are written from scratch by each batch
+                parser.error('--resume can\'t be used with %s' % outputs[0])
         if self.options.debug:
             print "Your commandline options:\n", self.options
 
@@ -63,19 +2288,39 @@ class WikispacesToMediawikiConverter:
     http://www.mediawiki.org/wiki/Help:Formatting
     http://www.wikispaces.com/wikitext
     '''
-    def __init__(self, filepath, options):
+    # called after each conversion stage, see run_regexps
+    stage_hook = None
+    
+    def __init__(self, filepath, options, content=None):
+        '''Read in the page at filepath, or take its content if given.
+        
+        filepath is still where run writes the output to, and its base 
+        name is the page name that {$page} expands to.
+        '''
         self.filepath = filepath
         self.options = options
+        self.page_name = os.path.basename(filepath)
         
         self.extended_start = False
         self.extended_end = False
+        # whether run_singlepass left the page to run_regexps
+        self.singlepass_fallback = False
         
-        # the 'rU' mode should convert any \r\n to plain \n.
-        self.content = open(filepath, 'rU').read()
+        if content is None:
+            self.content = read_page(filepath)
+        else:
+            self.content = NEWLINE_REGEXP.sub('\n', content)
         
     def run(self):
-        self.run_regexps()
-        self.write_output()
+        self.convert()
+        return self.write_output()
+    
+    def convert(self):
+        '''Convert the content with the engine chosen in the options.'''
+        if getattr(self.options, 'engine', 'regexp') == 'singlepass':
+            self.run_singlepass()
+        else:
+            self.run_regexps()
     
     def extend_edges(self):
         '''Make sure the content starts and ends with a newline.
@@ -96,34 +2341,92 @@ class WikispacesToMediawikiConverter:
             self.content = self.content[:-2]
     
     def run_regexps(self):
-        '''Run some regexps on the source.'''
+        '''Run some regexps on the source.
+        
+        The regexps themselves are in REGEXP_RULES, and the order they
+        are run in is REGEXP_STAGES. If a stage_hook is set, it is called 
+        after each stage with the stage name, the time it took, and the 
+        size of the content before and after it.
+        
+        A stage is skipped if the content has none of its STAGE_MARKERS, 
+        as it would leave the content as it is; a stage_hook with a skip 
+        method, like StageProfile, is told about it instead.
+        
+        With a time_budget in the options, ConversionTimeout is raised 
+        after the first stage that ends over the budget.
+        '''
+        self.extend_edges()
+        hook = self.stage_hook
+        skip = getattr(hook, 'skip', None)
+        budget = getattr(self.options, 'time_budget', None)
+        page_start_time = time.time()
+        # restore_verbatim always runs, also when extract_verbatim doesn't
+        self.verbatim = []
+        for stage in REGEXP_STAGES:
+            markers = STAGE_MARKERS.get(stage)
+            if markers is not None:
+                content = self.content
+                for marker in markers:
+                    if marker in content:
+                        break
+                else:
+                    if skip is not None:
+                        skip(stage)
+                    continue
+            if hook is None:
+                getattr(self, stage)()
+            else:
+                bytes_in = len(self.content)
+                start_time = time.time()
+                getattr(self, stage)()
+                hook(stage, time.time() - start_time, bytes_in, 
+                     len(self.content))
+            if budget is not None:
+                elapsed = time.time() - page_start_time
+                if elapsed > budget:
+                    raise ConversionTimeout(stage, elapsed, budget)
+        self.restore_edges()
+    
+    def run_singlepass(self):
+        '''Same as run_regexps, but converts in a single scan.
+        
+        Pages with markup that the engine can't convert the way the 
+        sequential passes do are handed to run_regexps, which is told to 
+        the stage_hook as a 'singlepass_fallback' stage. See SinglePassEngine.
+        '''
         self.extend_edges()
-        self.extract_verbatim() # take out code and escapes
-        self.parse_toc()
-        self.parse_italics()
-        self.parse_external_links()
-        self.parse_file_links()
-        self.parse_bold()
-        self.parse_underline()
-        self.parse_monospaced()
-        self.parse_variables()
-        self.parse_includes()
-        self.parse_images()
-        self.parse_indents()
-        self.parse_tables()
-        self.restore_verbatim() # restore code and escapes
-        self.parse_code()
-        self.parse_math()
-        self.parse_escapes()
+        bytes_in = len(self.content)
+        start_time = time.time()
+        engine = SinglePassEngine(self.options, self.page_name, strict=True)
+        try:
+            self.content = engine.convert(self.content)
+        except IrregularMarkup:
+            self.singlepass_fallback = True
+            if self.stage_hook is not None:
+                self.stage_hook('singlepass_fallback', 
+                                time.time() - start_time, bytes_in, bytes_in)
+            self.restore_edges()
+            WikispacesToMediawikiConverter.run_regexps(self)
+            return
+        if self.stage_hook is not None:
+            self.stage_hook('singlepass', time.time() - start_time, bytes_in, 
+                            len(self.content))
         self.restore_edges()
+    
+    def apply_rules(self, stage):
+        '''Apply the compiled rules of one stage to the content.'''
+        for regexp, replacement in COMPILED_RULES[stage]:
+            if callable(replacement):
+                replacement = functools.partial(replacement, self)
+            self.content = regexp.sub(replacement, self.content)
         
     def parse_toc(self):
         '''remove the [[toc]] since mediawiki does it by default'''
-        self.content = re.sub(r'\n?\[\[toc(\|flat)?\]\]', r'', self.content)
+        self.apply_rules('toc')
     
     def parse_italics(self):
         """change italics from // to ''"""
-        self.content = re.sub(r'(?<!http:)(?<!https:)(?<!ftp:)//', r"''", self.content)
+        self.apply_rules('italics')
     
     def parse_external_links(self):
         '''change external link format, and free 'naked' external links.
@@ -134,13 +2437,7 @@ class WikispacesToMediawikiConverter:
         naked external links (those without label) simply get stripped of
         braces, since that produces the equivalent output in mediawiki.
         '''
-        # change external link format
-        self.content = re.sub(r'\[\[(https?://[^|\]]*)\|([^\]]*)\]\]', r'[\1 \2]', self.content)
-        self.content = re.sub(r'\[\[(ftp://[^|\]]*)\|([^\]]*)\]\]', r'[\1 \2]', self.content)
-        
-        # free naked external links
-        self.content = re.sub(r'\[\[(https?://[^|\]]*)\]\]', r'\1', self.content)
-        self.content = re.sub(r'\[\[(ftp://[^|\]]*)\]\]', r'\1', self.content)
+        self.apply_rules('external_links')
         
     def parse_file_links(self):
         '''change file link format to external links.
@@ -151,37 +2448,31 @@ class WikispacesToMediawikiConverter:
         '''
         if not self.options.usemedia:
             # change [[file:...]] links to external links
-            self.content = re.sub(r'\[\[file:([^|\]]*)\|([^\]]*)\]\]', r'[' + self.options.filelocation + r'\1 \2]', self.content)
-            self.content = re.sub(r'\[\[file:([^|\]]*)\]\]', r'[' + self.options.filelocation + r'\1 \1]', self.content)
+            self.apply_rules('file_links')
         else:
-            self.content = re.sub(r'\[\[file:([^|\]]*)\|([^\]]*)\]\]', r'[[Media:\1|\2]]', self.content)
-            self.content = re.sub(r'\[\[file:([^|\]]*)\]\]', r'[[Media:\1]]', self.content)
+            self.apply_rules('media_links')
             
     def parse_bold(self):
         """change bold from ** to '''"""
-        def replace_bold(matchobj):
-            text = matchobj.group(0)
-            text = text.replace('**', "'''")
-            return text
-        self.content = re.sub(r'(?<![\n\*])\*{2,}', replace_bold, self.content)
+        self.apply_rules('bold')
         
     def parse_underline(self):
         """change underline from __ to <u></u>"""
-        self.content = re.sub(r'(?s)__(.*?)__', r'<u>\1</u>', self.content)
+        self.apply_rules('underline')
         
     def parse_monospaced(self):
         """change monospaced font from {{}} to <tt></tt>"""
-        self.content = re.sub(r'(?s){{(.*?)}}', r'<tt>\1</tt>', self.content)
+        self.apply_rules('monospaced')
     
     def parse_variables(self):
         """Parse variables.
         
         The only variable currently supported is {$page}"""
-        self.content = re.sub(r'{\$page}', os.path.basename(self.filepath), self.content)
+        self.apply_rules('variables')
     
     def parse_includes(self):
         """change includes from [[include...]] to {{}}"""
-        self.content = re.sub(r'\[\[include page="([^"]*?)"[^\]]*?\]\]', r'{{:\1}}', self.content)
+        self.apply_rules('includes')
     
     def parse_code(self):
         '''convert the [[code]] tags to <pre> tags.
@@ -194,21 +2485,11 @@ class WikispacesToMediawikiConverter:
         
         maybe will add optional support for that with an extra cli option.
         '''
-        def code_replace(matchobj):
-            code = matchobj.group(2)
-            if self.options.debug:
-                print code
-            return '<pre>' + code + '</pre>'
-        self.content = re.sub(r'(?s)\[\[code( +format=".*?")?\]\](.*?)\[\[code\]\]', code_replace, self.content)
+        self.apply_rules('code')
         
     def parse_math(self):
         '''convert the [[math]] tags to <math> tags.'''
-        def math_replace(matchobj):
-            code = matchobj.group(2)
-            if self.options.debug:
-                print code
-            return '<math>' + code + '</math>'
-        self.content = re.sub(r'(?s)\[\[math( +format=".*?")?\]\](.*?)\[\[math\]\]', math_replace, self.content)
+        self.apply_rules('math')
 
     def parse_images(self):
         '''convert [[image:...]] tags to [[File:...]] tags.
@@ -220,152 +2501,1353 @@ class WikispacesToMediawikiConverter:
         http://www.mediawiki.org/wiki/Help:Images
         http://www.wikispaces.com/image+tags
         '''
-        def image_parse(matchobj):
-            imagetag = matchobj.group(0)
-            if self.options.debug:
-                print imagetag
-            image_filename = re.search(r'\[\[image:([^ ]*)', imagetag).group(1)
-            
-            try:
-                image_width = re.search(r'width="(\d+?)"', imagetag).group(1)
-            except AttributeError:
-                image_width = None
-            
-            try:
-                image_height = re.search(r'height="(\d+?)"', imagetag).group(1)
-            except AttributeError:
-                image_height = None
-                
-            if image_width is not None and image_height is not None:
-                image_size = '|' + image_width + 'x' + image_height + 'px'
-            elif image_width is not None and image_height is None:
-                image_size = '|' + image_width + 'px'
-            elif image_width is None and image_height is not None:
-                image_size = '|' + 'x' + image_height + 'px'
-            else:
-                image_size = ''
-            
-            try:
-                image_align = re.search(r'align="(.*?)"', imagetag).group(1)
-            except AttributeError:
-                image_align = None
-            if image_align is not None:
-                image_align = '|' + image_align
-            else:
-                image_align = ''
-            
-            try:
-                image_comment = re.search(r'caption="(.*?)"', imagetag).group(1)
-            except AttributeError:
-                image_comment = None
-            if image_comment is not None:
-                image_comment = '|' + image_comment
-            else:
-                image_comment = ''
-            
-            try:
-                image_link = re.search(r'link="(.*?)"', imagetag).group(1)
-            except AttributeError:
-                image_link = None
-            if image_link is not None:
-                image_link = '|' + 'link=' + image_link
-            else:
-                image_link = ''
-            
-            # in MW, thumbs cannot be links, but otherwise, a thumb is the 
-            # best representation of a captioned wikispaces image.
-            if image_comment != '' and image_link == '':
-                image_thumb = '|thumb'
-            else:
-                image_thumb = ''
-            
-            return '[[File:' + image_filename + image_thumb + image_size + \
-                        image_align + image_link + image_comment
-            
-        self.content = re.sub(r'\[\[image:[^\]]+', image_parse, self.content)
+        self.apply_rules('images')
     
     def parse_indents(self):
         '''change indent from > to :'''
-        def replace_indents(matchobj):
-            indents = matchobj.group(0)
-            if self.options.debug:
-                print indents
-            indents = indents.replace('>', ':')
-            return indents
-        
-        self.content = re.sub(r'(?m)^>+', replace_indents, self.content)
+        self.apply_rules('indents')
     
     def parse_tables(self):
-        '''convert wikispaces tables to mediawiki tables.'''
-        def replace_tables(matchobj):
-            atable = matchobj.group(0)
-            rows = atable.split('||\n')
-            for i, row in enumerate(rows):
-                if not row.endswith('||'):
-                    rows[i] = row + '||'
-            
-            output_table = '{| style="border: 1px solid #c6c9ff; border-collapse: collapse;" cellspacing="0" cellpadding="10" border="1"\n'
-            
-            for row in rows:
-                output_row = '|-\n'
-                cells = re.findall(r'(?s)(?<=\|\|)(.*?)(?=\|\|)', row)
-                for cell in cells:
-                    if cell.startswith('='):
-                        cell_type = '|align="center" |'
-                        cell = cell[1:]
-                    elif cell.startswith('>'):
-                        cell_type = '|align="right" |'
-                        cell = cell[1:]
-                    elif cell.startswith('~'):
-                        cell_type = '!'
-                        cell = cell[1:]
-                    else:
-                        cell_type = '|'
-                        
-                    output_row = output_row + cell_type + cell + '\n'
-                output_table += output_row
-                
-            output_table += '|}'
-            
-            return output_table
+        '''convert wikispaces tables to mediawiki tables.
         
-        self.content = re.sub(r'(?s)(?<=\n)([|][|].*?[|][|])(?=\n[^|]|\n[|][^|])', 
-                replace_tables, self.content)
+        tables are found with find_tables rather than a regexp, and built 
+        line by line, so this is linear in the size of the page.
+        '''
+        content = self.content
+        output = []
+        pos = 0
+        for start, end in find_tables(content):
+            output.append(content[pos:start])
+            output.extend(generate_table(content[start:end].split('\n')))
+            pos = end
+        if pos:
+            output.append(content[pos:])
+            self.content = ''.join(output)
     
     def extract_verbatim(self):
         '''Take out sections that should remain unparsed.
         
-        Store them in a dict, leave placeholders in content.
+        Store them in a list, leave placeholders in content.
         '''
-        self.verbatim_dict = {}
-        def replace_verbatim(matchobj):
-            while True:
-                key = 'verbatim_placeholder_' + str(random.randint(1, 1e15))
-                if key not in self.verbatim_dict.keys():
-                    break
-            self.verbatim_dict[key] = matchobj.group(0)
-            return key
-        
-        self.content = re.sub(r'(?s)\n?\[\[code( +format=".*?")?\]\](.*?)\[\[code\]\]\n?', replace_verbatim, self.content)
-        self.content = re.sub(r'``(.*)``', replace_verbatim, self.content)
-        self.content = re.sub(r'(?s)\[\[math( +format=".*?")?\]\](.*?)\[\[math\]\]', replace_verbatim, self.content)
+        self.verbatim = []
+        self.verbatim_sentinel = choose_sentinel(self.content)
+        self.apply_rules('verbatim')
         
     def restore_verbatim(self):
         '''Restore verbatim sections taken out by extract_verbatim.'''
-        for key in self.verbatim_dict.keys():
-            self.content = self.content.replace(key, self.verbatim_dict[key])
+        if self.verbatim:
+            self.content = self.restore_placeholders(self.content)
+    
+    def restore_placeholders(self, text):
+        '''Replace all verbatim placeholders in text, in a single pass.'''
+        verbatim = self.verbatim
+        return placeholder_regexp(self.verbatim_sentinel).sub(
+                lambda m: verbatim[int(m.group(1))], text)
         
     def parse_escapes(self):
         '''Replace escapes '``' with '<nowiki>' tags.'''
-        self.content = re.sub(r'``(.*)``', r'<nowiki>\1</nowiki>', self.content)
+        self.apply_rules('escapes')
     
     def write_output(self):
-        output_filepath = os.path.join(os.path.dirname(self.filepath), 
-                            os.path.basename(self.filepath) + '_mediawiki')
-                            
-        open(output_filepath, 'w').write(self.content)
+        '''Write the content to the output file, unless it is there already.
+        
+        A changed output is written to a temporary file first, which then 
+        replaces the output file, so the output file is always complete.
+        Returns 'new' if there was no output file, 'updated' if it was 
+        replaced, or 'unchanged' if it already had the content.
+        '''
+        return write_if_changed(output_path(self.filepath), self.content)
+
+
+# universal newlines, like reading a page in 'rU' mode
+NEWLINE_REGEXP = re.compile(r'\r\n?')
+
+class Converter:
+    '''Converts pages in memory with fixed options.
+    
+    A Converter holds no state of its own while converting: all the state 
+    of a page lives in the WikispacesToMediawikiConverter that convert 
+    makes for it, and the compiled rules and caches that pages share are 
+    safe to use from several threads. So one Converter can serve any 
+    number of threads at once, e.g. in a thread pool.
+    
+    stage_hook, if given, is set on the converter of each page; a 
+    StageProfile can be shared between threads.
+    '''
+    def __init__(self, options=None, stage_hook=None):
+        if options is None:
+            options = default_options()
+        self.options = options
+        self.stage_hook = stage_hook
+    
+    def convert(self, text, page_name=''):
+        '''Convert the wikispaces source text of a page, and return it.
+        
+        page_name is what {$page} expands to.
+        '''
+        context = WikispacesToMediawikiConverter(page_name, self.options, text)
+        context.page_name = page_name
+        context.stage_hook = self.stage_hook
+        context.convert()
+        return context.content
+
+def convert(text, options=None, page_name=''):
+    '''Convert the wikispaces source text of a page, and return it.
+    
+    This is the in-memory equivalent of running the converter on a file: 
+    nothing is read or written. options are like those of default_options, 
+    which is what is used if they are not given; page_name is what {$page} 
+    expands to. To convert many pages with the same options, use a 
+    Converter.
+    '''
+    return Converter(options).convert(text, page_name)
+
+class ServerStats:
+    '''Latency and throughput counters of a conversion server.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.pages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.busy_seconds = 0.0
+        self.max_latency = 0.0
+    
+    def record(self, pages, bytes_in, bytes_out, elapsed, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.pages += pages
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.busy_seconds += elapsed
+            self.max_latency = max(self.max_latency, elapsed)
+    
+    def snapshot(self):
+        '''The counters as a dict, with the mean latency and throughput.'''
+        with self.lock:
+            uptime = time.time() - self.start_time
+            stats = {
+                'uptime': uptime,
+                'requests': self.requests,
+                'errors': self.errors,
+                'pages': self.pages,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'busy_seconds': self.busy_seconds,
+                'max_latency': self.max_latency,
+                'mean_latency': 0.0,
+                'pages_per_second': 0.0,
+                'bytes_per_second': 0.0,
+                }
+            if self.requests:
+                stats['mean_latency'] = self.busy_seconds / self.requests
+            if self.busy_seconds:
+                stats['pages_per_second'] = self.pages / self.busy_seconds
+                stats['bytes_per_second'] = self.bytes_in / self.busy_seconds
+            return stats
+
+class ConversionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves conversions with the server's converter.
+    
+    POST /convert?page=NAME  converts the request body, and returns the 
+                             result as text/plain.
+    POST /batch              converts many pages: the body is a JSON list 
+                             of {"name": ..., "text": ...} objects, and the 
+                             result is the same list, with the texts 
+                             converted. Texts are unicode in JSON, and 
+                             UTF-8 otherwise.
+    GET /stats               returns the ServerStats counters as JSON.
+    '''
+    server_version = 'wstomwconverter/' + VersionInfo.version
+    
+    def do_GET(self):
+        if urlparse.urlsplit(self.path).path != '/stats':
+            return self.send_error(404)
+        self.reply('application/json', json.dumps(self.server.stats.snapshot()))
+    
+    def do_POST(self):
+        url = urlparse.urlsplit(self.path)
+        if url.path not in ('/convert', '/batch'):
+            return self.send_error(404)
+        start_time = time.time()
+        body = ''
+        pages = 0
+        result = ''
+        error = None
+        try:
+            body = self.rfile.read(self.content_length())
+            if url.path == '/convert':
+                page_name = urlparse.parse_qs(url.query).get('page', [''])[0]
+                result = self.server.converter.convert(body, page_name)
+                pages = 1
+            else:
+                result, pages = self.convert_batch(body)
+        except ValueError as e:
+            error = (400, str(e))
+        except Exception as e:
+            error = (500, '%s: %s' % (e.__class__.__name__, e))
+        self.server.stats.record(pages, len(body), len(result), 
+                time.time() - start_time, error is not None)
+        if error is not None:
+            return self.send_error(*error)
+        if url.path == '/convert':
+            self.reply('text/plain; charset=utf-8', result)
+        else:
+            self.reply('application/json', result)
+    
+    def content_length(self):
+        '''The length of the request body; ValueError if it isn't one.'''
+        length = self.headers.get('Content-Length', '0')
+        if not length.strip().isdigit():
+            # a negative length would read until the client hangs up
+            raise ValueError('bad Content-Length: %r' % length)
+        return int(length)
+    
+    def convert_batch(self, body):
+        '''Convert the pages of a /batch request; returns the JSON reply.'''
+        try:
+            pages = json.loads(body)
+            if not isinstance(pages, list):
+                raise TypeError
+            names = [page.get('name', '') for page in pages]
+            texts = [page['text'] for page in pages]
+            for value in names + texts:
+                if not isinstance(value, basestring):
+                    raise TypeError
+        except (TypeError, KeyError, AttributeError):
+            raise ValueError('expected a list of {"name": ..., "text": ...}')
+        converted = []
+        for name, text in zip(names, texts):
+            text = self.server.converter.convert(text.encode('utf-8'), 
+                                                 name.encode('utf-8'))
+            converted.append({'name': name, 'text': text.decode('utf-8')})
+        return json.dumps(converted), len(converted)
+    
+    def reply(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def address_string(self):
+        # clients of a unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+    
+    def log_message(self, format, *args):
+        if self.server.converter.options.debug:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ConversionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''An HTTP server converting pages in a thread per request.'''
+    daemon_threads = True
+    
+    def __init__(self, address, converter):
+        BaseHTTPServer.HTTPServer.__init__(self, address, 
+                                           ConversionRequestHandler)
+        self.converter = converter
+        self.stats = ServerStats()
+
+class UnixConversionServer(SocketServer.ThreadingMixIn, 
+                           SocketServer.UnixStreamServer):
+    '''Same as ConversionServer, but on a unix socket.'''
+    daemon_threads = True
+    
+    def __init__(self, path, converter):
+        # a socket left behind by an earlier server would make bind fail
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, 
+                                               ConversionRequestHandler)
+        self.converter = converter
+        self.stats = ServerStats()
+    
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        os.remove(self.server_address)
+
+def make_server(address, converter):
+    '''A conversion server for address, which is [HOST:]PORT or unix:PATH.
+    
+    HOST defaults to localhost, and PORT 0 picks a free port. See 
+    ConversionRequestHandler for what the server does.
+    '''
+    if address.startswith('unix:'):
+        return UnixConversionServer(address[len('unix:'):], converter)
+    host, sep, port = address.rpartition(':')
+    return ConversionServer((host or 'localhost', int(port)), converter)
+
+# The document tree of a page, as SinglePassEngine.parse builds it: lists 
+# of text and nodes. A page is parsed once, and can then be rendered any 
+# number of ways, e.g. to mediawiki with different options, or to plain 
+# text, by walking the tree with a Renderer.
+
+class Node(object):
+    '''A node of the document tree of a page, see parse.
+    
+    Children are lists of text (str) and nodes. kind names the render_ 
+    method of a Renderer that renders the node, and child_lists the 
+    attributes that hold its children, if any.
+    '''
+    __slots__ = ()
+    kind = None
+    child_lists = ()
+
+class Document(Node):
+    '''A whole page: paragraphs, and the blank lines between them as text.
+    
+    sentinel is a character that doesn't occur in the page, and the 
+    extended flags tell whether a line break was added at its start, and 
+    two at its end, for it to be parsed (see extend_edges).
+    '''
+    __slots__ = ('children', 'sentinel', 'extended_start', 'extended_end')
+    kind = 'document'
+    child_lists = ('children',)
+    
+    def __init__(self, children, sentinel, extended_start=False, 
+                 extended_end=False):
+        self.children = children
+        self.sentinel = sentinel
+        self.extended_start = extended_start
+        self.extended_end = extended_end
+
+class Paragraph(Node):
+    __slots__ = ('children',)
+    kind = 'paragraph'
+    child_lists = ('children',)
+    
+    def __init__(self, children):
+        self.children = children
+
+class Code(Node):
+    '''A [[code]] block; line_before and line_after are the line breaks 
+    right before and after it that belong to it, if any.'''
+    __slots__ = ('body', 'line_before', 'line_after')
+    kind = 'code'
+    
+    def __init__(self, body, line_before='', line_after=''):
+        self.body = body
+        self.line_before = line_before
+        self.line_after = line_after
+
+class Math(Node):
+    __slots__ = ('body',)
+    kind = 'math'
+    
+    def __init__(self, body):
+        self.body = body
+
+class Escape(Node):
+    '''Text between `` that is left as it is.'''
+    __slots__ = ('body',)
+    kind = 'escape'
+    
+    def __init__(self, body):
+        self.body = body
+
+class Toc(Node):
+    __slots__ = ('flat',)
+    kind = 'toc'
+    
+    def __init__(self, flat=False):
+        self.flat = flat
+
+class ExternalLink(Node):
+    '''A link to a URL; label is None for a link without one.'''
+    __slots__ = ('url', 'label')
+    kind = 'external_link'
+    child_lists = ('url', 'label')
+    
+    def __init__(self, url, label=None):
+        self.url = url
+        self.label = label
+
+class FileLink(Node):
+    '''A [[file:...]] link; label is None for a link without one.'''
+    __slots__ = ('filename', 'label')
+    kind = 'file_link'
+    child_lists = ('filename', 'label')
+    
+    def __init__(self, filename, label=None):
+        self.filename = filename
+        self.label = label
+
+class Include(Node):
+    __slots__ = ('page',)
+    kind = 'include'
+    child_lists = ('page',)
+    
+    def __init__(self, page):
+        self.page = page
+
+class Image(Node):
+    '''An [[image:...]] tag: tag is its source after '[[image:', up to the 
+    first ']', and closer is the closing ']]', or '' if the tag isn't 
+    closed with one.'''
+    __slots__ = ('tag', 'closer')
+    kind = 'image'
+    child_lists = ('tag',)
+    
+    def __init__(self, tag, closer=']]'):
+        self.tag = tag
+        self.closer = closer
+
+class Format(Node):
+    '''Where an inline span of a style starts or ends: 'italics', 'bold', 
+    'underline' or 'monospaced'. Spans can cross other nodes, so they are 
+    marks rather than nodes with children.
+    
+    source is the markup of the mark, and a mark that turns out to have 
+    no partner is literal, i.e. just its source. Italics and bold marks 
+    are never literal, and the common ones are shared, see SHARED_MARKS.
+    '''
+    __slots__ = ('style', 'source', 'opening', 'literal')
+    kind = 'format'
+    
+    def __init__(self, style, source, opening=True):
+        self.style = style
+        self.source = source
+        self.opening = opening
+        self.literal = False
+
+# the italics mark and the usual bold mark, which all documents share, 
+# since there are many of them; nodes aren't changed once parsed.
+SHARED_MARKS = {
+    '//': Format('italics', '//'), 
+    '**': Format('bold', '**'), 
+    }
+
+class Variable(Node):
+    '''{$page}, the name of the page.'''
+    __slots__ = ()
+    kind = 'variable'
+
+class Indent(Node):
+    __slots__ = ('depth',)
+    kind = 'indent'
+    
+    def __init__(self, depth):
+        self.depth = depth
+
+class Table(Node):
+    '''A table, with its rows and cells as text: which '||' delimits a 
+    cell is only known once the links and images in it are rendered, as 
+    convert_table finds them. A table without an end is left as it is.'''
+    __slots__ = ('children', 'ended')
+    kind = 'table'
+    child_lists = ('children',)
+    
+    def __init__(self, children, ended):
+        self.children = children
+        self.ended = ended
+
+# the nodes that can be in the children of another node
+NODE_CLASSES = (Paragraph, Code, Math, Escape, Toc, ExternalLink, FileLink, 
+                Include, Image, Format, Variable, Indent, Table)
+
+def iter_nodes(nodes):
+    '''Yield the nodes in the list nodes, and in their children, depth 
+    first.'''
+    for node in nodes:
+        if not isinstance(node, basestring):
+            yield node
+            for name in node.child_lists:
+                children = getattr(node, name)
+                if children is not None:
+                    for child in iter_nodes(children):
+                        yield child
+
+PARAGRAPH_BREAK_REGEXP = re.compile(r'(\n\n+)')
+
+def group_paragraphs(nodes):
+    '''Group a list of text and nodes into Paragraph nodes, at the blank 
+    lines between them, which stay as text.'''
+    grouped = []
+    paragraph = []
+    for node in nodes:
+        if not isinstance(node, basestring):
+            paragraph.append(node)
+        elif '\n\n' in node:
+            parts = PARAGRAPH_BREAK_REGEXP.split(node)
+            for i, part in enumerate(parts):
+                if i % 2 == 0:
+                    if part:
+                        paragraph.append(part)
+                    continue
+                if paragraph:
+                    grouped.append(Paragraph(paragraph))
+                    paragraph = []
+                grouped.append(part)
+        elif node:
+            paragraph.append(node)
+    if paragraph:
+        grouped.append(Paragraph(paragraph))
+    return grouped
+
+def extend_edges(text):
+    '''Make sure text starts with a newline, and ends with two.
+    
+    This is to simplify our matching patterns. Returns the text, and 
+    whether a newline was added at its start, and at its end.
+    '''
+    extended_start = not text.startswith('\n')
+    if extended_start:
+        text = '\n' + text
+    extended_end = not text.endswith('\n\n')
+    if extended_end:
+        text = text + '\n\n'
+    return text, extended_start, extended_end
+
+def parse(text, options=None):
+    '''Parse a wikispaces page into its document tree, see Document.
+    
+    Only options.debug and options.time_budget are used by the parsing; 
+    the other options, and the page name, only matter to the renderers.
+    '''
+    if options is None:
+        options = default_options()
+    text, extended_start, extended_end = extend_edges(
+            NEWLINE_REGEXP.sub('\n', text))
+    document = SinglePassEngine(options, '').parse(text)
+    document.children = group_paragraphs(document.children)
+    document.extended_start = extended_start
+    document.extended_end = extended_end
+    return document
+
+# (class, prefix) -> the table of method_table
+METHOD_TABLES = {}
+
+def method_table(cls, prefix, keys):
+    '''The functions of the methods prefix + name of the old-style class 
+    cls, by key, for each (key, name) in keys that cls has a method for.
+    
+    The table is made once per class; calling the functions in it with 
+    the instance is faster than looking up a bound method every time.
+    '''
+    table = METHOD_TABLES.get((cls, prefix))
+    if table is None:
+        table = {}
+        for key, name in keys:
+            method = getattr(cls, prefix + name, None)
+            if method is not None:
+                table[key] = method.im_func
+        METHOD_TABLES[cls, prefix] = table
+    return table
+
+# code, math and escapes are converted inside each other's bodies too, as 
+# the regexp engine restores verbatim sections before converting them.
+NESTED_CODE_MATCHER = BlockMatcher('code')
+NESTED_MATH_MATCHER = BlockMatcher('math')
+NESTED_ESCAPE_REGEXP = re.compile(r'``(.*)``')
+
+def convert_nested(body, code=False, math=False, escapes=False):
+    '''Convert the code, math and escapes inside the body of another 
+    verbatim section.'''
+    if code and '[[code' in body:
+        body = NESTED_CODE_MATCHER.sub(
+                lambda m: '<pre>' + m.group(2) + '</pre>', body)
+    if math and '[[math' in body:
+        body = NESTED_MATH_MATCHER.sub(
+                lambda m: '<math>' + m.group(2) + '</math>', body)
+    if escapes and '``' in body:
+        body = NESTED_ESCAPE_REGEXP.sub(r'<nowiki>\1</nowiki>', body)
+    return body
+
+class Renderer:
+    '''Turns a document tree into text.
+    
+    Subclasses have a render_<kind> method for the kind of each node, 
+    which appends the rendering of the node to a list; text is copied as 
+    it is.
+    '''
+    def __init__(self):
+        # the render_ function of each class of node
+        self.renderers = method_table(self.__class__, 'render_', 
+                [(node_class, node_class.kind) for node_class in NODE_CLASSES])
+    
+    def render_document(self, document):
+        '''Render a whole page, as parse returned it.'''
+        text = self.render(document.children)
+        if document.extended_start:
+            text = text[1:]
+        if document.extended_end:
+            text = text[:-2]
+        return text
+    
+    def render(self, nodes):
+        '''Render a list of text and nodes.'''
+        out = []
+        self.render_nodes(nodes, out)
+        return ''.join(out)
+    
+    def render_nodes(self, nodes, out):
+        renderers = self.renderers
+        append = out.append
+        for node in nodes:
+            method = renderers.get(node.__class__)
+            if method is None:
+                # text
+                append(node)
+            else:
+                method(self, node, out)
+    
+    def render_paragraph(self, node, out):
+        self.render_nodes(node.children, out)
+
+# the mediawiki markup of the Format marks, by (style, opening)
+MEDIAWIKI_FORMATS = {
+    ('italics', True): "''", 
+    ('underline', True): '<u>', 
+    ('underline', False): '</u>', 
+    ('monospaced', True): '<tt>', 
+    ('monospaced', False): '</tt>', 
+    }
+
+class MediaWikiRenderer(Renderer):
+    '''Renders a document tree to mediawiki markup, like the single-pass 
+    engine does: the same as the converter, unless the page has markup 
+    that a strict SinglePassEngine leaves to the sequential passes (see 
+    IrregularMarkup), which parse doesn't.
+    
+    options are those of the converter; usemedia and filelocation change 
+    how file links are rendered.
+    '''
+    def __init__(self, options, page_name=''):
+        Renderer.__init__(self)
+        self.options = options
+        self.page_name = page_name
+        # the verbatim sections of the table being rendered
+        self.stash = None
+        self.sentinel = None
+    
+    def render_document(self, document):
+        self.sentinel = document.sentinel
+        return Renderer.render_document(self, document)
+    
+    def render_verbatim(self, converted, out):
+        if self.stash is not None:
+            out.append(make_placeholder(self.sentinel, len(self.stash)))
+            self.stash.append(converted)
+        else:
+            out.append(converted)
+    
+    def render_code(self, node, out):
+        self.render_verbatim(node.line_before + '<pre>' + 
+                convert_nested(node.body, math=True, escapes=True) + 
+                '</pre>' + node.line_after, out)
+    
+    def render_math(self, node, out):
+        self.render_verbatim('<math>' + 
+                convert_nested(node.body, code=True, escapes=True) + 
+                '</math>', out)
+    
+    def render_escape(self, node, out):
+        self.render_verbatim('<nowiki>' + 
+                convert_nested(node.body, code=True, math=True) + 
+                '</nowiki>', out)
+    
+    def render_toc(self, node, out):
+        pass
+    
+    def render_external_link(self, node, out):
+        if node.label is None:
+            self.render_nodes(node.url, out)
+        else:
+            out.append('[')
+            self.render_nodes(node.url, out)
+            out.append(' ')
+            self.render_nodes(node.label, out)
+            out.append(']')
+    
+    def render_file_link(self, node, out):
+        filename = self.render(node.filename)
+        label = None
+        if node.label is not None:
+            label = self.render(node.label)
+        if not self.options.usemedia:
+            if label is None:
+                label = filename
+            out.append('[' + self.options.filelocation + filename + ' ' + 
+                       label + ']')
+        elif label is None:
+            out.append('[[Media:' + filename + ']]')
+        else:
+            out.append('[[Media:' + filename + '|' + label + ']]')
+    
+    def render_include(self, node, out):
+        out.append('{{:')
+        self.render_nodes(node.page, out)
+        out.append('}}')
+    
+    def render_image(self, node, out):
+        out.append(convert_image_tag('[[image:' + self.render(node.tag)))
+        out.append(node.closer)
+    
+    def render_format(self, node, out):
+        if node.literal:
+            out.append(node.source)
+        elif node.style == 'bold':
+            out.append(node.source.replace('**', "'''"))
+        else:
+            out.append(MEDIAWIKI_FORMATS[node.style, node.opening])
+    
+    def render_variable(self, node, out):
+        out.append(self.page_name)
+    
+    def render_indent(self, node, out):
+        out.append(':' * node.depth)
+    
+    def render_table(self, node, out):
+        # verbatim sections are stashed away while the table is converted, 
+        # so that no '||' or line break in them is taken for a cell or row.
+        stash = self.stash = []
+        try:
+            atable = self.render(node.children)
+        finally:
+            self.stash = None
+        if node.ended:
+            atable = convert_table(atable)
+        if stash:
+            atable = placeholder_regexp(self.sentinel).sub(
+                    lambda m: stash[int(m.group(1))], atable)
+        out.append(atable)
+
+# a cell delimiter of a table, with the alignment or header mark after it
+TABLE_DELIMITER_REGEXP = re.compile(r'\|\|[=>~]?')
+
+class PlainTextRenderer(Renderer):
+    '''Renders a document tree to its text without markup, e.g. for a 
+    search index: link labels (or targets), and the bodies of code, math 
+    and escapes. Images, includes and tables of contents are left out.'''
+    def __init__(self, page_name=''):
+        Renderer.__init__(self)
+        self.page_name = page_name
+    
+    def render_code(self, node, out):
+        out.append(node.line_before + node.body + node.line_after)
+    
+    def render_math(self, node, out):
+        out.append(node.body)
+    
+    render_escape = render_math
+    
+    def render_toc(self, node, out):
+        pass
+    
+    def render_external_link(self, node, out):
+        if node.label is None:
+            self.render_nodes(node.url, out)
+        else:
+            self.render_nodes(node.label, out)
+    
+    def render_file_link(self, node, out):
+        if node.label is None:
+            self.render_nodes(node.filename, out)
+        else:
+            self.render_nodes(node.label, out)
+    
+    render_include = render_image = render_indent = render_toc
+    
+    def render_format(self, node, out):
+        if node.literal:
+            out.append(node.source)
+    
+    def render_variable(self, node, out):
+        out.append(self.page_name)
+    
+    def render_table(self, node, out):
+        out.append(TABLE_DELIMITER_REGEXP.sub(' ', self.render(node.children)))
+
+def page_links(document):
+    '''The links of a document tree, in order, as (kind, target) tuples.
+    
+    kind is 'external', 'file', 'include' or 'image'; target is the URL, 
+    the file name, or the name of the included page.
+    '''
+    text = PlainTextRenderer()
+    links = []
+    for node in iter_nodes(document.children):
+        if node.kind == 'external_link':
+            links.append(('external', text.render(node.url)))
+        elif node.kind == 'file_link':
+            links.append(('file', text.render(node.filename)))
+        elif node.kind == 'include':
+            links.append(('include', text.render(node.page)))
+        elif node.kind == 'image':
+            links.append(('image', text.render(node.tag).split(' ', 1)[0]))
+    return links
+
+class IrregularMarkup(Exception):
+    '''Markup that a strict SinglePassEngine doesn't convert, as it can't 
+    tell how the sequential passes convert it, e.g. overlapping constructs.'''
+
+# markup that the sequential passes convert before or after a link, 
+# include or image, rather than as part of it
+SPAN_IRREGULAR_MARKERS = ('``', '[[code', '[[math', '[[toc', '\n||')
+
+# marks that pair up in the sequential passes, which see the name of a 
+# file link without a label twice
+FILE_NAME_PAIRED_MARKS = ('``', '[[code', '[[math', '__', '{{', '}}')
+
+# characters that make a page name markup for the passes after 
+# parse_variables, which convert {$page} before them
+PAGE_NAME_MARKUP_REGEXP = re.compile(r'[][>|`"\n]')
+
+# characters on either side of a naked external link that may form markup 
+# with the other side once the passes have removed its brackets
+LINK_JOIN_CHARS = frozenset('*/_{}|>[]`$\n')
+
+class SinglePassEngine:
+    '''Converts a page in a single left-to-right scan.
+    
+    This is an alternative to the chain of parse_* passes in 
+    WikispacesToMediawikiConverter.run_regexps. Every construct is 
+    recognized by one master pattern, and its node is added to the 
+    document tree as soon as it is seen, so the page is scanned only 
+    once. The tree is then rendered by a MediaWikiRenderer.
+    
+    Text that is itself subject to conversion (link labels, image tags, 
+    tables) is parsed by scanning just that part of the page, with the 
+    same state. Bold, indents and tables only fire where the 
+    sequential passes would have seen the same preceding character, 
+    i.e. taking removed [[toc]] tags and verbatim placeholders into account.
+    
+    Code, math, links, includes and images are recognized by their opener 
+    only; the rest of the construct is looked for with cached str.find, 
+    so that a page full of unclosed openers still takes linear time.
+    
+    Some markup comes out of the sequential passes in a way that depends 
+    on their order, rather than on the page: a [[toc]] that joins the 
+    text around it, constructs that overlap code, math or escapes, page 
+    names with markup in them, unclosed images and tables. A strict 
+    engine raises IrregularMarkup on those, and run_singlepass then runs 
+    the passes instead; parse itself makes the best of them.
+    '''
+    # Every alternative starts with a literal character, so that re only 
+    # tries the pattern where one of those characters is, and only the 
+    # alternatives for that character. The group of a token is named 
+    # after its handler, and the match as a whole is the token.
+    token_source = r'''(?xs)
+        \n(?: (?P<code_nl>\[\[code) | (?P<toc_nl>\[\[toc(?:\|flat)?\]\]) )
+      | \[\[(?: (?P<code>code)
+             | (?P<math>math)
+             | (?P<toc>toc(?:\|flat)?\]\])
+             | (?P<external_link>(?:https?|ftp)://)
+             | (?P<file_link>file:)
+             | (?P<include>include[ ]page=")
+             | (?P<image>image:(?=[^\]])) )
+      | `(?P<escape>`(?P<escape_body>[^\n]*)``)
+      | /(?<!http:/)(?<!https:/)(?<!ftp:/)(?P<italics>/)
+      | \*(?P<bold>\*+)
+      | _(?P<underline>_)
+      | {(?: (?P<monospaced_open>{) | (?P<variable>\$page}) )
+      | }(?P<monospaced_close>})
+      | >(?<=[\n\]]>)(?P<indent>>*)
+      | \|(?P<table>\|%s)
+        '''
+    token_pattern = re.compile(token_source % '')
+    # inside a table, a '||' is only a token where the table can end, or 
+    # where it is part of a '|||'; the other ones are just text. The table 
+    # can't end at a line break that is followed by another row.
+    table_token_pattern = re.compile(token_source % r'(?=[|[]|\n(?![|][|]))')
+    toc_pattern = re.compile(r'\n?\[\[toc(\|flat)?\]\]')
+    link_delimiter_pattern = re.compile(r'[|\]]')
+    
+    def __init__(self, options, page_name, strict=False):
+        self.options = options
+        self.page_name = page_name
+        self.strict = strict
+        # the handle_ function of each token, by the name of its group
+        self.handlers = method_table(self.__class__, 'handle_', 
+                [(name, name) for name in self.token_pattern.groupindex])
+    
+    def convert(self, text):
+        '''Convert text, which must start with '\\n' and end with '\\n\\n'.'''
+        renderer = MediaWikiRenderer(self.options, self.page_name)
+        return renderer.render_document(self.parse(text))
+    
+    def parse(self, text):
+        '''Parse text, which must start with '\\n' and end with '\\n\\n', 
+        into a Document of its nodes, not yet grouped into paragraphs.'''
+        self.boundary = (None, None)
+        self.underline_open = None
+        self.monospaced_open = None
+        self.closer_cache = {}
+        self.find_cache = {}
+        self.endpos = len(text)
+        self.in_image = False
+        self.depth = 0
+        self.table_depth = None
+        self.table_ended = False
+        self.no_more_tables = False
+        # the number of file links, images and tables being parsed
+        self.joined = 0
+        self.sentinel = choose_sentinel(text)
+        self.start_time = time.time()
+        self.budget = getattr(self.options, 'time_budget', None)
+        self.deadline = None
+        if self.budget is not None:
+            self.deadline = self.start_time + self.budget
+        
+        out = []
+        self.scan(text, 0, len(text), out)
+        # an opening mark whose only partners were inside verbatim sections; 
+        # the sequential passes have already converted a mark inside a 
+        # file link, image or table by then.
+        for opened in (self.underline_open, self.monospaced_open):
+            if opened is not None and not opened[1]:
+                self.irregular('unpaired ' + opened[0].source)
+                opened[0].literal = True
+        return Document(out, self.sentinel)
+    
+    def scan(self, text, pos, endpos, out):
+        '''Parse text[pos:endpos], appending its text and nodes to out.
+        
+        Returns the position where scanning stopped, which is endpos unless 
+        the end of a table was found.
+        '''
+        if self.table_depth is None:
+            search = self.token_pattern.search
+        else:
+            search = self.table_token_pattern.search
+        handlers = self.handlers
+        append = out.append
+        deadline = self.deadline
+        outer_endpos = self.endpos
+        self.endpos = endpos
+        self.depth += 1
+        try:
+            while True:
+                matchobj = search(text, pos, endpos)
+                if matchobj is None:
+                    break
+                if deadline is not None and time.time() > deadline:
+                    raise ConversionTimeout('singlepass', 
+                            time.time() - self.start_time, self.budget)
+                start = matchobj.start()
+                if start != pos:
+                    append(text[pos:start])
+                kind = matchobj.lastgroup
+                if kind == 'bold':
+                    # the most common token, so it is handled right here; 
+                    # the sequential passes leave a bold mark after a line 
+                    # break or a '*' as it is.
+                    pos = matchobj.end()
+                    source = matchobj.group()
+                    boundary = self.boundary
+                    if start == boundary[0]:
+                        previous = boundary[1]
+                    else:
+                        previous = text[start - 1]
+                    if previous == '\n' or previous == '*':
+                        append(source)
+                    else:
+                        append(SHARED_MARKS.get(source) or Format('bold', source))
+                    continue
+                pos = handlers[kind](self, text, matchobj, out)
+                if self.table_ended and self.depth == self.table_depth:
+                    return pos
+            if pos != endpos:
+                append(text[pos:endpos])
+            return endpos
+        finally:
+            self.depth -= 1
+            self.endpos = outer_endpos
+    
+    def scan_to_list(self, text, start, end, joined=False):
+        '''Parse text[start:end] into a new list. joined tells that the 
+        sequential passes convert that part as a whole, see open_mark.'''
+        out = []
+        self.joined += joined
+        try:
+            self.scan(text, start, end, out)
+        finally:
+            self.joined -= joined
+        return out
+    
+    def open_mark(self, style, source, out):
+        '''Add the opening mark of an underline or monospaced span to out.
+        
+        Returns the mark, and whether it is inside a file link, image or 
+        table, which the sequential passes convert as a whole.
+        '''
+        mark = Format(style, source)
+        out.append(mark)
+        return mark, self.joined > 0
+    
+    def previous_char(self, text, pos):
+        '''The character the sequential passes would see before pos.'''
+        if pos == self.boundary[0]:
+            return self.boundary[1]
+        return text[pos - 1:pos]
+    
+    def has_closer(self, text, closer, pos):
+        '''Is there an occurrence of closer at or after pos?'''
+        found = self.closer_cache.get(closer)
+        if found is None or (found != -1 and found < pos):
+            found = text.find(closer, pos)
+            self.closer_cache[closer] = found
+        return found != -1
+    
+    def find_after(self, text, needle, pos):
+        '''The first occurrence of needle at or after pos, or -1.
+        
+        needle is a string or a compiled regexp. The last result for each 
+        needle is cached, since openers are looked for left to right.
+        '''
+        cached = self.find_cache.get(needle)
+        if cached is not None:
+            searched_from, found = cached
+            if searched_from <= pos and (found == -1 or pos <= found):
+                return found
+        if isinstance(needle, basestring):
+            found = text.find(needle, pos)
+        else:
+            matchobj = needle.search(text, pos)
+            if matchobj is None:
+                found = -1
+            else:
+                found = matchobj.start()
+        self.find_cache[needle] = (pos, found)
+        return found
+    
+    def match_block(self, text, tag, pos):
+        '''Match the rest of a [[tag]]...[[tag]] block whose opener ends at pos.
+        
+        Returns (body_start, body_end, end), or None if there is no block.
+        '''
+        endpos = self.endpos
+        format = FORMAT_REGEXP.match(text, pos, endpos)
+        if format is not None:
+            quote = self.find_after(text, '"]]', format.end())
+            if quote == -1:
+                return None
+            body_start = quote + 3
+        elif text.startswith(']]', pos, endpos):
+            body_start = pos + 2
+        else:
+            return None
+        closer = '[[' + tag + ']]'
+        body_end = self.find_after(text, closer, body_start)
+        if body_end == -1 or body_end + len(closer) > endpos:
+            return None
+        return body_start, body_end, body_end + len(closer)
+    
+    def match_link(self, text, pos):
+        '''Match the rest of a link whose target starts at pos.
+        
+        Returns (target_end, label_end, end), with label_end None for a 
+        link without a label, or None if there is no link.
+        '''
+        endpos = self.endpos
+        target_end = self.find_after(text, self.link_delimiter_pattern, pos)
+        if target_end == -1 or target_end >= endpos:
+            return None
+        if text[target_end] == '|':
+            label_end = self.find_after(text, ']', target_end + 1)
+            if label_end != -1 and text.startswith(']]', label_end, endpos):
+                return target_end, label_end, label_end + 2
+        elif text.startswith(']]', target_end, endpos):
+            return target_end, None, target_end + 2
+        return None
+    
+    def irregular(self, reason):
+        '''Give up on markup whose conversion the sequential passes may 
+        not agree with, if strict.'''
+        if self.strict:
+            raise IrregularMarkup(reason)
+    
+    def check_span(self, text, start, end):
+        '''Check a construct from start to end for markup that the 
+        sequential passes see differently: verbatim or a [[toc]], which 
+        they have taken out before, or a table row, which they convert 
+        after it.'''
+        if not self.strict:
+            return
+        for marker in SPAN_IRREGULAR_MARKERS:
+            if text.find(marker, start, end) != -1:
+                self.irregular('%s in a construct' % marker)
+    
+    def emit_literal(self, matchobj, out):
+        '''An opener that doesn't start a construct after all.
+        
+        Only its '[[' is skipped; the rest is scanned like any text, e.g. 
+        for the italics in '[[http:////'.
+        '''
+        self.irregular('unclosed ' + matchobj.group())
+        end = matchobj.group().index('[[') + 2
+        out.append(matchobj.group()[:end])
+        return matchobj.start() + end
+    
+    def emit_verbatim(self, end, out, node):
+        # the sequential passes see a placeholder here, and a placeholder 
+        # doesn't end with a newline.
+        self.boundary = (end, self.sentinel)
+        out.append(node)
+        return end
+    
+    def handle_code(self, text, matchobj, out):
+        block = self.match_block(text, 'code', matchobj.end())
+        if block is None:
+            return self.emit_literal(matchobj, out)
+        body_start, body_end, end = block
+        code_post = ''
+        if text.startswith('\n', end, self.endpos):
+            code_post = '\n'
+            end += 1
+        code = text[body_start:body_end]
+        if '[[math' in code or '``' in code:
+            self.irregular('verbatim in code')
+        if self.options.debug:
+            print code
+        code_pre = ''
+        if matchobj.lastgroup == 'code_nl':
+            code_pre = '\n'
+        return self.emit_verbatim(end, out, Code(code, code_pre, code_post))
+    
+    handle_code_nl = handle_code
+    
+    def handle_math(self, text, matchobj, out):
+        block = self.match_block(text, 'math', matchobj.end())
+        if block is None:
+            return self.emit_literal(matchobj, out)
+        body_start, body_end, end = block
+        code = text[body_start:body_end]
+        if '[[code' in code or '``' in code:
+            self.irregular('verbatim in math')
+        if self.options.debug:
+            print code
+        return self.emit_verbatim(end, out, Math(code))
+    
+    def handle_escape(self, text, matchobj, out):
+        body = matchobj.group('escape_body')
+        if '[[code' in body or '[[math' in body:
+            self.irregular('verbatim in escape')
+        return self.emit_verbatim(matchobj.end(), out, Escape(body))
+    
+    def handle_toc(self, text, matchobj, out):
+        previous = self.previous_char(text, matchobj.start())
+        following = text[matchobj.end():matchobj.end() + 1]
+        # the text before may also be verbatim, which is restored later
+        raw_previous = text[matchobj.start() - 1:matchobj.start()]
+        if following != '\n' and (self.table_depth is not None or 
+                ((previous in LINK_JOIN_CHARS or 
+                  raw_previous in LINK_JOIN_CHARS) and 
+                 following in LINK_JOIN_CHARS)):
+            # removing the tag joins the text around it into markup, or 
+            # into the cells of a table
+            self.irregular('markup joined by ' + matchobj.group())
+        self.boundary = (matchobj.end(), previous)
+        out.append(Toc(matchobj.group().endswith('|flat]]')))
+        return matchobj.end()
+    
+    handle_toc_nl = handle_toc
+    
+    def handle_external_link(self, text, matchobj, out):
+        link = self.match_link(text, matchobj.end())
+        if link is None:
+            return self.emit_literal(matchobj, out)
+        url_end, label_end, end = link
+        self.check_span(text, matchobj.start(), end)
+        if (text.find('[[', matchobj.end(), url_end) != -1 or 
+                text.find('//', matchobj.end() - 1, url_end) != -1):
+            # parse_italics runs first
+            self.irregular('markup in a url')
+        if label_end is None and (text[url_end - 1] in LINK_JOIN_CHARS or 
+                                  text[end:end + 1] in LINK_JOIN_CHARS):
+            self.irregular('naked link next to markup')
+        url = self.scan_to_list(text, matchobj.start() + 2, url_end)
+        label = None
+        if label_end is not None:
+            label = self.scan_to_list(text, url_end + 1, label_end)
+        out.append(ExternalLink(url, label))
+        return end
+    
+    def handle_file_link(self, text, matchobj, out):
+        link = self.match_link(text, matchobj.end())
+        if link is None:
+            return self.emit_literal(matchobj, out)
+        filename_end, label_end, end = link
+        self.check_span(text, matchobj.start(), end)
+        if text.find('[[', matchobj.end(), filename_end) != -1:
+            self.irregular('markup in a file name')
+        if label_end is None and self.strict:
+            # the name is written twice, and its marks can pair up with 
+            # their own copies
+            name = text[matchobj.end():filename_end]
+            for mark in FILE_NAME_PAIRED_MARKS:
+                if mark in name:
+                    self.irregular('paired mark in a file name')
+        filename = self.scan_to_list(text, matchobj.end(), filename_end, 
+                                     joined=True)
+        label = None
+        if label_end is not None:
+            label = self.scan_to_list(text, filename_end + 1, label_end, 
+                                      joined=True)
+        out.append(FileLink(filename, label))
+        return end
+    
+    def handle_include(self, text, matchobj, out):
+        quote = self.find_after(text, '"', matchobj.end())
+        close = -1
+        if quote != -1:
+            close = self.find_after(text, ']', quote + 1)
+        if close == -1 or not text.startswith(']]', close, self.endpos):
+            return self.emit_literal(matchobj, out)
+        if '[[' in text[matchobj.end():close]:
+            self.irregular('include around other markup')
+        self.check_span(text, matchobj.start(), close)
+        out.append(Include(self.scan_to_list(text, matchobj.end(), quote)))
+        return close + 2
+    
+    def handle_image(self, text, matchobj, out):
+        start = matchobj.end()
+        if self.in_image:
+            # the sequential passes convert the whole tag in one match
+            self.irregular('image in image')
+            out.append('[[image:')
+            return start
+        end = self.find_after(text, ']', start)
+        if end == -1 or end >= self.endpos:
+            self.irregular('unclosed image')
+        self.check_span(text, start, end)
+        if self.strict and text.find('||', start, end) != -1:
+            # tables are converted before images
+            self.irregular('table in an image')
+        if end == -1 or end > self.endpos:
+            end = self.endpos
+        self.in_image = True
+        try:
+            tag = self.scan_to_list(text, start, end, joined=True)
+        finally:
+            self.in_image = False
+        if self.options.debug:
+            print text[matchobj.start():end]
+        closer = ''
+        if text.startswith(']]', end, self.endpos):
+            closer = ']]'
+        out.append(Image(tag, closer))
+        return end + len(closer)
+    
+    def handle_italics(self, text, matchobj, out):
+        out.append(SHARED_MARKS['//'])
+        return matchobj.end()
+    
+    def handle_underline(self, text, matchobj, out):
+        if self.underline_open is not None:
+            out.append(Format('underline', '__', False))
+            self.underline_open = None
+        elif self.has_closer(text, '__', matchobj.end()):
+            self.underline_open = self.open_mark('underline', '__', out)
+        else:
+            self.irregular('unclosed __')
+            out.append('__')
+        return matchobj.end()
+    
+    def handle_monospaced_open(self, text, matchobj, out):
+        if self.monospaced_open is not None:
+            out.append('{{')
+        elif self.has_closer(text, '}}', matchobj.end()):
+            self.monospaced_open = self.open_mark('monospaced', '{{', out)
+        else:
+            self.irregular('unclosed {{')
+            # the second '{' may start a {$page}
+            out.append('{')
+            return matchobj.start() + 1
+        return matchobj.end()
+    
+    def handle_monospaced_close(self, text, matchobj, out):
+        if self.monospaced_open is not None:
+            out.append(Format('monospaced', '}}', False))
+            self.monospaced_open = None
+        else:
+            out.append('}}')
+        return matchobj.end()
+    
+    def handle_variable(self, text, matchobj, out):
+        if (self.monospaced_open is not None and 
+                text[matchobj.end():matchobj.end() + 1] == '}'):
+            # '{$page}}': monospaced is converted first, and claims the '}}'
+            out.append('{$page')
+            out.append(Format('monospaced', '}}', False))
+            self.monospaced_open = None
+            return matchobj.end() + 1
+        if PAGE_NAME_MARKUP_REGEXP.search(self.page_name):
+            self.irregular('page name with markup')
+        out.append(Variable())
+        return matchobj.end()
+    
+    def handle_indent(self, text, matchobj, out):
+        indents = matchobj.group()
+        if self.previous_char(text, matchobj.start()) in ('\n', ''):
+            if self.options.debug:
+                print indents
+            out.append(Indent(len(indents)))
+        else:
+            out.append(indents)
+        return matchobj.end()
+    
+    def handle_table(self, text, matchobj, out):
+        start = matchobj.start()
+        if self.table_depth is not None:
+            return self.handle_table_delimiter(text, matchobj, out)
+        if (self.no_more_tables or self.depth > 1 or 
+                self.previous_char(text, start) != '\n'):
+            out.append('||')
+            return matchobj.end()
+        
+        self.table_depth = self.depth + 1
+        self.table_ended = False
+        table_out = ['||']
+        self.joined += 1
+        try:
+            end = self.scan(text, matchobj.end(), len(text), table_out)
+        finally:
+            self.joined -= 1
+        ended = self.table_ended
+        self.table_depth = None
+        self.table_ended = False
+        if not ended:
+            # then no later table can be terminated either.
+            self.irregular('unterminated table')
+            self.no_more_tables = True
+        out.append(Table(table_out, ended))
+        return end
+    
+    def handle_table_delimiter(self, text, matchobj, out):
+        '''A '||' inside a table: a cell delimiter, or the end of the table.'''
+        pos = matchobj.end()
+        if text[pos:pos + 1] == '|':
+            # '|||': the table can only end at the last two
+            out.append('|')
+            return matchobj.start() + 1
+        out.append('||')
+        if self.depth == self.table_depth and self.is_table_end(text, pos):
+            self.table_ended = True
+        return pos
+    
+    def is_table_end(self, text, pos):
+        '''Would the sequential passes see a line break and no table row at pos?'''
+        toc = self.toc_pattern.match(text, pos)
+        while toc is not None:
+            pos = toc.end()
+            toc = self.toc_pattern.match(text, pos)
+        if text[pos:pos + 1] != '\n':
+            return False
+        if (text.startswith('\n[[code', pos) and 
+                self.match_block(text, 'code', pos + len('\n[[code'))):
+            # the line break is part of a verbatim placeholder
+            return False
+        following = text[pos + 1:pos + 3]
+        return following[:1] not in ('|', '') or following[1:] not in ('|', '')
 
 
 if __name__ == '__main__':
     s = Starter()
-    s.start()
+    if s.start():
+        sys.exit(1)